@@ -0,0 +1,284 @@
+import os
+import json
+import argparse
+import numpy as np
+import netCDF4 as nc
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Generate synthetic, ORCA2-shaped NEMO/NEMOTAM files so that the scripts in
+DIAGNOSTICS can be run (and benchmarked) without a model run. Files are laid
+out as the diagnostics expect them, relative to OUTPUT_DIRECTORY:
+
+mesh_mask.nc, subbasins.nc       : grid (31x149x182) and Atlantic basin mask
+WATER_MASS_OUTPUTS/WATER_MASS_tan_output.nc
+                                 : tangent-linear run; pt_conc_tl is a tracer
+                                   patch in the North Atlantic which spreads
+                                   from record to record
+WATER_MASS_OUTPUTS/WATER_MASS_adj_output.nc
+                                 : adjoint run; pt_vent_ad is non-zero only at
+                                   surface outcrops, and accumulates in time
+ADV_OUTPUTS/adv_*_output.nc      : the tangent-linear patch under the four
+                                   advection schemes (with small negative
+                                   overshoots for the non-monotonic ones)
+TRAJ_CLIMATOLOGY_60y.nc          : 365-day trajectory climatology
+TRAJECTORY/t_????????_????.nc    : trajectory tiles with DOMAIN_ attributes, as
+                                   written by NEMO on jpni x jpnj processors
+SYNTHETIC_CONFIG.json            : the settings used (read by run_benchmarks.py)
+
+Temperature and salinity are smooth functions of latitude and depth (with
+noise), and land follows a synthetic bathymetry, so that the tracer and
+water-mass fields have realistic sparsity.
+
+Usage: python make_synthetic_outputs.py [--records N] [--tiles 4x16] ...
+       (see --help)
+'''
+
+NZ,NY,NX=31,149,182
+FILL_VALUE=1e20
+
+################################################################################
+#                                 GRID
+################################################################################
+
+def synthetic_grid(nz=NZ,ny=NY,nx=NX):
+    '''ORCA2-like grid, bathymetry and Atlantic basin mask'''
+    lat=np.linspace(-78,89.7,ny)[:,np.newaxis]*np.ones((1,nx))
+    lon=((np.linspace(78,78+360,nx,endpoint=False)+180)%360-180)[np.newaxis,:]*np.ones((ny,1))
+    e1t=np.maximum(111e3*(360./nx)*np.cos(np.deg2rad(lat)),2e4)
+    e2t=111e3*(167.7/(ny-1))*np.ones((ny,nx))
+    e3t_1d=10+490*(np.arange(nz)/float(nz-1))**2
+    gdept_1d=np.cumsum(e3t_1d)-e3t_1d/2
+
+    # Continents, with shelves shoaling towards their coasts over coast_cells
+    # grid cells, and a deep ocean interior:
+    continent=(np.sin(np.deg2rad(2*lon))*np.cos(np.deg2rad(1.5*lat))>0.55) | (lat<-70)
+    continent|=(lon>-30) & (lon<40) & (lat>-35) & (lat<35) & (np.abs(lon-10)>12) # Africa
+    coast_cells=np.full((ny,nx),4)
+    land=continent.copy()
+    for distance in np.arange(4):
+        coast_cells[~continent & land & (coast_cells==4)]=distance
+        land=land | np.roll(land,1,0) | np.roll(land,-1,0) | np.roll(land,1,1) | np.roll(land,-1,1)
+    deep=0.8+0.2*np.cos(np.deg2rad(3*lon))*np.sin(np.deg2rad(2*lat+30))
+    nlevels=np.where(continent,0,np.clip((nz*np.minimum(deep,0.2+0.2*coast_cells)).astype(int),\
+                                         3,nz))
+    tmask=(np.arange(nz)[:,np.newaxis,np.newaxis]<nlevels).astype(np.int8)
+
+    atlmsk=((lon>-100) & (lon<20) & (lat>-35) & (lat<70) & (nlevels>0)).astype(np.float32)
+    return {'lat':lat,'lon':lon,'e1t':e1t,'e2t':e2t,'e3t_1d':e3t_1d,'gdept_1d':gdept_1d,\
+            'tmask':tmask,'atlmsk':atlmsk}
+
+def write_mesh_mask(filename,GRID):
+    nz,ny,nx=GRID['tmask'].shape
+    MESH=nc.Dataset(filename,'w')
+    MESH.createDimension('x',nx)
+    MESH.createDimension('y',ny)
+    MESH.createDimension('z',nz)
+    MESH.createDimension('t',None)
+    e3t=GRID['e3t_1d'][:,np.newaxis,np.newaxis]*np.ones((nz,ny,nx))
+    for name,value in [('nav_lon',GRID['lon']),('nav_lat',GRID['lat'])]:
+        MESH.createVariable(name,np.float32,('y','x'))[:]=value
+    for name,value in [('glamt',GRID['lon']),('gphit',GRID['lat']),\
+                       ('e1t',GRID['e1t']),('e2t',GRID['e2t']),('e1v',GRID['e1t'])]:
+        MESH.createVariable(name,np.float64,('t','y','x'))[:]=value[np.newaxis]
+    for name,value in [('e3t',e3t),('e3v',e3t)]:
+        MESH.createVariable(name,np.float64,('t','z','y','x'))[:]=value[np.newaxis]
+    MESH.createVariable('tmask'  ,np.int8   ,('t','z','y','x'))[:]=GRID['tmask'][np.newaxis]
+    MESH.createVariable('gdept_0',np.float64,('t','z'))[:]=GRID['gdept_1d'][np.newaxis]
+    MESH.close()
+
+def write_subbasins(filename,GRID):
+    ny,nx=GRID['atlmsk'].shape
+    SUBBASINS=nc.Dataset(filename,'w')
+    SUBBASINS.createDimension('x',nx)
+    SUBBASINS.createDimension('y',ny)
+    SUBBASINS.createVariable('navlat',np.float32,('y','x'))[:]=GRID['lat']
+    SUBBASINS.createVariable('atlmsk',np.float32,('y','x'))[:]=GRID['atlmsk']
+    SUBBASINS.close()
+
+################################################################################
+#                                FIELDS
+################################################################################
+
+def temperature_salinity(GRID,rng,record=0):
+    '''Smooth (z,y,x) T and S with a seasonal cycle and noise'''
+    depth=GRID['gdept_1d'][:,np.newaxis,np.newaxis]
+    lat  =GRID['lat'][np.newaxis]
+    season=np.cos(2*np.pi*record/365.)*np.sin(np.deg2rad(lat))
+    shape=np.shape(depth*lat)
+    tn=(1+27*np.cos(np.deg2rad(lat))**2+3*season)*np.exp(-depth/700.)+0.5\
+       +0.3*rng.standard_normal(shape)
+    sn=34.6+1.9*np.exp(-depth/900.)*np.cos(np.deg2rad(lat-20))**2+0.3*np.exp(-depth/1500.)\
+       +0.05*rng.standard_normal(shape)
+    return tn.astype(np.float32),sn.astype(np.float32)
+
+def velocity(GRID,rng):
+    '''(z,y,x) u and v with a western-intensified gyre and noise'''
+    depth=GRID['gdept_1d'][:,np.newaxis,np.newaxis]
+    lat,lon=GRID['lat'][np.newaxis],GRID['lon'][np.newaxis]
+    shape=np.shape(depth*lat)
+    un=0.1*np.sin(np.deg2rad(3*lat))*np.exp(-depth/1000.)+0.01*rng.standard_normal(shape)
+    vn=0.2*np.exp(-((lon+75)/8.)**2)*np.cos(np.deg2rad(2*lat))*np.exp(-depth/1000.)\
+       -0.02*np.exp(-((depth-2000)/800.)**2)+0.01*rng.standard_normal(shape)
+    return un.astype(np.float32),vn.astype(np.float32)
+
+def tracer_patch(GRID,record,nrecords,lat0=35.,lon0=-55.,dep0=300.,overshoot=0.):
+    '''(z,y,x) tracer patch spreading with record number, zero far from it'''
+    depth=GRID['gdept_1d'][:,np.newaxis,np.newaxis]
+    lat,lon=GRID['lat'][np.newaxis],GRID['lon'][np.newaxis]
+    width=3.+25.*record/max(nrecords-1,1)
+    r2=((lat-lat0)/width)**2+((lon-lon0)/(1.5*width))**2+((depth-dep0)/(100.+40*width))**2
+    conc=np.exp(-r2)/(1+record*0.1)
+    conc-=overshoot*np.exp(-r2/4.)*np.cos(6*np.sqrt(r2))**2 # Non-monotonic schemes
+    conc[np.abs(conc)<1e-3]=0
+    return conc.astype(np.float32)
+
+def masked(data,tmask):
+    return np.ma.masked_array(data,np.broadcast_to(tmask==0,np.shape(data)))
+
+def create_output_file(filename,nz,ny,nx,variables):
+    '''netCDF file with (t,z,y,x) or (t,y,x) variables {name:ndim}'''
+    OUT=nc.Dataset(filename,'w')
+    OUT.createDimension('x',nx)
+    OUT.createDimension('y',ny)
+    OUT.createDimension('z',nz)
+    OUT.createDimension('t',None)
+    for name,ndim in variables.items():
+        dims=('t','z','y','x') if ndim==4 else ('t','y','x')
+        OUT.createVariable(name,np.float32,dims,fill_value=FILL_VALUE)
+    return OUT
+
+################################################################################
+#                                OUTPUTS
+################################################################################
+
+def write_tangent_linear_output(filename,GRID,nrecords,rng):
+    nz,ny,nx=GRID['tmask'].shape
+    OUT=create_output_file(filename,nz,ny,nx,{'pt_conc_tl':4,'tn':4,'sn':4})
+    for ii in np.arange(nrecords):
+        tn,sn=temperature_salinity(GRID,rng,ii*10950/15)
+        OUT.variables['pt_conc_tl'][ii]=masked(tracer_patch(GRID,ii,nrecords),GRID['tmask'])
+        OUT.variables['tn'        ][ii]=masked(tn,GRID['tmask'])
+        OUT.variables['sn'        ][ii]=masked(sn,GRID['tmask'])
+    OUT.close()
+
+def write_adjoint_output(filename,GRID,nrecords,rng):
+    '''Adjoint run; records are in model (not age) order'''
+    nz,ny,nx=GRID['tmask'].shape
+    OUT=create_output_file(filename,nz,ny,nx,{'pt_vol_ad':4,'pt_vent_ad':3,'tn':4,'sn':4})
+    cell_volume=GRID['e1t']*GRID['e2t']*GRID['e3t_1d'][:,np.newaxis,np.newaxis]
+    outcrops=(GRID['atlmsk']>0) & (GRID['lat']>45)
+    ventilated=np.zeros((ny,nx))
+    for ii in np.arange(nrecords):
+        age=nrecords-1-ii
+        tn,sn=temperature_salinity(GRID,rng,ii*10950/15)
+        patch=tracer_patch(GRID,age,nrecords,lat0=35.,lon0=-55.,dep0=1000.)
+        ventilated+=outcrops*rng.random((ny,nx))*(rng.random((ny,nx))<0.3)
+        OUT.variables['pt_vol_ad' ][ii]=masked(patch*cell_volume,GRID['tmask'])
+        OUT.variables['pt_vent_ad'][ii]=masked(ventilated*1e9*age/nrecords,GRID['tmask'][0])
+        OUT.variables['tn'        ][ii]=masked(tn,GRID['tmask'])
+        OUT.variables['sn'        ][ii]=masked(sn,GRID['tmask'])
+    OUT.close()
+
+def write_advection_outputs(directory,GRID,nrecords):
+    nz,ny,nx=GRID['tmask'].shape
+    for scheme,overshoot in [('TVD',0.),('weighted_mean',0.),('upwind',0.),('centred',0.05)]:
+        OUT=create_output_file(directory+'adv_'+scheme+'_output.nc',nz,ny,nx,{'pt_conc_tl':4})
+        for ii in np.arange(nrecords):
+            OUT.variables['pt_conc_tl'][ii]=masked(tracer_patch(GRID,ii*(1+overshoot),nrecords,\
+                                                                overshoot=overshoot),GRID['tmask'])
+        OUT.close()
+
+def write_climatology(filename,GRID,ndays,rng):
+    nz,ny,nx=GRID['tmask'].shape
+    OUT=create_output_file(filename,nz,ny,nx,{'tn':4,'sn':4,'un':4,'vn':4})
+    for day in np.arange(ndays):
+        tn,sn=temperature_salinity(GRID,rng,day)
+        un,vn=velocity(GRID,rng)
+        for name,value in [('tn',tn),('sn',sn),('un',un),('vn',vn)]:
+            OUT.variables[name][day]=masked(value,GRID['tmask'])
+    OUT.close()
+
+def write_trajectory_tiles(directory,GRID,jpni,jpnj,nsteps_total,nsteps_per_day,rng):
+    '''Trajectory tile files t_<step>_<tile>.nc, one record each'''
+    nz,ny,nx=GRID['tmask'].shape
+    iedges=np.linspace(0,nx,jpni+1).astype(int)
+    jedges=np.linspace(0,ny,jpnj+1).astype(int)
+    for step in np.arange(0,nsteps_total+1,nsteps_per_day):
+        tn,sn=temperature_salinity(GRID,rng,step//nsteps_per_day)
+        un,vn=velocity(GRID,rng)
+        for jj in np.arange(jpnj):
+            for ii in np.arange(jpni):
+                tile=jj*jpni+ii
+                jslice=slice(jedges[jj],jedges[jj+1])
+                islice=slice(iedges[ii],iedges[ii+1])
+                TILE=nc.Dataset(directory+'t_%08d_%04d.nc'%(step,tile),'w')
+                TILE.DOMAIN_number        =tile
+                TILE.DOMAIN_size_global   =[nx,ny]
+                TILE.DOMAIN_size_local    =[islice.stop-islice.start,jslice.stop-jslice.start]
+                TILE.DOMAIN_position_first=[islice.start+1,jslice.start+1]
+                TILE.DOMAIN_position_last =[islice.stop   ,jslice.stop   ]
+                TILE.DOMAIN_halo_size_start=[0,0]
+                TILE.DOMAIN_halo_size_end  =[0,0]
+                TILE.createDimension('x',islice.stop-islice.start)
+                TILE.createDimension('y',jslice.stop-jslice.start)
+                TILE.createDimension('z',nz)
+                TILE.createDimension('t',None)
+                TILE.createVariable('nav_lon',np.float32,('y','x'))[:]=GRID['lon'][jslice,islice]
+                TILE.createVariable('nav_lat',np.float32,('y','x'))[:]=GRID['lat'][jslice,islice]
+                for name,value in [('tn',tn),('sn',sn),('un',un),('vn',vn)]:
+                    TILE.createVariable(name,np.float32,('t','z','y','x'),fill_value=FILL_VALUE)\
+                        [0]=masked(value,GRID['tmask'])[:,jslice,islice]
+                TILE.close()
+
+################################################################################
+#                                 MAIN
+################################################################################
+
+def make_synthetic_outputs(output_directory,nrecords=20,nclimatology_days=365,jpni=4,jpnj=16,\
+                           nsteps_per_day=15,ndays_per_year=5,nyears=2,shape=(NZ,NY,NX),seed=0):
+    '''Write every synthetic file under output_directory'''
+    rng=np.random.default_rng(seed)
+    nsteps_total=nsteps_per_day*ndays_per_year*nyears
+    for subdirectory in ['','WATER_MASS_OUTPUTS/','ADV_OUTPUTS/','TRAJECTORY/']:
+        if not os.path.isdir(output_directory+subdirectory):
+            os.makedirs(output_directory+subdirectory)
+    GRID=synthetic_grid(*shape)
+    print('writing grid');         write_mesh_mask(output_directory+'mesh_mask.nc',GRID)
+    write_subbasins(output_directory+'subbasins.nc',GRID)
+    print('writing tangent-linear output')
+    write_tangent_linear_output(output_directory+'WATER_MASS_OUTPUTS/WATER_MASS_tan_output.nc',\
+                                GRID,nrecords,rng)
+    print('writing adjoint output')
+    write_adjoint_output(output_directory+'WATER_MASS_OUTPUTS/WATER_MASS_adj_output.nc',\
+                         GRID,nrecords,rng)
+    print('writing advection scheme outputs')
+    write_advection_outputs(output_directory+'ADV_OUTPUTS/',GRID,nrecords)
+    print('writing trajectory climatology')
+    write_climatology(output_directory+'TRAJ_CLIMATOLOGY_60y.nc',GRID,nclimatology_days,rng)
+    print('writing trajectory tiles')
+    write_trajectory_tiles(output_directory+'TRAJECTORY/',GRID,jpni,jpnj,\
+                           nsteps_total,nsteps_per_day,rng)
+    with open(output_directory+'SYNTHETIC_CONFIG.json','w') as f:
+        json.dump({'nrecords':nrecords,'nclimatology_days':nclimatology_days,\
+                   'nprocessors':jpni*jpnj,'jpni':jpni,'jpnj':jpnj,\
+                   'nsteps_per_day':nsteps_per_day,'nsteps_per_year':nsteps_per_day*ndays_per_year,\
+                   'nsteps_total':nsteps_total,'shape':list(shape),'seed':seed},f,indent=1)
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Generate synthetic ORCA2-shaped NEMOTAM files')
+    parser.add_argument('output_directory',nargs='?',default='./SYNTHETIC_OUTPUTS/')
+    parser.add_argument('--records',type=int,default=20,help='records in each run output')
+    parser.add_argument('--climatology-days',type=int,default=365)
+    parser.add_argument('--tiles',default='4x16',help='trajectory tiles, jpni x jpnj')
+    parser.add_argument('--days-per-year',type=int,default=5,help='trajectory days per year')
+    parser.add_argument('--years',type=int,default=2,help='trajectory years')
+    parser.add_argument('--shape',default='%dx%dx%d'%(NZ,NY,NX),help='grid size, z x y x x')
+    parser.add_argument('--seed',type=int,default=0)
+    args=parser.parse_args()
+    jpni,jpnj=[int(n) for n in args.tiles.split('x')]
+    make_synthetic_outputs(os.path.join(args.output_directory,''),args.records,\
+                           args.climatology_days,jpni,jpnj,ndays_per_year=args.days_per_year,\
+                           nyears=args.years,shape=tuple(int(n) for n in args.shape.split('x')),\
+                           seed=args.seed)
@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import shutil
+import time
+import glob
+import runpy
+import argparse
+import resource
+import subprocess
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Time, and measure the peak memory of, every script in DIAGNOSTICS and the
+trajectory climatology pipeline against the synthetic outputs written by
+make_synthetic_outputs.py, so that successive versions can be compared
+without a model run.
+
+Each benchmark runs in a fresh python process with the synthetic output
+directory as its working directory (so the scripts' default './' paths
+point at the synthetic files), and reports:
+wall_time     : seconds spent in the benchmark itself (imports excluded)
+peak_rss_MB   : peak resident memory of the benchmark process
+peak_rss_children_MB
+              : largest peak resident memory of any worker process it
+                started (0 if none)
+The grid metrics cache is built before timing starts, so every benchmark
+sees a warm cache, and the results store is emptied before each benchmark,
+so that results are always calculated rather than loaded.
+
+Results are appended as one JSON line per invocation (git commit, time,
+synthetic settings and results) to RESULTS_FILE. With --compare, each result
+is also shown as a ratio to the previous entry in RESULTS_FILE.
+
+Usage: python make_synthetic_outputs.py SYNTHETIC_OUTPUTS/
+       python run_benchmarks.py SYNTHETIC_OUTPUTS/ [--only NAME ...] [--compare]
+'''
+
+BENCHMARKS_DIRECTORY =os.path.dirname(os.path.abspath(__file__))
+DIAGNOSTICS_DIRECTORY=os.path.join(BENCHMARKS_DIRECTORY,'..','DIAGNOSTICS')
+RESULTS_FILE         =os.path.join(BENCHMARKS_DIRECTORY,'benchmark_results.jsonl')
+
+################################################################################
+#                              BENCHMARKS
+################################################################################
+# Each benchmark is run by a function of the synthetic settings (CONFIG),
+# called in the synthetic output directory.
+
+def run_script(name):
+    def benchmark(CONFIG):
+        runpy.run_path(os.path.join(DIAGNOSTICS_DIRECTORY,name+'.py'),run_name='__main__')
+    return benchmark
+
+def tangent_linear_streaming(CONFIG):
+    import netCDF4 as nc
+    import numpy as np
+    from grid_metrics import grid_metrics
+    from streaming_diagnostics import tangent_linear_streaming
+    OUTPUT_NC=nc.Dataset('WATER_MASS_OUTPUTS/WATER_MASS_tan_output.nc')
+    tangent_linear_streaming(OUTPUT_NC,grid_metrics('mesh_mask.nc'),\
+                             np.arange(-2,30.01,0.1),np.arange(32,38.01,0.01))
+
+def adjoint_streaming(CONFIG):
+    import netCDF4 as nc
+    import numpy as np
+    from grid_metrics import grid_metrics
+    from streaming_diagnostics import adjoint_streaming
+    OUTPUT_NC=nc.Dataset('WATER_MASS_OUTPUTS/WATER_MASS_adj_output.nc')
+    adjoint_streaming(OUTPUT_NC,grid_metrics('mesh_mask.nc'),\
+                      np.arange(-2,30.01,0.1),np.arange(32,38.01,0.01))
+
+def build_trajectory_climatology(CONFIG):
+    from build_trajectory_climatology import build_trajectory_climatology
+    build_trajectory_climatology('BENCHMARK_TRAJ_CLIMATOLOGY.nc','TRAJECTORY',\
+                                 nprocessors    =CONFIG['nprocessors'],\
+                                 nsteps_per_year=CONFIG['nsteps_per_year'],\
+                                 nsteps_total   =CONFIG['nsteps_total'],\
+                                 nsteps_per_day =CONFIG['nsteps_per_day'],\
+                                 sums_file='BENCHMARK_running_sums.nc')
+
+def rearrange_climatology_for_rebuild_nemo(CONFIG):
+    # One day of the trajectory, for every tile, as in produce_trajectory_climatology.sh
+    import multiprocessing
+    from rearrange_climatology_for_rebuild_nemo import rearrange
+    fnames=sorted(glob.glob('TRAJECTORY/t_00000000_????.nc'))
+    pool=multiprocessing.Pool(min(os.cpu_count(),len(fnames)))
+    outfiles=pool.map(rearrange,fnames)
+    pool.close()
+    pool.join()
+    for outfile in outfiles:
+        os.remove(outfile)
+
+BENCHMARKS=[('diagnostics_tangent_linear'            ,run_script('diagnostics_tangent_linear')),
+            ('tangent_linear_streaming'              ,tangent_linear_streaming),
+            ('diagnostics_adjoint'                   ,run_script('diagnostics_adjoint')),
+            ('adjoint_streaming'                     ,adjoint_streaming),
+            ('compare_advection_schemes'             ,run_script('compare_advection_schemes')),
+            ('climatology_NADW_properties'           ,run_script('climatology_NADW_properties')),
+            ('climatology_NASMW_properties'          ,run_script('climatology_NASMW_properties')),
+            ('climatology_stream_functions'          ,run_script('climatology_stream_functions')),
+            ('build_trajectory_climatology'          ,build_trajectory_climatology),
+            ('rearrange_climatology_for_rebuild_nemo',rearrange_climatology_for_rebuild_nemo)]
+
+################################################################################
+#                              FUNCTIONS
+################################################################################
+
+def read_config(data_directory):
+    with open(os.path.join(data_directory,'SYNTHETIC_CONFIG.json')) as f:
+        return json.load(f)
+
+def run_one(name,data_directory,result_file):
+    '''Run a single benchmark in this process and write its result to result_file'''
+    sys.path.insert(0,DIAGNOSTICS_DIRECTORY)
+    os.chdir(data_directory)
+    CONFIG=read_config('.')
+    benchmark=dict(BENCHMARKS)[name]
+    shutil.rmtree('RESULTS_STORE',ignore_errors=True)
+    t0=time.perf_counter()
+    benchmark(CONFIG)
+    wall_time=time.perf_counter()-t0
+    RESULT={'wall_time'           :wall_time,
+            'peak_rss_MB'         :resource.getrusage(resource.RUSAGE_SELF    ).ru_maxrss/1024.,
+            'peak_rss_children_MB':resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.}
+    with open(result_file,'w') as f:
+        json.dump(RESULT,f)
+
+def warm_grid_cache(data_directory):
+    sys.path.insert(0,DIAGNOSTICS_DIRECTORY)
+    from grid_metrics import grid_metrics
+    cwd=os.getcwd()
+    os.chdir(data_directory)
+    grid_metrics('mesh_mask.nc')
+    grid_metrics('mesh_mask.nc','subbasins.nc')
+    os.chdir(cwd)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','--short','HEAD'],\
+                                       cwd=BENCHMARKS_DIRECTORY).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def previous_results(results_file):
+    if not os.path.isfile(results_file):
+        return None
+    with open(results_file) as f:
+        lines=[line for line in f if line.strip()]
+    return json.loads(lines[-1]) if lines else None
+
+def run_benchmarks(data_directory,names=None,results_file=RESULTS_FILE,compare=False,quiet=True):
+    '''Run each benchmark in a subprocess and append the results to results_file'''
+    data_directory=os.path.abspath(data_directory)
+    names=names or [name for name,benchmark in BENCHMARKS]
+    warm_grid_cache(data_directory)
+    PREVIOUS=previous_results(results_file) if compare else None
+
+    RESULTS={}
+    for name in names:
+        result_file=os.path.join(data_directory,'.benchmark_%s.json'%name)
+        command=[sys.executable,os.path.abspath(__file__),data_directory,\
+                 '--run-one',name,'--result-file',result_file]
+        output=subprocess.DEVNULL if quiet else None
+        if subprocess.call(command,stdout=output)!=0:
+            print('%-40s FAILED'%name)
+            RESULTS[name]=None
+            continue
+        with open(result_file) as f:
+            RESULTS[name]=json.load(f)
+        os.remove(result_file)
+        line='%-40s %8.2f s %8.1f MB (workers %8.1f MB)'%(name,RESULTS[name]['wall_time'],\
+                RESULTS[name]['peak_rss_MB'],RESULTS[name]['peak_rss_children_MB'])
+        if PREVIOUS and PREVIOUS['results'].get(name):
+            line+='   x%.2f time, x%.2f memory vs %s'%(\
+                RESULTS[name]['wall_time']  /PREVIOUS['results'][name]['wall_time'],\
+                RESULTS[name]['peak_rss_MB']/PREVIOUS['results'][name]['peak_rss_MB'],\
+                PREVIOUS['commit'])
+        print(line)
+
+    with open(results_file,'a') as f:
+        f.write(json.dumps({'commit':git_commit(),\
+                            'time'  :time.strftime('%Y-%m-%dT%H:%M:%S'),\
+                            'config':read_config(data_directory),\
+                            'results':RESULTS})+'\n')
+    return RESULTS
+
+################################################################################
+#                                 MAIN
+################################################################################
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Benchmark the diagnostics on synthetic outputs')
+    parser.add_argument('data_directory',nargs='?',default='./SYNTHETIC_OUTPUTS/')
+    parser.add_argument('--only',nargs='+',choices=[name for name,benchmark in BENCHMARKS],\
+                        help='run only these benchmarks')
+    parser.add_argument('--results-file',default=RESULTS_FILE)
+    parser.add_argument('--compare',action='store_true',help='compare with the previous results')
+    parser.add_argument('--verbose',action='store_true',help="show the scripts' own output")
+    parser.add_argument('--run-one',help=argparse.SUPPRESS)
+    parser.add_argument('--result-file',help=argparse.SUPPRESS)
+    args=parser.parse_args()
+    if args.run_one:
+        run_one(args.run_one,args.data_directory,args.result_file)
+    else:
+        run_benchmarks(args.data_directory,args.only,args.results_file,args.compare,\
+                       quiet=not args.verbose)
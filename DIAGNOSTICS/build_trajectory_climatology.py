@@ -0,0 +1,280 @@
+import os
+import multiprocessing
+import numpy as np
+import netCDF4 as nc
+from nemo_io import tile_position
+from trajectory_store import record_variables,open_trajectory_tile,trajectory_blocks
+from instrumentation import stage,write_report,report_to,worker_stages,merge_stages
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Create a climatology from NEMOTAM trajectory files, replacing the
+ncra / rearrange_climatology_for_rebuild_nemo.py / rebuild_nemo / ncrcat loop
+in produce_trajectory_climatology.sh.
+
+Takes files TRAJECTORY_DIRECTORY/t_????????_????.nc and produces
+TRAJ_CLIMATOLOGY_Ny.nc. Each processor tile is handled by one worker of a
+process pool, which reads every trajectory file of that tile once and adds it
+to per-day running sums. The per-day means of each tile are then written
+straight into their position in the global (stitched) output file, using the
+DOMAIN_position_first/last attributes of the tile (as rebuild_nemo does). No
+intermediate files are written.
+
+As in produce_trajectory_climatology.sh, day D of the climatology is the
+average of trajectory steps D*NSTEPS_PER_DAY + k*NSTEPS_PER_YEAR for
+k=0,1,... up to NSTEPS_TOTAL. Points which are missing (_FillValue) in some
+records are averaged over the records in which they are present, as ncra does.
+
+The per-day running sums and sample counts are kept in RUNNING_SUMS_FILE
+alongside the climatology. When the trajectory is extended (e.g. by another
+50-year increment of make_trajectory_namelists.sh), set UPDATE=True and
+NSTEPS_TOTAL to the new final step: only the new trajectory files are read,
+the running sums are updated in place, one tile at a time, and the
+climatology for the whole trajectory is rewritten from them. The last step
+added to each tile is recorded (tile_last_step) as soon as its sums are
+written, and the last step of the whole file (last_step) only once every
+tile has been added, so an update that fails (e.g. on a missing trajectory
+file) can simply be repeated once the cause is fixed: tiles already updated
+are not read, or added, again. The climatology itself is replaced only once
+every tile has been written.
+
+If the trajectory has been repacked with trajectory_store.py, set
+TRAJECTORY_STORE to the store directory: each tile is then read from its
+single compressed store file, a block of records at a time, rather than from
+one file per trajectory step (the results are the same, up to any
+quantisation used when repacking).
+
+Time, bytes read and peak memory of each stage, in the parent and (summed
+over) the workers, are written to REPORT_FILE (see instrumentation.py).
+'''
+
+TRAJECTORY_DIRECTORY='[PATH TO TRAJECTORY]'
+NSTEPS_PER_YEAR=5475
+NSTEPS_TOTAL   =328500
+NSTEPS_PER_DAY =15   # nn_ittrjfrq: trajectory output frequency
+NPROCESSORS    =64   # Number of processors trajectory was run on
+NWORKERS       =multiprocessing.cpu_count()
+RUNNING_SUMS_FILE='TRAJ_CLIMATOLOGY_running_sums.nc'
+UPDATE         =False # Add new trajectory files to an existing RUNNING_SUMS_FILE
+REPORT_FILE    ='build_trajectory_climatology_report.json'
+TRAJECTORY_STORE=None # Directory of the repacked trajectory, if any (see trajectory_store.py)
+
+################################################################################
+#                              FUNCTIONS
+################################################################################
+
+def tile_daily_sums(tile,trajectory_directory=TRAJECTORY_DIRECTORY,\
+                    nsteps_per_year=NSTEPS_PER_YEAR,nsteps_total=NSTEPS_TOTAL,\
+                    nsteps_per_day=NSTEPS_PER_DAY,first_step=0,store_directory=None):
+    '''Read every trajectory record of one tile (from first_step to
+    nsteps_total) once, from its trajectory files or its store file, adding
+    each record to the running sum of its day of the year. Returns the sums
+    and the number of valid (non-missing) values contributing to them, per
+    variable'''
+    ndays=nsteps_per_year//nsteps_per_day
+    sums  ={}
+    counts={}
+    for steps,BLOCK in trajectory_blocks(tile,first_step,nsteps_total,nsteps_per_day,\
+                                         trajectory_directory,store_directory):
+        days=(steps%nsteps_per_year)//nsteps_per_day
+        for name,data in BLOCK.items():
+            with stage('running sums'):
+                if name not in sums:
+                    sums  [name]=np.zeros((ndays,)+data.shape[1:],dtype=np.float64)
+                    counts[name]=np.zeros((ndays,)+data.shape[1:],dtype=np.int32  )
+                for day in np.unique(days):
+                    day_data=data[days==day]
+                    sums  [name][day]+=np.sum(np.ma.filled(day_data,0),axis=0,dtype=np.float64)
+                    counts[name][day]+=np.sum(~np.ma.getmaskarray(day_data),axis=0)
+    return tile,sums,counts
+
+def _tile_daily_sums(args):
+    return tile_daily_sums(*args)+(worker_stages(),)
+
+def create_global_dimensions(OUT,TEMPLATE):
+    '''Copy the dimensions of a tile to OUT, at the size of the global domain'''
+    global_size=getattr(TEMPLATE,'DOMAIN_size_global',[TEMPLATE.dimensions['x'].size,\
+                                                       TEMPLATE.dimensions['y'].size])
+    for name,dimension in TEMPLATE.dimensions.items():
+        if dimension.isunlimited():
+            OUT.createDimension(name,None)
+        elif name=='x':
+            OUT.createDimension(name,global_size[0])
+        elif name=='y':
+            OUT.createDimension(name,global_size[1])
+        else:
+            OUT.createDimension(name,dimension.size)
+
+def create_climatology_file(outfile,TEMPLATE):
+    '''Create the stitched output file, with dimensions, variables and
+    attributes copied from the first tile (less its DOMAIN_ and STORE_
+    attributes)'''
+    OUT=nc.Dataset(outfile,'w')
+    OUT.setncatts(dict((key,value) for key,value in TEMPLATE.__dict__.items()\
+                       if not key.startswith(('DOMAIN','STORE'))))
+    create_global_dimensions(OUT,TEMPLATE)
+    for name,variable in TEMPLATE.variables.items():
+        fill_value=getattr(variable,'_FillValue',None)
+        x=OUT.createVariable(name,variable.datatype,variable.dimensions,fill_value=fill_value)
+        x.setncatts(dict((key,value) for key,value in variable.__dict__.items()\
+                         if key!='_FillValue'))
+    return OUT
+
+def create_running_sums_file(sums_file,TEMPLATE,last_step,ntiles):
+    '''Create the file holding the per-day running sum (<name>_sum) and
+    number of valid values (<name>_count) of each record variable, up to and
+    including trajectory step last_step, and the last step added to each of
+    ntiles tiles (tile_last_step)'''
+    SUMS=nc.Dataset(sums_file,'w')
+    SUMS.last_step=last_step
+    create_global_dimensions(SUMS,TEMPLATE)
+    for name in record_variables(TEMPLATE):
+        dimensions=TEMPLATE.variables[name].dimensions
+        SUMS.createVariable(name+'_sum'  ,np.float64,dimensions)
+        SUMS.createVariable(name+'_count',np.int32  ,dimensions,zlib=True)
+    tile_last_steps(SUMS,ntiles)[:]=last_step
+    return SUMS
+
+def tile_last_steps(SUMS,ntiles):
+    '''The tile_last_step variable of a running sums file, created (holding
+    its last_step for every tile) if the file predates it'''
+    if 'tile_last_step' not in SUMS.variables:
+        SUMS.createDimension('tile',ntiles)
+        SUMS.createVariable('tile_last_step',np.int64,('tile',))[:]=SUMS.last_step
+    return SUMS.variables['tile_last_step']
+
+def global_slice(variable,jslice,islice):
+    '''Index of a tile within a global variable'''
+    if variable.dimensions[-2:]==('y','x'):
+        return (Ellipsis,jslice,islice)
+    return (Ellipsis,)
+
+def read_tile_sums(SUMS,TILE,first_tile=True):
+    '''Running sums and counts of one tile, as saved in SUMS'''
+    jslice,islice=tile_position(TILE)
+    sums  ={}
+    counts={}
+    for name in record_variables(TILE):
+        index=global_slice(TILE.variables[name],jslice,islice)
+        if index==(Ellipsis,) and not first_tile:
+            continue
+        sums  [name]=np.ma.getdata(SUMS.variables[name+'_sum'  ][index])
+        counts[name]=np.ma.getdata(SUMS.variables[name+'_count'][index])
+    return sums,counts
+
+def write_tile(OUT,TILE,sums,counts,SUMS=None,accumulate=False,first_tile=True):
+    '''Write the per-day means of one tile, and its time-invariant
+    variables, into their position in the global output file. If SUMS is
+    given, the tile's running sums and counts are also saved there, after
+    adding those already in SUMS if accumulate is True. Record variables
+    without (y,x) dimensions (e.g. time) are the same in every tile, so are
+    only handled for the first_tile (tile 0).'''
+    jslice,islice=tile_position(TILE)
+    records=record_variables(TILE)
+    for name,variable in TILE.variables.items():
+        index=global_slice(variable,jslice,islice)
+        if name in records:
+            if index==(Ellipsis,) and not first_tile:
+                continue
+            if SUMS is not None:
+                if accumulate:
+                    sums  [name]+=np.ma.getdata(SUMS.variables[name+'_sum'  ][index])
+                    counts[name]+=np.ma.getdata(SUMS.variables[name+'_count'][index])
+                SUMS.variables[name+'_sum'  ][index]=sums  [name]
+                SUMS.variables[name+'_count'][index]=counts[name]
+            mean=np.ma.masked_where(counts[name]==0,sums[name]/np.maximum(counts[name],1))
+            OUT.variables[name][index]=mean.astype(variable.datatype)
+        else:
+            OUT.variables[name][index]=variable[:]
+
+def build_trajectory_climatology(outfile,trajectory_directory=TRAJECTORY_DIRECTORY,\
+                                 nprocessors=NPROCESSORS,nworkers=NWORKERS,\
+                                 nsteps_per_year=NSTEPS_PER_YEAR,nsteps_total=NSTEPS_TOTAL,\
+                                 nsteps_per_day=NSTEPS_PER_DAY,sums_file=RUNNING_SUMS_FILE,\
+                                 update=False,store_directory=None):
+    '''Build the climatology, one tile per worker, writing each tile into
+    the output file (and its running sums into sums_file) as soon as its
+    worker has finished. If update, only trajectory steps after the last
+    step already added to each tile of sums_file are read, and added to its
+    running sums in place. Tiles are read from store_directory if given
+    (see trajectory_store.py).
+
+    The output file is written under a temporary name and only replaces
+    outfile once every tile has succeeded. A new sums_file is written the
+    same way, while an update records each tile's progress in it (see
+    tile_last_steps), so a failed run (or update) can simply be repeated'''
+    tmp_outfile  =outfile  +'.tmp%d'%os.getpid()
+    tmp_sums_file=sums_file+'.tmp%d'%os.getpid()
+    OUT=SUMS=None
+    try:
+        if update:
+            SUMS=nc.Dataset(sums_file,'a')
+            first_step=int(SUMS.last_step)+nsteps_per_day
+            if first_step>nsteps_total:
+                SUMS.close()
+                print('%s already holds every step up to %d'%(sums_file,nsteps_total))
+                return
+            first_steps=np.asarray(tile_last_steps(SUMS,nprocessors)[:])+nsteps_per_day
+        else:
+            first_step=0
+            first_steps=np.zeros(nprocessors,dtype=np.int64)
+        TEMPLATE=open_trajectory_tile(0,first_step,trajectory_directory,store_directory)
+        OUT=create_climatology_file(tmp_outfile,TEMPLATE)
+        if not update:
+            SUMS=create_running_sums_file(tmp_sums_file,TEMPLATE,nsteps_total,nprocessors)
+        TEMPLATE.close()
+
+        ## Tiles already updated (by an update that failed) need only be written:
+        for tile in np.flatnonzero(first_steps>nsteps_total):
+            print('writing tile %04d (already updated)'%tile)
+            with stage('save'):
+                TILE=open_trajectory_tile(tile,first_step,trajectory_directory,store_directory)
+                sums,counts=read_tile_sums(SUMS,TILE,first_tile=tile==0)
+                write_tile(OUT,TILE,sums,counts,first_tile=tile==0)
+                TILE.close()
+
+        tasks=[(tile,trajectory_directory,nsteps_per_year,nsteps_total,nsteps_per_day,\
+                first_steps[tile],store_directory)\
+               for tile in np.flatnonzero(first_steps<=nsteps_total)]
+        pool=multiprocessing.Pool(nworkers)
+        try:
+            for tile,sums,counts,stages in pool.imap_unordered(_tile_daily_sums,tasks):
+                print('writing tile %04d'%tile)
+                merge_stages(stages)
+                with stage('save'):
+                    TILE=open_trajectory_tile(tile,first_step,trajectory_directory,\
+                                              store_directory)
+                    write_tile(OUT,TILE,sums,counts,SUMS,accumulate=update,first_tile=tile==0)
+                    TILE.close()
+                    # Only now does the tile hold every step up to nsteps_total:
+                    SUMS.variables['tile_last_step'][tile]=nsteps_total
+                    SUMS.sync()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        # ... and, once every tile does, the file:
+        SUMS.last_step=nsteps_total
+        SUMS.close()
+        OUT.close()
+        if not update:
+            os.replace(tmp_sums_file,sums_file)
+        os.replace(tmp_outfile,outfile)
+    finally:
+        for DATASET in [OUT,SUMS]:
+            if DATASET is not None and DATASET.isopen():
+                DATASET.close()
+        for filename in [tmp_outfile,tmp_sums_file]:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+################################################################################
+#                                 MAIN
+################################################################################
+
+if __name__=='__main__':
+    report_to(REPORT_FILE) # Rewritten as the script runs, so a killed job leaves a report
+    build_trajectory_climatology('TRAJ_CLIMATOLOGY_%dy.nc'%(NSTEPS_TOTAL//NSTEPS_PER_YEAR),\
+                                 update=UPDATE,store_directory=TRAJECTORY_STORE)
+    write_report(REPORT_FILE)
@@ -1,44 +1,33 @@
-import numpy as np
 import netCDF4 as nc
+from grid_metrics import grid_metrics
+from nemo_io import single_precision_reads
+from instrumentation import write_report,report_to
+from water_masses import NADW,water_mass_census
 
 PATH_TO_MESH_MASK             ='./'
 PATH_TO_SUBBASINS             ='./'
 PATH_TO_TRAJECTORY_CLIMATOLOGY='./'
+REPORT_FILE                   ='climatology_NADW_properties_report.json' # see instrumentation.py
+SINGLE_PRECISION              =False # Plain float32 reads, see nemo_io.single_precision_reads
 
-MESH     =nc.Dataset(PATH_TO_MESH_MASK+'mesh_mask.nc')
-SUBBASINS=nc.Dataset(PATH_TO_SUBBASINS+'subbasins.nc')
+report_to(REPORT_FILE) # Rewritten as the script runs, so a killed job leaves a report
+GRID     =grid_metrics(PATH_TO_MESH_MASK+'mesh_mask.nc',PATH_TO_SUBBASINS+'subbasins.nc')
 TRAJ_CLIM=nc.Dataset(PATH_TO_TRAJECTORY_CLIMATOLOGY+'TRAJ_CLIMATOLOGY_60y.nc')
-
-# Climatological temperature and salinity
-
-tn=TRAJ_CLIM.variables['tn'][0:365,:,:,:]
-sn=TRAJ_CLIM.variables['sn'][0:365,:,:,:]
-
-# Grid info and basin mask
-atlmsk=SUBBASINS.variables['atlmsk'][:]
-e1t=MESH.variables['e1t'][:]
-e2t=MESH.variables['e2t'][:]
-e3t=MESH.variables['e3t'][:]
-
+if SINGLE_PRECISION:
+    single_precision_reads(PATH_TO_MESH_MASK+'mesh_mask.nc')
 
 # Finding NADW in climatology
 ############################
-# Temperature constraint (2,4)*C
-NADW_t=tn*atlmsk
-NADW_t[ (NADW_t>4) | (NADW_t<2) ]=100
-NADW_t[NADW_t!=100]=1
-NADW_t[NADW_t==100]=0
-
-# Salinity constraint (34.9,35.0) psu
-NADW_s=sn*atlmsk
-NADW_s[ (NADW_s>35.0) | (NADW_s<34.9) ]=100
-NADW_s[NADW_s!=100]=1
-NADW_s[NADW_s==100]=0
-
-NADW_clim=NADW_t*NADW_s #Masks non-NADW locations in the climatology
-
-np.save('NADW_climavg.npy',NADW_clim)
+# Temperature constraint (2,4)*C, salinity constraint (34.9,35.0) psu, Atlantic
+# basin (see water_masses.py). The climatology is classified a few days at a
+# time, and the mask of NADW locations is saved bit-packed; it can be
+# recovered as a boolean (t,z,y,x) array with:
+# from water_masses import load_water_mass_mask
+# NADW_clim=load_water_mass_mask('NADW_climavg.npz')
 
 ### Climatological NADW volume (m^3) and outcrop area (km^2) time series:
-NADW_volume =np.sum( (NADW_clim*e1t*e2t*e3t).reshape(365,-1) ,axis=1)  
-NADW_outcrop=np.sum( (NADW_clim[:,0,:,:]*e1t*e2t).reshape(365,-1),axis=1)/1e6 
+NADW_volume,NADW_outcrop=water_mass_census(TRAJ_CLIM,GRID,NADW,nrecords=365,\
+                                           mask_file='NADW_climavg.npz')
+
+## Per-stage timing, bytes read and memory:
+write_report(REPORT_FILE)
@@ -1,61 +1,35 @@
-import numpy as np
 import netCDF4 as nc
+from grid_metrics import grid_metrics
+from nemo_io import single_precision_reads
+from instrumentation import write_report,report_to
+from water_masses import NASMW,water_mass_census
 
 PATH_TO_MESH_MASK             ='./'
 PATH_TO_SUBBASINS             ='./'
 PATH_TO_TRAJECTORY_CLIMATOLOGY='./'
+REPORT_FILE                   ='climatology_NASMW_properties_report.json' # see instrumentation.py
+SINGLE_PRECISION              =False # Plain float32 reads, see nemo_io.single_precision_reads
 
-MESH     =nc.Dataset(PATH_TO_MESH_MASK+'mesh_mask.nc')
-SUBBASINS=nc.Dataset(PATH_TO_SUBBASINS+'subbasins.nc')
+report_to(REPORT_FILE) # Rewritten as the script runs, so a killed job leaves a report
+GRID     =grid_metrics(PATH_TO_MESH_MASK+'mesh_mask.nc',PATH_TO_SUBBASINS+'subbasins.nc')
 TRAJ_CLIM=nc.Dataset(PATH_TO_TRAJECTORY_CLIMATOLOGY+'TRAJ_CLIMATOLOGY_60y.nc')
-
-# Climatological temperature and salinity
-print('loading trajectory T')
-tn=TRAJ_CLIM.variables['tn'][0:365,:]
-print('loading trajectory S')
-sn=TRAJ_CLIM.variables['sn'][0:365,:]
-
-# Grid info and basin mask
-atlmsk=SUBBASINS.variables['atlmsk'][:]
-atlmsk[SUBBASINS.variables['navlat'][:]<0]=0 #North Atlantic only
-e1t=MESH.variables['e1t'][:]
-e2t=MESH.variables['e2t'][:]
-e3t=MESH.variables['e3t'][:]
-lon=MESH.variables['glamt'][:]
+if SINGLE_PRECISION:
+    single_precision_reads(PATH_TO_MESH_MASK+'mesh_mask.nc')
 
 # Finding NASMW in climatology
 ############################
-#Temperature constraint
-NASMW_t=tn*atlmsk
-NASMW_t[ (tn*atlmsk>19) | (tn*atlmsk<17) ]=100
-NASMW_t[NASMW_t!=100]=1
-NASMW_t[NASMW_t==100]=0
-
-#Salinity constraint
-NASMW_s=sn*atlmsk
-NASMW_s[ (NASMW_s>36.6) | (NASMW_s<36.4) ]=100
-NASMW_s[NASMW_s!=100]=1
-NASMW_s[NASMW_s==100]=0
-
-#Zonal boundary
-NASMW_lon=lon*atlmsk
-NASMW_lon[NASMW_lon<-35]=1000
-NASMW_lon[NASMW_lon!=1000]=0
-NASMW_lon[NASMW_lon==1000]=1
-
-#All water satisfying above 3 constraints:
-NASMW_TSlon=NASMW_t*NASMW_s*NASMW_lon
-
-#Thickness constraint
-NASMW_thck=np.sum(NASMW_TSlon*e3t,axis=1,keepdims=True) #Thickness of mode water
-NASMW_thck[NASMW_thck<125]=0                           #Mask if <125m
-NASMW_thck[NASMW_thck!=0 ]=1                           
-
-# Result:
-NASMW_clim=NASMW_TSlon*NASMW_thck                       #Apply mask to mode water
-
-np.save('NASMW_climavg.npy',NASMW_clim)
+# Temperature constraint (17,19)*C, salinity constraint (36.4,36.6) psu, west
+# of 35W in the North Atlantic, and at least 125m thick in each water column
+# (see water_masses.py). The climatology is classified a few days at a time,
+# and the mask of NASMW locations is saved bit-packed; it can be recovered as
+# a boolean (t,z,y,x) array with:
+# from water_masses import load_water_mass_mask
+# NASMW_clim=load_water_mass_mask('NASMW_climavg.npz')
 
 # Time series of NASMW volume (m^3) and outcrop area (km^2)
-NASMW_volume =np.sum( (NASMW_clim*e1t*e2t*e3t).reshape(365,-1) ,axis=1)  
-NASMW_outcrop=np.sum( (NASMW_clim[:,0,:,:]*e1t*e2t).reshape(365,-1),axis=1)/1e6 
+print('classifying trajectory T and S')
+NASMW_volume,NASMW_outcrop=water_mass_census(TRAJ_CLIM,GRID,NASMW,nrecords=365,\
+                                             mask_file='NASMW_climavg.npz')
+
+## Per-stage timing, bytes read and memory:
+write_report(REPORT_FILE)
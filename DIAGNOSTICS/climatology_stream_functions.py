@@ -1,36 +1,55 @@
-import sys
-import numpy as np
 import netCDF4 as nc
+from grid_metrics import grid_metrics
+from nemo_io import single_precision_reads
+from instrumentation import stage,write_report,report_to
+from results_store import results_key,load_results,store_results
+from stream_functions import climatology_stream_functions
 
 PATH_TO_MESH_MASK             ='./'
 PATH_TO_SUBBASINS             ='./'
 PATH_TO_TRAJECTORY_CLIMATOLOGY='./'
+REPORT_FILE                   ='climatology_stream_functions_report.json' # see instrumentation.py
+USE_RESULTS_STORE             =True # see results_store.py
+SINGLE_PRECISION              =False # Plain float32 reads, see nemo_io.single_precision_reads
 
-MESH     =nc.Dataset(PATH_TO_MESH_MASK+'mesh_mask.nc')
-SUBBASINS=nc.Dataset(PATH_TO_SUBBASINS+'subbasins.nc')
+report_to(REPORT_FILE) # Rewritten as the script runs, so a killed job leaves a report
+GRID     =grid_metrics(PATH_TO_MESH_MASK+'mesh_mask.nc',PATH_TO_SUBBASINS+'subbasins.nc')
 TRAJ_CLIM=nc.Dataset(PATH_TO_TRAJECTORY_CLIMATOLOGY+'TRAJ_CLIMATOLOGY_60y.nc')
-
-print('loading grid data')
-
-e1v=MESH.variables['e1v'][0,:,:]
-e3v=MESH.variables['e3v'][0,:,:,:]
-
-print('loading basin mask')
-atlmsk=SUBBASINS.variables['atlmsk'][:]
-atlmsk[MESH.variables['nav_lat'][:]<0]=0 #North Atlantic only
+if SINGLE_PRECISION:
+    single_precision_reads(PATH_TO_MESH_MASK+'mesh_mask.nc')
 
 ########################################
 ### BAROTROPIC AND MERIDIONAL STREAM FUNCTION CALCULATIONS
-print('getting mean velocity fields')
-print('zonal')
-u_bar=np.mean(TRAJ_CLIM.variables['un'][:],axis=0,keepdims=False) #Annual mean zonal velocity
-print('meridional')
-v_bar=np.mean(TRAJ_CLIM.variables['vn'][:],axis=0,keepdims=False) #Annual mean meridional velocity
-
-print('calculating barotropic stream function')
-
-# Calculate Atlantic barotropic stream function (Sv, integrated from W to E)
-BSFv=np.cumsum(np.sum(e3v[:,:,:]*e1v[:,:]*v_bar[:,:,:]*atlmsk[:,:],axis=0),axis=1)*1e-6
-print('calculating meridional overturning stream function')
-#Calculate Atlantic meridional overturning stream function (Sv):
-MSF=np.cumsum(np.sum(atlmsk*e1v*e3v*v_bar,axis=2),axis=0)*1e-6
+# Annual, monthly and seasonal (DJF,MAM,JJA,SON) means are all calculated in a
+# single pass over the meridional velocity (see stream_functions.py). They are
+# kept in a store, and only recalculated when the climatology or grid changes.
+INPUT_FILES=[PATH_TO_TRAJECTORY_CLIMATOLOGY+'TRAJ_CLIMATOLOGY_60y.nc',\
+             PATH_TO_MESH_MASK+'mesh_mask.nc',PATH_TO_SUBBASINS+'subbasins.nc']
+PARAMETERS ={'diagnostic':'climatology_stream_functions'}
+if SINGLE_PRECISION:
+    PARAMETERS['single_precision']=True
+SF=None
+if USE_RESULTS_STORE:
+    RESULTS_KEY=results_key(INPUT_FILES,PARAMETERS)
+    SF         =load_results(RESULTS_KEY)
+if SF is None:
+    print('getting mean meridional velocity and stream functions')
+    SF=climatology_stream_functions(TRAJ_CLIM,GRID)
+    if USE_RESULTS_STORE:
+        with stage('save'):
+            store_results(RESULTS_KEY,SF,INPUT_FILES,PARAMETERS,'climatology_stream_functions.py')
+
+v_bar=SF['v_bar'] #Annual mean meridional velocity
+
+# Atlantic barotropic stream function (Sv, integrated from W to E)
+BSFv         =SF['BSFv'         ]
+BSFv_monthly =SF['BSFv_monthly' ]
+BSFv_seasonal=SF['BSFv_seasonal']
+
+# Atlantic meridional overturning stream function (Sv):
+MSF          =SF['MSF'          ]
+MSF_monthly  =SF['MSF_monthly'  ]
+MSF_seasonal =SF['MSF_seasonal' ]
+
+## Per-stage timing, bytes read and memory:
+write_report(REPORT_FILE)
@@ -1,6 +1,13 @@
 import sys
 import numpy as np
 import netCDF4 as nc
+from grid_metrics import grid_metrics
+from ts_histogram import ts_bin_indices,ts_histograms
+from nemo_io import read_records,single_precision_reads,prefetch_reads
+from instrumentation import stage,write_report,report_to
+from regrid import remap_weights,regrid
+from results_store import results_key,load_results,store_results
+from sparse_tracer import active_cells,record_sums,active_ts_histogram
 ################################################################################
 #                             DESCRIPTION
 ################################################################################
@@ -14,6 +21,10 @@ tracer_initial_volume
 tracer_ventilation_prdens
        (t,  y,x) : probability density that tracer of age "t" has reached the 
                    surface at location (x,y)
+tracer_ventilation_prdens_regular
+       (t,  Y,X) : the same, conservatively regridded to the regular grid
+                   lat_regular (Y,), lon_regular (X,) (only if
+                   REGRID_RESOLUTION is set)
 tem_bins
        (T,)      : temperature values used to bin surface water tagged by tracer
 sal_bins
@@ -38,43 +49,166 @@ tracer_age_probability
 PATH_TO_OUTPUTS  ='WATER_MASS_OUTPUTS/'
 PATH_TO_MESH_MASK='./'
 
+# With SPARSE=True, only cells where tracer has ventilated are summed and
+# binned (see sparse_tracer.py).
+# Set STREAMING=True to read RECORDS_PER_BLOCK outputs at a time, in reverse
+# (age) order directly from the file, rather than flipping the whole run in
+# memory (see streaming_diagnostics.py). If TARGET_VENTILATED_FRACTION is set,
+# reading stops once that fraction of the tracer has ventilated, and outputs
+# only cover ages up to that point.
+STREAMING                 =False
+RECORDS_PER_BLOCK         =1
+TARGET_VENTILATED_FRACTION=None
+SPARSE                    =True
+# With STREAMING=True, read the next PREFETCH_BLOCKS blocks (of pt_vent_ad, tn
+# and sn) on a background thread while the current block is reduced (see
+# nemo_io.prefetch_reads), so reading and calculation overlap:
+PREFETCH_BLOCKS           =0
+
+# Time, bytes read and peak memory of each stage are written here (see
+# instrumentation.py):
+REPORT_FILE='diagnostics_adjoint_report.json'
+
+# Every quantity above is kept in a store, keyed by the contents of the output
+# and mesh files, the TS bins and TARGET_VENTILATED_FRACTION, and is loaded
+# from there instead of being recalculated until one of them changes (see
+# results_store.py). Set USE_RESULTS_STORE=False to always recalculate.
+USE_RESULTS_STORE=True
+
+# Set SINGLE_PRECISION=True to read the outputs as plain float32 arrays, with
+# land set to zero once from the tmask of mesh_mask.nc, rather than as masked
+# arrays (see nemo_io.single_precision_reads). Results agree with masked reads
+# to float32 rounding (relative difference < 1e-6), except that land cells of
+# spatial fields are 0 rather than masked.
+SINGLE_PRECISION=False
+
+# Set REGRID_RESOLUTION (degrees) to also regrid the probability density
+# conservatively onto a regular latitude-longitude grid, with weights computed
+# once from mesh_mask.nc and cached (see regrid.py).
+REGRID_RESOLUTION=None
+
+# Set TILED=True to calculate the same quantities (as STREAMING does, including
+# TARGET_VENTILATED_FRACTION) directly from the per-processor
+# PTTAM_output_????????_????.nc files in PATH_TO_TILES, one tile per worker
+# process, without rebuild_nemo or ncrcat (see tile_diagnostics.py).
+TILED        =False
+PATH_TO_TILES='[PATH TO PTTAM OUTPUT TILES]/'
+
+report_to(REPORT_FILE) # Rewritten as the script runs, so a killed job leaves a report
+
 ## TAM output:
-OUTPUT_NC=nc.Dataset(PATH_TO_OUTPUTS+'WATER_MASS_adj_output.nc') # output file 
+if TILED:
+    from tile_diagnostics import tile_files
+    TILE_FILES=tile_files(PATH_TO_TILES)
+else:
+    OUTPUT_NC=nc.Dataset(PATH_TO_OUTPUTS+'WATER_MASS_adj_output.nc') # output file 
+
+## Grid data (cached, see grid_metrics.py):
+GRID=grid_metrics(PATH_TO_MESH_MASK+'mesh_mask.nc')
+if SINGLE_PRECISION:
+    single_precision_reads(PATH_TO_MESH_MASK+'mesh_mask.nc')
+prefetch_reads(PREFETCH_BLOCKS)
 
-tracer_vol =np.flip(OUTPUT_NC.variables['pt_vol_ad' ][:],0) # Passive tracer concentration
-tracer_vent=np.flip(OUTPUT_NC.variables['pt_vent_ad'][:],0) # Tracer ventilation volume
-traj_sst   =np.flip(OUTPUT_NC.variables['tn'        ][:,0,:,:],0) # Trajectory SST
-traj_sss   =np.flip(OUTPUT_NC.variables['sn'        ][:,0,:,:],0) # Trajectory SSS
+## TS bins:
+tem_bins=np.linspace(- 2  , 5  ,29)
+sal_bins=np.linspace( 34.5,35.5,21)
 
-## Grid data:
-MESH=nc.Dataset(PATH_TO_MESH_MASK+'mesh_mask.nc')
-e1t=MESH.variables['e1t'  ][:]
-e2t=MESH.variables['e2t'  ][:]
+## Stored results (see results_store.py):
+INPUT_FILES=[PATH_TO_OUTPUTS+'WATER_MASS_adj_output.nc',PATH_TO_MESH_MASK+'mesh_mask.nc']
+if TILED:
+    INPUT_FILES=sum(TILE_FILES.values(),[])+INPUT_FILES[1:]
+PARAMETERS ={'diagnostic':'adjoint','tem_bins':tem_bins,'sal_bins':sal_bins,\
+             'target_ventilated_fraction':TARGET_VENTILATED_FRACTION if STREAMING or TILED\
+                                          else None}
+if SINGLE_PRECISION:
+    PARAMETERS['single_precision']=True
+STORED     =None
+if USE_RESULTS_STORE:
+    RESULTS_KEY=results_key(INPUT_FILES,PARAMETERS)
+    STORED     =load_results(RESULTS_KEY)
 
 ################################################################################
 #                            DIAGNOSTICS
 ################################################################################
-noutputs=tracer_vol.shape[0]
 
-# VENTILATION LOCATION PROBABILITY DENSITY:
-tracer_initial_volume     = np.sum(tracer_vol[0,:])
-tracer_ventilation_prdens = tracer_vent/(tracer_initial_volume*(e1t*e2t))
+if STORED is not None or STREAMING or TILED:
+    if STORED is not None:
+        AD=STORED
+    elif TILED:
+        from tile_diagnostics import adjoint_tiles
+        AD=adjoint_tiles(PATH_TO_TILES,PATH_TO_MESH_MASK+'mesh_mask.nc',tem_bins,sal_bins,\
+                         TARGET_VENTILATED_FRACTION)
+    else:
+        from streaming_diagnostics import adjoint_streaming
+        AD=adjoint_streaming(OUTPUT_NC,GRID,tem_bins,sal_bins,RECORDS_PER_BLOCK,\
+                             TARGET_VENTILATED_FRACTION,SPARSE)
+    tracer_initial_volume     =AD['tracer_initial_volume'     ]
+    tracer_ventilation_prdens =AD['tracer_ventilation_prdens' ]
+    tracer_TS_volume_histogram=AD['tracer_TS_volume_histogram']
+    tracer_age_probability    =AD['tracer_age_probability'    ]
+else:
+    with stage('load'):
+        # Passive tracer concentration, tracer ventilation volume, trajectory SST and SSS:
+        tracer_vol =np.flip(read_records( OUTPUT_NC.variables['pt_vol_ad' ]       ),0)
+        tracer_vent=np.flip(read_records( OUTPUT_NC.variables['pt_vent_ad']       ),0)
+        traj_sst   =np.flip(read_records((OUTPUT_NC.variables['tn'        ],(0,))),0)
+        traj_sss   =np.flip(read_records((OUTPUT_NC.variables['sn'        ],(0,))),0)
 
-# VENTILATION TS PROBABILITY DENSITY:
-## Initialise histogram
-tem_bins=np.linspace(- 2  , 5  ,29)
-sal_bins=np.linspace( 34.5,35.5,21)
-tracer_TS_volume_histogram=np.zeros((noutputs,len(tem_bins)-1,len(sal_bins)-1))
-## Populate histogram
-for ii in np.arange(noutputs):
-    tracer_TS_volume_histogram[ii,:,:],_,_=\
-                    np.histogram2d(traj_sst[ii,:].flatten(),\
-                                   traj_sss[ii,:].flatten(),\
-                                   [tem_bins,sal_bins],\
-                                   weights=tracer_vent[ii,:].flatten())
+    ## Grid data:
+    e1t=GRID['e1t'  ]
+    e2t=GRID['e2t'  ]
+
+    noutputs=tracer_vol.shape[0]
+
+    # VENTILATION LOCATION PROBABILITY DENSITY:
+    with stage('ventilation'):
+        tracer_initial_volume     = np.sum(tracer_vol[0,:],dtype=np.float64)
+        if SPARSE:
+            ## Only cells where tracer has ventilated are used (see sparse_tracer.py):
+            record,index,vent_values=active_cells(tracer_vent)
+            prdens=np.zeros((noutputs,np.size(e1t)))
+            prdens[record,index]=vent_values/(tracer_initial_volume*(e1t*e2t).reshape(-1)[index])
+            tracer_ventilation_prdens = np.ma.masked_array(prdens.reshape(np.shape(tracer_vent)),\
+                                                           np.ma.getmaskarray(tracer_vent))
+        else:
+            tracer_ventilation_prdens = tracer_vent/(tracer_initial_volume*(e1t*e2t))
+
+    # VENTILATION TS PROBABILITY DENSITY:
+    with stage('histogram'):
+        if SPARSE:
+            ## Bin trajectory SST and SSS of the ventilating cells only
+            tracer_TS_volume_histogram=active_ts_histogram(record,index,vent_values,\
+                                                           traj_sst,traj_sss,tem_bins,sal_bins)
+        else:
+            ## Bin trajectory SST and SSS, then populate histogram for all outputs at once
+            TS_bin_indices=ts_bin_indices(traj_sst,traj_sss,tem_bins,sal_bins)
+            tracer_TS_volume_histogram,=ts_histograms(TS_bin_indices,[tracer_vent],\
+                                                      tem_bins,sal_bins)
+
+    # TRACER AGE PROBABILITY DISTRIBUTION
+    with stage('age'):
+        if SPARSE:
+            tracer_age_probability=record_sums(record,vent_values,noutputs)/tracer_initial_volume
+        else:
+            tracer_age_probability=np.sum(tracer_vent.reshape(noutputs,-1),axis=1,\
+                                          dtype=np.float64)/tracer_initial_volume
 
-# TRACER AGE PROBABILITY DISTRIBUTION
-tracer_age_probability=np.sum(tracer_vent.reshape(noutputs,-1),axis=1)\
-                        /tracer_initial_volume
+if USE_RESULTS_STORE and STORED is None:
+    with stage('save'):
+        store_results(RESULTS_KEY,{'tracer_initial_volume'     :tracer_initial_volume,
+                                   'tracer_ventilation_prdens' :tracer_ventilation_prdens,
+                                   'tem_bins'                  :tem_bins,
+                                   'sal_bins'                  :sal_bins,
+                                   'tracer_TS_volume_histogram':tracer_TS_volume_histogram,
+                                   'tracer_age_probability'    :tracer_age_probability},\
+                      INPUT_FILES,PARAMETERS,'diagnostics_adjoint.py')
 
+## Probability density on a regular lat-lon grid (see regrid.py):
+if REGRID_RESOLUTION is not None:
+    with stage('regrid'):
+        REMAP=remap_weights(PATH_TO_MESH_MASK+'mesh_mask.nc',REGRID_RESOLUTION)
+        lat_regular,lon_regular=REMAP['lat'],REMAP['lon']
+        tracer_ventilation_prdens_regular=regrid(REMAP,tracer_ventilation_prdens)
 
+## Per-stage timing, bytes read and memory:
+write_report(REPORT_FILE)
@@ -1,6 +1,15 @@
 import sys
 import numpy as np
 import netCDF4 as nc
+from grid_metrics import grid_metrics
+from ts_histogram import ts_bin_indices,ts_histograms
+from nemo_io import read_records,read_precision,single_precision_reads,prefetch_reads
+from instrumentation import stage,write_report,report_to
+from regrid import remap_weights,regrid
+from results_store import results_key,load_results,store_results
+from streaming_diagnostics import unit_positions,lateral_spread,active_lateral_spread,\
+                                  vertical_spread
+from sparse_tracer import active_cells,record_sums,scatter_sums,active_ts_histogram
 ################################################################################
 #                             DESCRIPTION
 ################################################################################
@@ -18,12 +27,22 @@ tracer_total_volume
 tracer_depth_integrated_prdens
        (t,  y,x) : Time-evolving probability density (/m^2) that tracer is
                    found at a given location
+tracer_depth_integrated_prdens_regular
+       (t,  Y,X) : the same, conservatively regridded to the regular grid
+                   lat_regular (Y,), lon_regular (X,) (only if
+                   REGRID_RESOLUTION is set)
 lat_bar         
        (t,)      : time series of tracer weighted centre of mass latitude
 lon_bar         
        (t,)      : time series of tracer weighted centre of mass longitude
 dep_bar         
        (t,)      : time series of tracer weighted centre of mass depth
+lateral_STD
+       (t,)      : time series of tracer weighted RMS great-circle distance
+                   (km) from the centre of mass
+vertical_STD
+       (t,)      : time series of tracer weighted RMS distance in depth (m)
+                   from the centre of mass
 tem_bins
        (T,)      : temperature values used to bin water tagged by tracer
 sal_bins
@@ -45,72 +64,224 @@ tracer_TS_volume_histogram
 PATH_TO_OUTPUTS  ='WATER_MASS_OUTPUTS/'
 PATH_TO_MESH_MASK='./'
 
+# With SPARSE=True, only cells where the tracer is non-zero are multiplied,
+# summed and binned (see sparse_tracer.py), so the cost scales with the size of
+# the tracer patch rather than of the grid.
+# Set STREAMING=True to read RECORDS_PER_BLOCK outputs at a time rather than
+# the whole run (see streaming_diagnostics.py). Peak memory is then independent
+# of the number of outputs, and every quantity above is calculated except the
+# full (t,z,y,x) tracer_volume.
+STREAMING        =False
+RECORDS_PER_BLOCK=1
+SPARSE           =True
+# With STREAMING=True, read the next PREFETCH_BLOCKS blocks (of pt_conc_tl, tn
+# and sn) on a background thread while the current block is reduced (see
+# nemo_io.prefetch_reads), so reading and calculation overlap:
+PREFETCH_BLOCKS  =0
+
+# Time, bytes read and peak memory of each stage are written here (see
+# instrumentation.py):
+REPORT_FILE='diagnostics_tangent_linear_report.json'
+
+# Every quantity above except tracer_volume is kept in a store, keyed by the
+# contents of the output and mesh files and by the TS bins, and is loaded from
+# there instead of being recalculated until one of them changes (see
+# results_store.py). Set USE_RESULTS_STORE=False to always recalculate.
+USE_RESULTS_STORE=True
+
+# Set SINGLE_PRECISION=True to read the outputs as plain float32 arrays, with
+# land set to zero once from the tmask of mesh_mask.nc, rather than as masked
+# arrays (see nemo_io.single_precision_reads). Results agree with masked reads
+# to float32 rounding (relative difference < 1e-6), except that land cells of
+# spatial fields are 0 rather than masked.
+SINGLE_PRECISION=False
+
+# Set REGRID_RESOLUTION (degrees) to also regrid the probability density
+# conservatively onto a regular latitude-longitude grid, with weights computed
+# once from mesh_mask.nc and cached (see regrid.py).
+REGRID_RESOLUTION=None
+
+# Set TILED=True to calculate the same quantities (as STREAMING does) directly
+# from the per-processor PTTAM_output_????????_????.nc files in PATH_TO_TILES,
+# one tile per worker process, without rebuild_nemo or ncrcat (see
+# tile_diagnostics.py).
+TILED        =False
+PATH_TO_TILES='[PATH TO PTTAM OUTPUT TILES]/'
+
+report_to(REPORT_FILE) # Rewritten as the script runs, so a killed job leaves a report
+
 ## TAM output:
-OUTPUT_NC=nc.Dataset(PATH_TO_OUTPUTS+'WATER_MASS_tan_output.nc')
+if TILED:
+    from tile_diagnostics import tile_files
+    TILE_FILES=tile_files(PATH_TO_TILES)
+else:
+    OUTPUT_NC=nc.Dataset(PATH_TO_OUTPUTS+'WATER_MASS_tan_output.nc')
+
+## Grid data (cached, see grid_metrics.py):
+GRID=grid_metrics(PATH_TO_MESH_MASK+'mesh_mask.nc')
+if SINGLE_PRECISION:
+    single_precision_reads(PATH_TO_MESH_MASK+'mesh_mask.nc')
+prefetch_reads(PREFETCH_BLOCKS)
 
-tracer_conc=OUTPUT_NC.variables['pt_conc_tl'][:] # Passive tracer concentration
-traj_tn   =OUTPUT_NC.variables['tn'        ][:] # Trajectory temperature
-traj_sn    =OUTPUT_NC.variables['sn'        ][:] # Trajectory salinity
+## TS bins:
+tem_bins=np.linspace(- 2  , 5  ,29)
+sal_bins=np.linspace( 34.5,35.5,21)
 
-## Grid data:
-MESH=nc.Dataset(PATH_TO_MESH_MASK+'mesh_mask.nc')
-e1t=MESH.variables['e1t'  ][:]
-e2t=MESH.variables['e2t'  ][:]
-e3t=MESH.variables['e3t'  ][:]
-lat=MESH.variables['gphit'][0,:]
-lon=MESH.variables['glamt'][0,:]
-dep=np.cumsum(e3t[0,:],axis=0)
+## Stored results (see results_store.py):
+INPUT_FILES=[PATH_TO_OUTPUTS+'WATER_MASS_tan_output.nc',PATH_TO_MESH_MASK+'mesh_mask.nc']
+if TILED:
+    INPUT_FILES=sum(TILE_FILES.values(),[])+INPUT_FILES[1:]
+PARAMETERS ={'diagnostic':'tangent_linear','tem_bins':tem_bins,'sal_bins':sal_bins}
+if SINGLE_PRECISION:
+    PARAMETERS['single_precision']=True
+STORED     =None
+if USE_RESULTS_STORE:
+    RESULTS_KEY=results_key(INPUT_FILES,PARAMETERS)
+    STORED     =load_results(RESULTS_KEY,names=['lateral_STD','vertical_STD'])
 
 ################################################################################
 #                              DIAGNOSTICS
 ################################################################################
 
-# DEPTH-INTEGRATED PROBABILITY DENSITY
-noutputs=np.shape(tracer_conc)[0] #number of outputs
-tracer_volume                 =tracer_conc*(e1t*e2t*e3t)    #Volume in each grid cell
-tracer_depth_integrated_volume=np.sum(tracer_volume,axis=1) #Depth-integrated volume
-tracer_initial_volume         =np.sum(tracer_volume[0,:])   #Injected tracer volume
-tracer_total_volume           =np.sum( (tracer_volume).reshape(noutputs,-1) ,axis=1)
-tracer_depth_integrated_prdens=(tracer_depth_integrated_volume/tracer_initial_volume)\
-                             /(e1t*e2t)
-
-# TRACER CENTRE OF MASS:
-## Get mean lat and lon:
-### Project grid to Cartesian coordinates using inverse spherical projection:
-R_earth=6371e3
-X=R_earth*np.sin(np.deg2rad(lat+90))*np.cos(np.deg2rad(lon+180))
-Y=R_earth*np.sin(np.deg2rad(lat+90))*np.sin(np.deg2rad(lon+180))
-Z=R_earth*np.cos(np.deg2rad(lat+90))
-
-### Mean position in cartesian coordinates = sum(volume*{X,Y,Z})/sum(volume)
-X_bar=np.sum( (X*tracer_depth_integrated_volume).reshape(noutputs,-1),axis=1)\
-       /tracer_total_volume
-Y_bar=np.sum( (Y*tracer_depth_integrated_volume).reshape(noutputs,-1),axis=1)\
-       /tracer_total_volume
-Z_bar=np.sum( (Z*tracer_depth_integrated_volume).reshape(noutputs,-1),axis=1)\
-       /tracer_total_volume
-
-### Project mean position back to spherical coordinates and get lat,lon:
-lat_bar  =(np.rad2deg(np.arccos(Z_bar/np.sqrt(X_bar**2 + Y_bar**2 + Z_bar**2)))-90)
-lon_bar  =(np.rad2deg(np.arctan2(Y_bar,X_bar))-180)
-
-## Get mean depth:
-### Mean depth = sum(volume * depth)/sum(volume)
-dep_bar = np.sum( (tracer_volume*dep).reshape(noutputs,-1),axis=1 )\
-          /tracer_total_volume
-
-
-# TS PROPERTIES OF WATER OCCUPIED BY TRACER:
-## Initialise histogram
-tem_bins=np.linspace(- 2  , 5  ,29)
-sal_bins=np.linspace( 34.5,35.5,21)
-tracer_TS_volume_histogram=np.zeros((noutputs,len(tem_bins)-1,len(sal_bins)-1))
-
-## Populate histogram
-for ii in np.arange(noutputs):
-    tracer_TS_volume_histogram[ii,:,:],_,_=\
-                    np.histogram2d(traj_tn[ii,:].flatten(),\
-                                   traj_sn[ii,:].flatten(),\
-                                   [tem_bins,sal_bins],\
-                                   weights=tracer_volume[ii,:].flatten())
-                          
+if STORED is not None or STREAMING or TILED:
+    if STORED is not None:
+        TL=STORED
+    elif TILED:
+        from tile_diagnostics import tangent_linear_tiles
+        TL=tangent_linear_tiles(PATH_TO_TILES,PATH_TO_MESH_MASK+'mesh_mask.nc',tem_bins,sal_bins)
+    else:
+        from streaming_diagnostics import tangent_linear_streaming
+        TL=tangent_linear_streaming(OUTPUT_NC,GRID,tem_bins,sal_bins,RECORDS_PER_BLOCK,SPARSE)
+    tracer_depth_integrated_volume=TL['tracer_depth_integrated_volume']
+    tracer_initial_volume         =TL['tracer_initial_volume'         ]
+    tracer_total_volume           =TL['tracer_total_volume'           ]
+    tracer_depth_integrated_prdens=TL['tracer_depth_integrated_prdens']
+    lat_bar                       =TL['lat_bar'                       ]
+    lon_bar                       =TL['lon_bar'                       ]
+    dep_bar                       =TL['dep_bar'                       ]
+    lateral_STD                   =TL['lateral_STD'                   ]
+    vertical_STD                  =TL['vertical_STD'                  ]
+    tracer_TS_volume_histogram    =TL['tracer_TS_volume_histogram'    ]
+else:
+    with stage('load'):
+        tracer_conc=read_records(OUTPUT_NC.variables['pt_conc_tl']) # Passive tracer concentration
+        traj_tn    =read_records(OUTPUT_NC.variables['tn'        ]) # Trajectory temperature
+        traj_sn    =read_records(OUTPUT_NC.variables['sn'        ]) # Trajectory salinity
+
+    ## Grid data:
+    e1t=GRID['e1t'  ]
+    e2t=GRID['e2t'  ]
+    lat=GRID['gphit'][0,:]
+    lon=GRID['glamt'][0,:]
+    # In the precision of the reads, so that full-size products stay float32
+    # with SINGLE_PRECISION (sums are taken in float64):
+    cell_volume=read_precision(GRID['cell_volume'])
+    dep        =read_precision(GRID['dep'        ])
+
+    # DEPTH-INTEGRATED PROBABILITY DENSITY
+    with stage('volume'):
+        noutputs=np.shape(tracer_conc)[0] #number of outputs
+        nz      =np.shape(dep)[0]         #number of levels
+        if SPARSE:
+            ## Only the non-zero cells of the run are multiplied and summed (see sparse_tracer.py):
+            record,index,conc_values=active_cells(tracer_conc)
+            volume=conc_values*cell_volume.reshape(-1)[index]
+            column=index%np.size(lat)
+            tracer_volume                 =np.ma.masked_array(np.zeros(np.shape(tracer_conc),\
+                                                                       dtype=volume.dtype),\
+                                                              np.ma.getmask(tracer_conc))
+            np.ma.getdata(tracer_volume).reshape(noutputs,-1)[record,index]=volume
+            tracer_depth_integrated_volume=np.ma.masked_array(\
+                    scatter_sums(record,column,volume,noutputs,np.size(lat)).reshape(\
+                    (noutputs,)+np.shape(lat)),np.ma.getmaskarray(tracer_conc).all(axis=1))
+            tracer_initial_volume         =np.sum(volume[record==0],dtype=np.float64)
+            tracer_total_volume           =record_sums(record,volume,noutputs)
+        else:
+            tracer_volume                 =tracer_conc*cell_volume      #Volume in each grid cell
+            tracer_depth_integrated_volume=np.sum(tracer_volume,axis=1,\
+                                                  dtype=np.float64) #Depth-integrated volume
+            tracer_initial_volume         =np.sum(tracer_volume[0,:],\
+                                                  dtype=np.float64) #Injected tracer volume
+            tracer_total_volume           =np.sum( (tracer_volume).reshape(noutputs,-1) ,axis=1,\
+                                                  dtype=np.float64)
+        tracer_depth_integrated_prdens=(tracer_depth_integrated_volume/tracer_initial_volume)\
+                                     /(e1t*e2t)
+
+    # TRACER CENTRE OF MASS:
+    with stage('centre of mass'):
+        ## Get mean lat and lon:
+        ### Grid in Cartesian coordinates (inverse spherical projection, see grid_metrics.py):
+        X,Y,Z=GRID['X'],GRID['Y'],GRID['Z']
+
+        ### Mean position in cartesian coordinates = sum(volume*{X,Y,Z})/sum(volume)
+        X_bar=np.sum( (X*tracer_depth_integrated_volume).reshape(noutputs,-1),axis=1)\
+               /tracer_total_volume
+        Y_bar=np.sum( (Y*tracer_depth_integrated_volume).reshape(noutputs,-1),axis=1)\
+               /tracer_total_volume
+        Z_bar=np.sum( (Z*tracer_depth_integrated_volume).reshape(noutputs,-1),axis=1)\
+               /tracer_total_volume
+
+        ### Project mean position back to spherical coordinates and get lat,lon:
+        lat_bar  =(np.rad2deg(np.arccos(Z_bar/np.sqrt(X_bar**2 + Y_bar**2 + Z_bar**2)))-90)
+        lon_bar  =(np.rad2deg(np.arctan2(Y_bar,X_bar))-180)
+
+        ## Get mean depth:
+        ### Mean depth = sum(volume * depth)/sum(volume)
+        if SPARSE:
+            dep_bar = record_sums(record,dep.reshape(-1)[index]*volume,noutputs)\
+                      /tracer_total_volume
+        else:
+            dep_bar = np.sum( (tracer_volume*dep).reshape(noutputs,-1),axis=1,dtype=np.float64 )\
+                      /tracer_total_volume
+
+    # TRACER LATERAL AND VERTICAL STANDARD DEVIATION:
+    with stage('spread'):
+        ## Great-circle distances from the centre of mass (see streaming_diagnostics.py):
+        unit  =unit_positions(X,Y,Z)
+        centre=np.stack([X_bar,Y_bar,Z_bar],axis=1)
+        if SPARSE:
+            lateral_STD =active_lateral_spread(unit,record,column,volume,centre,tracer_total_volume)
+            level_volume=scatter_sums(record,index//np.size(lat),volume,noutputs,nz)
+        else:
+            lateral_STD =lateral_spread(unit,tracer_depth_integrated_volume,centre,\
+                                        tracer_total_volume)
+            level_volume=np.sum(tracer_volume.reshape(noutputs,nz,-1),axis=2,dtype=np.float64)
+        vertical_STD=vertical_spread(GRID['gdept_0'][0,:],dep_bar,level_volume,tracer_total_volume)
+
+    # TS PROPERTIES OF WATER OCCUPIED BY TRACER:
+    with stage('histogram'):
+        if SPARSE:
+            ## Bin trajectory T and S of the non-zero cells only
+            tracer_TS_volume_histogram=active_ts_histogram(record,index,volume,traj_tn,traj_sn,\
+                                                           tem_bins,sal_bins)
+        else:
+            ## Bin trajectory T and S, then populate histogram for all outputs at once
+            TS_bin_indices=ts_bin_indices(traj_tn,traj_sn,tem_bins,sal_bins)
+            tracer_TS_volume_histogram,=ts_histograms(TS_bin_indices,[tracer_volume],\
+                                                      tem_bins,sal_bins)
+
+if USE_RESULTS_STORE and STORED is None:
+    with stage('save'):
+        store_results(RESULTS_KEY,{'tracer_depth_integrated_volume':tracer_depth_integrated_volume,
+                                   'tracer_initial_volume'         :tracer_initial_volume,
+                                   'tracer_total_volume'           :tracer_total_volume,
+                                   'tracer_depth_integrated_prdens':tracer_depth_integrated_prdens,
+                                   'lat_bar'                       :lat_bar,
+                                   'lon_bar'                       :lon_bar,
+                                   'dep_bar'                       :dep_bar,
+                                   'lateral_STD'                   :lateral_STD,
+                                   'vertical_STD'                  :vertical_STD,
+                                   'tem_bins'                      :tem_bins,
+                                   'sal_bins'                      :sal_bins,
+                                   'tracer_TS_volume_histogram'    :tracer_TS_volume_histogram},\
+                      INPUT_FILES,PARAMETERS,'diagnostics_tangent_linear.py')
+
+## Probability density on a regular lat-lon grid (see regrid.py):
+if REGRID_RESOLUTION is not None:
+    with stage('regrid'):
+        REMAP=remap_weights(PATH_TO_MESH_MASK+'mesh_mask.nc',REGRID_RESOLUTION)
+        lat_regular,lon_regular=REMAP['lat'],REMAP['lon']
+        tracer_depth_integrated_prdens_regular=regrid(REMAP,tracer_depth_integrated_prdens)
+
+## Per-stage timing, bytes read and memory:
+write_report(REPORT_FILE)
@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+import numpy as np
+import netCDF4 as nc
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Persistent cache of the grid metrics used by the diagnostics. The fields below
+are read from mesh_mask.nc (and subbasins.nc) and derived once, then saved as
+.npy files in a directory named after a hash of the mesh (and basin) file
+contents. Later calls memory-map the saved arrays, which is almost instant and
+lets concurrent jobs share the same pages. Editing or replacing either file
+changes the hash, so a stale cache is never used. The hash of each file is
+remembered (in GRID_METRICS_CACHE/file_hashes.json) for as long as its size
+and modification time are unchanged, so the files are only read in full when
+they change (see remembered_file_hash).
+
+grid_metrics(mesh_file,subbasins_file=None,cache_dir=GRID_METRICS_CACHE)
+       dictionary of (read-only) arrays:
+       e1t,e2t,e3t,e1v,e3v,gphit,glamt,gdept_0,tmask,nav_lat
+                   : as in mesh_mask.nc (if present there)
+       cell_area   : (1,  y,x) e1t*e2t
+       cell_volume : (1,z,y,x) e1t*e2t*e3t
+       dep         : (  z,y,x) depth of bottom of each cell, cumsum(e3t)
+       X,Y,Z       : (    y,x) Cartesian position of T points (m)
+       atlmsk      : (    y,x) Atlantic basin mask   } only if subbasins_file
+       atlmsk_NA   : (    y,x) North Atlantic only   } is given
+remembered_file_hash(filename,index_dir)
+       SHA-1 (hex digest) of a file's contents, remembered in
+       index_dir/file_hashes.json while its size and mtime are unchanged
+'''
+
+GRID_METRICS_CACHE='./GRID_METRICS_CACHE/'
+R_earth=6371e3
+
+MESH_VARIABLES=['e1t','e2t','e3t','e1v','e3v','gphit','glamt','gdept_0','tmask','nav_lat']
+
+def file_hash(filename,hasher=None,chunk_size=2**24):
+    '''Hash of a file's contents'''
+    hasher=hasher or hashlib.sha1()
+    with open(filename,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size),b''):
+            hasher.update(chunk)
+    return hasher
+
+def remembered_file_hash(filename,index_dir):
+    '''Hash of a file's contents, remembered while its size and mtime are unchanged'''
+    index_file=os.path.join(index_dir,'file_hashes.json')
+    HASHES={}
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            HASHES=json.load(f)
+    path=os.path.abspath(filename)
+    stat=os.stat(path)
+    ENTRY=HASHES.get(path)
+    if ENTRY is None or ENTRY['size']!=stat.st_size or ENTRY['mtime_ns']!=stat.st_mtime_ns:
+        ENTRY={'size':stat.st_size,'mtime_ns':stat.st_mtime_ns,\
+               'sha1':file_hash(path).hexdigest()}
+        HASHES[path]=ENTRY
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        tmp_file=index_file+'.tmp%d'%os.getpid()
+        with open(tmp_file,'w') as f:
+            json.dump(HASHES,f,indent=1)
+        os.replace(tmp_file,index_file)
+    return ENTRY['sha1']
+
+def cartesian_projection(lat,lon):
+    '''Project grid to Cartesian coordinates using inverse spherical projection'''
+    X=R_earth*np.sin(np.deg2rad(lat+90))*np.cos(np.deg2rad(lon+180))
+    Y=R_earth*np.sin(np.deg2rad(lat+90))*np.sin(np.deg2rad(lon+180))
+    Z=R_earth*np.cos(np.deg2rad(lat+90))
+    return X,Y,Z
+
+def compute_grid_metrics(mesh_file,subbasins_file=None):
+    '''Read and derive the grid metrics (no caching)'''
+    MESH=nc.Dataset(mesh_file)
+    GRID=dict((name,np.ma.getdata(MESH.variables[name][:]))\
+              for name in MESH_VARIABLES if name in MESH.variables)
+    MESH.close()
+
+    lat=GRID['gphit'][0,:]
+    lon=GRID['glamt'][0,:]
+    GRID['cell_area'  ]=GRID['e1t']*GRID['e2t']
+    GRID['cell_volume']=GRID['e1t']*GRID['e2t']*GRID['e3t']
+    GRID['dep'        ]=np.cumsum(GRID['e3t'][0,:],axis=0)
+    GRID['X'],GRID['Y'],GRID['Z']=cartesian_projection(lat,lon)
+
+    if subbasins_file is not None:
+        SUBBASINS=nc.Dataset(subbasins_file)
+        GRID['atlmsk']=np.ma.getdata(SUBBASINS.variables['atlmsk'][:])
+        SUBBASINS.close()
+        GRID['atlmsk_NA']=GRID['atlmsk'].copy()
+        GRID['atlmsk_NA'][lat<0]=0 #North Atlantic only
+    return GRID
+
+def grid_metrics(mesh_file,subbasins_file=None,cache_dir=GRID_METRICS_CACHE):
+    '''Grid metrics, memory-mapped from cache_dir (computed on first use)'''
+    key=remembered_file_hash(mesh_file,cache_dir)
+    if subbasins_file is not None:
+        key=hashlib.sha1((key+remembered_file_hash(subbasins_file,cache_dir)).encode()).hexdigest()
+    key_dir=os.path.join(cache_dir,key)
+
+    if not os.path.isdir(key_dir):
+        GRID=compute_grid_metrics(mesh_file,subbasins_file)
+        # Write to a private directory first, so that concurrent jobs never
+        # see a partially written cache
+        tmp_dir=key_dir+'.tmp%d'%os.getpid()
+        os.makedirs(tmp_dir)
+        for name,value in GRID.items():
+            np.save(os.path.join(tmp_dir,name+'.npy'),value)
+        try:
+            os.rename(tmp_dir,key_dir)
+        except OSError: # Another job got there first
+            for name in GRID:
+                os.remove(os.path.join(tmp_dir,name+'.npy'))
+            os.rmdir(tmp_dir)
+
+    return dict((name[:-4],np.load(os.path.join(key_dir,name),mmap_mode='r'))\
+                for name in os.listdir(key_dir) if name.endswith('.npy'))
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import resource
+from contextlib import contextmanager
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Per-stage instrumentation shared by the diagnostics. Each named stage (e.g.
+'load', 'volume', 'centre of mass', 'histogram', 'save') records:
+calls                : number of times the stage was entered
+wall_time            : total wall time spent in the stage (s)
+bytes_read           : {variable name: bytes} read from netCDF files in the
+                       stage (counted by nemo_io.read_records)
+peak_rss_MB          : peak resident memory of the process when the stage
+                       last finished
+peak_rss_increase_MB : how much the stage raised the process' peak resident
+                       memory, i.e. which stages are responsible for the peak
+Stages may be nested, and are then named 'outer/inner'. Entering a stage
+costs a few microseconds, so instrumentation is always on; the report is
+only written if a script asks for it.
+
+report_to(filename,interval)
+       keep filename up to date with report() while the script runs: it is
+       rewritten as each outermost stage finishes (at most every interval
+       seconds), at exit and on SIGTERM (as sent at a job's wall-time limit),
+       so that a job which is killed or runs out of memory still leaves a
+       report of the stages it got through
+stage(name)
+       context manager timing a named stage
+count_read(name,data)
+       add the size of an array read from variable name to the current stage
+report()
+       dictionary of the stages so far, with total wall time and peak memory
+write_report(filename)
+       write report() as JSON (replacing filename only once it is written)
+worker_stages(), merge_stages(stages)
+       return (and reset) the stages recorded in a worker process, and add
+       them to the report of the parent process (under 'workers/')
+'''
+
+# Stage timer (time.perf_counter is python 3 only, and this module is also
+# imported by rearrange_climatology_for_rebuild_nemo.py under python 2.7):
+_CLOCK =getattr(time,'perf_counter',time.time)
+STAGES ={}
+_ACTIVE=[]          # Names of the stages currently entered, outermost first
+_START =time.time()
+# File kept up to date by report_to, the process writing it, and when it last did:
+_REPORT={'filename':None,'pid':None,'interval':10.,'written':0.}
+
+def peak_rss_MB():
+    '''Peak resident memory of this process (MB)'''
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024.**2 if sys.platform=='darwin' else peak/1024. # bytes on macOS, kB on Linux
+
+def _stage_record(name):
+    if name not in STAGES:
+        STAGES[name]={'calls':0,'wall_time':0.,'bytes_read':{},\
+                      'peak_rss_MB':0.,'peak_rss_increase_MB':0.}
+    return STAGES[name]
+
+@contextmanager
+def stage(name):
+    '''Time a named stage (nested in any stage already entered)'''
+    _ACTIVE.append(name)
+    RECORD=_stage_record('/'.join(_ACTIVE))
+    peak_before=peak_rss_MB()
+    t0=_CLOCK()
+    try:
+        yield RECORD
+    finally:
+        RECORD['wall_time']+=_CLOCK()-t0
+        RECORD['calls'    ]+=1
+        RECORD['peak_rss_MB']=peak_rss_MB()
+        RECORD['peak_rss_increase_MB']+=RECORD['peak_rss_MB']-peak_before
+        _ACTIVE.pop()
+        if not _ACTIVE and time.time()-_REPORT['written']>=_REPORT['interval']:
+            _flush_report()
+
+def count_read(name,data):
+    '''Add the bytes of data (read from variable name) to the current stage'''
+    RECORD=_stage_record('/'.join(_ACTIVE) or 'unstaged')
+    nbytes=getattr(getattr(data,'data',data),'nbytes',0) # Data only, not masks
+    RECORD['bytes_read'][name]=RECORD['bytes_read'].get(name,0)+nbytes
+
+def report():
+    return {'script'     :os.path.basename(sys.argv[0]),
+            'wall_time'  :time.time()-_START,
+            'peak_rss_MB':peak_rss_MB(),
+            'bytes_read' :sum(sum(RECORD['bytes_read'].values()) for RECORD in STAGES.values()),
+            'stages'     :STAGES}
+
+def write_report(filename):
+    tmp_file=filename+'.tmp%d'%os.getpid()
+    with open(tmp_file,'w') as f:
+        json.dump(report(),f,indent=1)
+    os.rename(tmp_file,filename) # Atomic on POSIX (os.replace is python 3 only)
+
+def _flush_report():
+    '''Rewrite the report_to file (only from the process that asked for it,
+    not from worker processes forked from it)'''
+    if _REPORT['filename'] is not None and os.getpid()==_REPORT['pid']:
+        write_report(_REPORT['filename'])
+        _REPORT['written']=time.time()
+
+def _terminated(signum,frame):
+    if os.getpid()==_REPORT['pid']:
+        _flush_report()
+        sys.exit(128+signum)
+    # A forked worker: terminate as it would have without the handler
+    signal.signal(signum,signal.SIG_DFL)
+    os.kill(os.getpid(),signum)
+
+def report_to(filename,interval=10.):
+    '''Keep filename up to date with the report while the script runs'''
+    if _REPORT['filename'] is None:
+        atexit.register(_flush_report)
+        signal.signal(signal.SIGTERM,_terminated)
+    _REPORT.update(filename=filename,pid=os.getpid(),interval=interval)
+
+def worker_stages():
+    '''Stages recorded in this (worker) process since the last call'''
+    stages=dict(STAGES)
+    STAGES.clear()
+    return stages
+
+def merge_stages(stages,prefix='workers/'):
+    '''Add stages from a worker process to this process' report'''
+    for name,WORKER in stages.items():
+        RECORD=_stage_record(prefix+name)
+        RECORD['calls'    ]+=WORKER['calls'    ]
+        RECORD['wall_time']+=WORKER['wall_time']
+        for variable,nbytes in WORKER['bytes_read'].items():
+            RECORD['bytes_read'][variable]=RECORD['bytes_read'].get(variable,0)+nbytes
+        RECORD['peak_rss_MB']=max(RECORD['peak_rss_MB'],WORKER['peak_rss_MB'])
+        RECORD['peak_rss_increase_MB']=max(RECORD['peak_rss_increase_MB'],\
+                                           WORKER['peak_rss_increase_MB'])
@@ -0,0 +1,169 @@
+import numpy as np
+import netCDF4 as nc
+from instrumentation import stage,count_read
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Helpers for reading NEMO/NEMOTAM output files a few records at a time, so
+that diagnostics can be accumulated without holding a whole (t,z,y,x) run in
+memory. Every read is counted in the current instrumentation stage (see
+instrumentation.py), and reads by record_blocks are timed as stage 'load'.
+
+read_records(variable,start,stop)
+       variable[start:stop] (by default, the whole variable), or
+       variable[start:stop,index] for a (variable,index) pair
+
+record_blocks(variables,records_per_block,nrecords,reverse)
+       yields (start,stop,[variable[start:stop] for variable in variables])
+       for consecutive blocks along the leading (time) axis, optionally
+       only over the first nrecords records (clamped to the length of the
+       file). An entry of variables may also be a (variable,index) pair, to
+       read only variable[start:stop,index] (e.g. index=(0,) for the surface
+       level). If reverse is True, records are read from the end of the
+       file backwards and returned in reverse order, so that start and stop
+       count records from the end of the run (as when interpreting adjoint
+       outputs by "age")
+prefetch_reads(nblocks)
+       from now on, record_blocks reads up to nblocks blocks ahead of the one
+       being used, on a background thread, so that the next blocks are read
+       while the current one is reduced (0: no prefetching). Blocks are
+       read in order by a single thread (netCDF/HDF5 calls are not safe to
+       run concurrently), each holding every variable of record_blocks, so
+       up to nblocks+1 blocks are in memory at once. Stage 'load' then times
+       only the wait for each block, i.e. the reading not hidden behind
+       computation (bytes read are counted as before)
+single_precision_reads(mesh_file)
+       from now on, read_records (and so record_blocks) returns plain
+       (unmasked) arrays of the values as stored (float32 for NEMO outputs),
+       with land set to zero using the tmask (umask, vmask for un, vn) of
+       mesh_file, read once here. This skips netCDF4's masking of every read
+       and the masked-array arithmetic that follows it in every diagnostic.
+       All sums are accumulated in float64 either way, so totals, centres of
+       mass, spreads, histograms and the ocean values of every field agree
+       with masked reads to float32 rounding (relative difference < 1e-6);
+       land cells of spatial fields are 0 rather than masked. Call with
+       mesh_file=None to return to masked reads. Reads of processor tiles
+       use the part of the mask at each tile's position
+read_precision(metric)
+       a grid metric (e.g. cell_volume) in the precision of the reads:
+       float32 after single_precision_reads, as it is otherwise. Full-size
+       products of outputs and metrics (e.g. tracer volumes) are made with
+       it, so that they stay float32 (half the memory of float64); their
+       sums are taken with dtype=np.float64
+tile_position(DATASET)
+       (y,x) slices of the global domain covered by one processor's output
+       tile, from its DOMAIN_position_first/last attributes (as used by
+       rebuild_nemo); the whole domain if it has none
+'''
+
+# Land (True) of the single-precision reads (see single_precision_reads), by
+# mesh_mask.nc mask name, and the mask used for each variable (tmask for any
+# other variable, or if mesh_mask.nc has no umask/vmask):
+LAND={}
+LAND_MASK_OF={'un':'umask','vn':'vmask'}
+# Blocks read ahead by record_blocks (see prefetch_reads):
+PREFETCH={'nblocks':0}
+
+def single_precision_reads(mesh_file):
+    '''Read plain arrays, with land zeroed by the masks of mesh_file'''
+    LAND.clear()
+    if mesh_file is None:
+        return
+    MESH=nc.Dataset(mesh_file)
+    for name in ['tmask','umask','vmask']:
+        if name in MESH.variables:
+            LAND[name]=np.ma.getdata(MESH.variables[name][0])==0
+    MESH.close()
+
+def read_precision(metric):
+    '''metric as float32 if outputs are read in single precision'''
+    return np.asarray(metric,dtype=np.float32) if LAND else metric
+
+def raw_records(variable,start=0,stop=None,index=()):
+    '''variable[start:stop,index] as stored (not masked), with land zeroed'''
+    variable.set_auto_mask(False)
+    data=np.asarray(variable[(slice(start,stop),)+tuple(index)])
+    variable.set_auto_mask(True)
+    if variable.ndim>=3:
+        land=LAND.get(LAND_MASK_OF.get(variable.name),LAND['tmask'])
+        if variable.ndim==3: # (t,y,x)
+            land=land[0]
+        if land.shape[-2:]!=variable.shape[-2:]: # A processor tile
+            jslice,islice=tile_position(variable.group())
+            land=land[...,jslice,islice]
+        np.copyto(data,0,where=land[tuple(index)])
+    return data
+
+def uncounted_records(variable,start=0,stop=None):
+    '''As read_records, without counting the read (for reads off the main
+    thread, where stages are not tracked)'''
+    index=()
+    if isinstance(variable,tuple):
+        variable,index=variable
+    if LAND:
+        return raw_records(variable,start,stop,index)
+    return variable[(slice(start,stop),)+tuple(index)]
+
+def read_records(variable,start=0,stop=None):
+    '''variable[start:stop], or variable[start:stop,index] for a pair'''
+    data=uncounted_records(variable,start,stop)
+    count_read((variable[0] if isinstance(variable,tuple) else variable).name,data)
+    return data
+
+def prefetch_reads(nblocks):
+    '''Read nblocks blocks ahead in record_blocks (0: no prefetching)'''
+    PREFETCH['nblocks']=nblocks
+
+def read_block(variables,start,stop,ntotal,reverse):
+    '''[variable[start:stop] for variable in variables], uncounted'''
+    if reverse:
+        return [uncounted_records(variable,ntotal-stop,ntotal-start)[::-1]\
+                for variable in variables]
+    return [uncounted_records(variable,start,stop) for variable in variables]
+
+def record_blocks(variables,records_per_block=1,nrecords=None,reverse=False):
+    '''Iterate over consecutive blocks of records of one or more netCDF
+    variables sharing the same leading (time) dimension'''
+    first=variables[0][0] if isinstance(variables[0],tuple) else variables[0]
+    ntotal=first.shape[0]
+    nrecords=min(nrecords or ntotal,ntotal)
+    blocks=[(start,min(start+records_per_block,nrecords))\
+            for start in np.arange(0,nrecords,records_per_block)]
+    names=[(variable[0] if isinstance(variable,tuple) else variable).name\
+           for variable in variables]
+    if PREFETCH['nblocks']<=0:
+        for start,stop in blocks:
+            with stage('load'):
+                block=read_block(variables,start,stop,ntotal,reverse)
+                for name,data in zip(names,block):
+                    count_read(name,data)
+            yield start,stop,block
+        return
+
+    # Imported here, as rearrange_climatology_for_rebuild_nemo.py (which
+    # never prefetches) is still run with python 2.7:
+    from concurrent.futures import ThreadPoolExecutor
+    READER=ThreadPoolExecutor(max_workers=1)
+    pending=[]
+    try:
+        for n,(start,stop) in enumerate(blocks):
+            # Keep the next nblocks blocks (after this one) in flight:
+            for next_start,next_stop in blocks[n+len(pending):n+1+PREFETCH['nblocks']]:
+                pending.append(READER.submit(read_block,variables,next_start,next_stop,\
+                                             ntotal,reverse))
+            with stage('load'):
+                block=pending.pop(0).result()
+                for name,data in zip(names,block):
+                    count_read(name,data)
+            yield start,stop,block
+    finally:
+        # Finish (or cancel) any reads before the caller can close the file:
+        READER.shutdown(wait=True,cancel_futures=True)
+
+def tile_position(DATASET):
+    '''(y,x) slices of the global domain covered by a tile'''
+    first=getattr(DATASET,'DOMAIN_position_first',[1,1])
+    last =getattr(DATASET,'DOMAIN_position_last' ,[DATASET.dimensions['x'].size,\
+                                                   DATASET.dimensions['y'].size])
+    return slice(first[1]-1,last[1]),slice(first[0]-1,last[0])
@@ -0,0 +1,233 @@
+import os
+import re
+import glob
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import netCDF4 as nc
+from grid_metrics import grid_metrics
+from nemo_io import record_blocks,single_precision_reads,prefetch_reads
+from ts_histogram import ts_bin_indices
+from streaming_diagnostics import tangent_linear_streaming,adjoint_streaming
+from instrumentation import stage,write_report,report_to,worker_stages,merge_stages
+from results_store import results_key,load_results,store_results
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Batch driver calculating the water-mass diagnostics of every experiment in
+WATER_MASS_RUNS in one job. Runs are discovered from the namelists there: the
+name of each run is its cn_exp, its output is expected in
+PATH_TO_OUTPUTS/<cn_exp>_output.nc (stitched and concatenated as described in
+diagnostics_tangent_linear.py), and its mode (ln_swi_opatam=200: tangent-linear,
+201: adjoint) selects the diagnostics calculated for it, those of
+diagnostics_tangent_linear.py or diagnostics_adjoint.py respectively (as their
+STREAMING=True versions, see streaming_diagnostics.py).
+
+Runs are processed concurrently, one per worker process. Data used by several
+runs is read once and shared read-only between workers:
+- grid metrics are built (or found) once in the memory-mapped cache of
+  grid_metrics.py, whose pages every worker then shares;
+- runs with the same mode, time steps, output frequency and trajectory
+  (nn_it000, nn_itend, nn_pttam_out_freq, cn_dirtrj, nn_ittrjoffset) have
+  identical trajectory tn,sn in their outputs. These are read once, from the
+  first run, binned into TS classes (ts_histogram.ts_bin_indices; surface only
+  for adjoint runs) and placed in shared memory, from which the TS
+  histograms of every run in the group are filled. Runs with a trajectory of
+  their own read tn,sn block by block as usual.
+
+Results of each run are kept in the results store under the same key as the
+corresponding script, so runs already processed (by this driver or by the
+scripts with STREAMING=True) are loaded rather than recalculated, and vice
+versa. The script calculates RESULTS[cn_exp][quantity], with quantities as
+documented in diagnostics_tangent_linear.py and diagnostics_adjoint.py.
+'''
+
+PATH_TO_RUNS     ='../WATER_MASS_RUNS/'
+PATH_TO_OUTPUTS  ='WATER_MASS_OUTPUTS/'
+PATH_TO_MESH_MASK='./'
+RECORDS_PER_BLOCK=1
+SPARSE           =True # Only sum over cells where the tracer is non-zero (see sparse_tracer.py)
+TARGET_VENTILATED_FRACTION=None # As in diagnostics_adjoint.py
+NWORKERS         =None # Default: one per run, up to the number of CPUs
+SINGLE_PRECISION =False # Plain float32 reads (see nemo_io.single_precision_reads)
+PREFETCH_BLOCKS  =0    # Blocks read ahead of the calculation (see nemo_io.prefetch_reads)
+
+# Time, bytes read and peak memory of each stage (of every worker) are written
+# here (see instrumentation.py):
+REPORT_FILE='process_water_mass_runs_report.json'
+USE_RESULTS_STORE=True
+
+## TS bins (as in diagnostics_tangent_linear.py and diagnostics_adjoint.py):
+tem_bins=np.linspace(- 2  , 5  ,29)
+sal_bins=np.linspace( 34.5,35.5,21)
+
+# Namelist parameters determining the trajectory T/S written with the outputs:
+TRAJECTORY_PARAMETERS=['ln_swi_opatam','nn_it000','nn_itend','nn_pttam_out_freq',\
+                       'cn_dirtrj','nn_ittrjoffset']
+MODES={200:'tangent_linear',201:'adjoint'}
+# Stored results without these (stored before they were calculated) are recalculated:
+STORED_NAMES={'tangent_linear':['lateral_STD','vertical_STD'],'adjoint':[]}
+
+################################################################################
+#                              FUNCTIONS
+################################################################################
+
+def namelist_value(namelist_file,name):
+    '''Value (as a string, without quotes) of name in a NEMO namelist'''
+    with open(namelist_file) as f:
+        for line in f:
+            match=re.match(r'\s*'+name+r'\s*=\s*([^!]*)',line)
+            if match:
+                return match.group(1).strip().strip('\'"')
+    return None
+
+def water_mass_runs(path_to_runs=PATH_TO_RUNS,path_to_outputs=PATH_TO_OUTPUTS):
+    '''{cn_exp: run} for each namelist in path_to_runs, where run is a
+    dictionary of its mode, output file and trajectory parameters'''
+    RUNS={}
+    for namelist_file in sorted(glob.glob(os.path.join(path_to_runs,'*.namelist'))):
+        name=namelist_value(namelist_file,'cn_exp')
+        TRAJECTORY=tuple(namelist_value(namelist_file,parameter)\
+                         for parameter in TRAJECTORY_PARAMETERS)
+        RUNS[name]={'mode'       :MODES[int(TRAJECTORY[0])],
+                    'output_file':os.path.join(path_to_outputs,name+'_output.nc'),
+                    'trajectory' :TRAJECTORY}
+    return RUNS
+
+def run_parameters(mode,tem_bins=tem_bins,sal_bins=sal_bins,\
+                   target_fraction=TARGET_VENTILATED_FRACTION,single_precision=SINGLE_PRECISION):
+    '''Results store parameters, as used by diagnostics_<mode>.py'''
+    PARAMETERS={'diagnostic':mode,'tem_bins':tem_bins,'sal_bins':sal_bins}
+    if mode=='adjoint':
+        PARAMETERS['target_ventilated_fraction']=target_fraction
+    if single_precision:
+        PARAMETERS['single_precision']=True
+    return PARAMETERS
+
+def shared_ts_bin_indices(output_file,mode,tem_bins,sal_bins,records_per_block=1):
+    '''TS bin indices of every record of output_file (surface only for
+    adjoint runs), in a new block of shared memory. Returns the shared memory
+    and a description (name,shape,dtype) by which workers attach to it'''
+    OUTPUT_NC=nc.Dataset(output_file)
+    index=(0,) if mode=='adjoint' else ()
+    tn=OUTPUT_NC.variables['tn']
+    shape=(tn.shape[0],int(np.prod(tn.shape[1+len(index):])))
+    # Fewer than 2**15 TS classes: 2 bytes per cell
+    dtype=np.int16 if (len(tem_bins)-1)*(len(sal_bins)-1)<2**15 else np.int32
+    SHARED=shared_memory.SharedMemory(create=True,\
+                                      size=int(np.prod(shape))*np.dtype(dtype).itemsize)
+    ts_indices=np.ndarray(shape,dtype,buffer=SHARED.buf)
+    for start,stop,(traj_tn,traj_sn) in record_blocks([(tn,index),\
+                                                       (OUTPUT_NC.variables['sn'],index)],\
+                                                      records_per_block):
+        ts_indices[start:stop]=ts_bin_indices(traj_tn,traj_sn,tem_bins,sal_bins)
+    OUTPUT_NC.close()
+    return SHARED,(SHARED.name,shape,np.dtype(dtype).str)
+
+def process_run(RUN,mesh_file,tem_bins,sal_bins,records_per_block=1,target_fraction=None,\
+                sparse=False,shared_ts_indices=None):
+    '''Diagnostics of one run, using TS bin indices in shared memory if given'''
+    OUTPUT_NC=nc.Dataset(RUN['output_file'])
+    GRID=grid_metrics(mesh_file)
+    ts_indices=None
+    if shared_ts_indices is not None:
+        name,shape,dtype=shared_ts_indices
+        SHARED=shared_memory.SharedMemory(name=name)
+        ts_indices=np.ndarray(shape,np.dtype(dtype),buffer=SHARED.buf)
+        ts_indices.flags.writeable=False
+    if RUN['mode']=='tangent_linear':
+        RESULTS=tangent_linear_streaming(OUTPUT_NC,GRID,tem_bins,sal_bins,records_per_block,\
+                                         sparse,ts_indices)
+    else:
+        RESULTS=adjoint_streaming(OUTPUT_NC,GRID,tem_bins,sal_bins,records_per_block,\
+                                  target_fraction,sparse,ts_indices)
+    if shared_ts_indices is not None:
+        del ts_indices
+        SHARED.close()
+    OUTPUT_NC.close()
+    return RESULTS
+
+def _process_run(args):
+    name=args[0]
+    return name,process_run(*args[1:]),worker_stages()
+
+def process_water_mass_runs(RUNS,mesh_file,tem_bins,sal_bins,records_per_block=1,\
+                            target_fraction=None,sparse=False,nworkers=None):
+    '''Diagnostics of every run in RUNS ({cn_exp: run}, see water_mass_runs),
+    one run per worker process, sharing the TS classes of runs with the same
+    trajectory'''
+    grid_metrics(mesh_file) # Build the cache once, before the workers read it
+
+    ## Runs with the same trajectory share their TS bin indices:
+    GROUPS={}
+    for name,RUN in RUNS.items():
+        GROUPS.setdefault(RUN['trajectory'],[]).append(name)
+    SHARED={}
+    SPECS ={}
+    with stage('shared TS classes'):
+        for names in GROUPS.values():
+            if len(names)>1:
+                SHARED[names[0]],SPECS[names[0]]=\
+                        shared_ts_bin_indices(RUNS[names[0]]['output_file'],\
+                                              RUNS[names[0]]['mode'],tem_bins,sal_bins,\
+                                              records_per_block)
+                for name in names[1:]:
+                    SPECS[name]=SPECS[names[0]]
+
+    try:
+        # Workers start with no stages of their own (not those of this process):
+        pool=multiprocessing.Pool(nworkers or min(len(RUNS),multiprocessing.cpu_count()),\
+                                  initializer=worker_stages)
+        results=pool.map(_process_run,[(name,RUN,mesh_file,tem_bins,sal_bins,records_per_block,\
+                                        target_fraction,sparse,SPECS.get(name))\
+                                       for name,RUN in RUNS.items()])
+        pool.close()
+        pool.join()
+    finally:
+        for SHARED_MEMORY in SHARED.values():
+            SHARED_MEMORY.close()
+            SHARED_MEMORY.unlink()
+    for name,RESULTS,stages in results:
+        merge_stages(stages)
+    return dict((name,RESULTS) for name,RESULTS,stages in results)
+
+################################################################################
+#                              DIAGNOSTICS
+################################################################################
+
+if __name__=='__main__':
+    report_to(REPORT_FILE) # Rewritten as the script runs, so a killed job leaves a report
+    RUNS=water_mass_runs(PATH_TO_RUNS,PATH_TO_OUTPUTS)
+    if SINGLE_PRECISION:
+        single_precision_reads(PATH_TO_MESH_MASK+'mesh_mask.nc') # Inherited by every worker
+    prefetch_reads(PREFETCH_BLOCKS)
+    for name in [name for name,RUN in RUNS.items() if not os.path.isfile(RUN['output_file'])]:
+        print('%s: no output file %s, skipping'%(name,RUNS.pop(name)['output_file']))
+
+    ## Stored results of each run (see results_store.py):
+    RESULTS={}
+    RESULTS_KEYS={}
+    if USE_RESULTS_STORE:
+        for name,RUN in RUNS.items():
+            RESULTS_KEYS[name]=results_key([RUN['output_file'],PATH_TO_MESH_MASK+'mesh_mask.nc'],\
+                                           run_parameters(RUN['mode']))
+            STORED=load_results(RESULTS_KEYS[name],names=STORED_NAMES[RUN['mode']])
+            if STORED is not None:
+                RESULTS[name]=STORED
+
+    ## Process the remaining runs:
+    NEW_RUNS=dict((name,RUN) for name,RUN in RUNS.items() if name not in RESULTS)
+    if NEW_RUNS:
+        RESULTS.update(process_water_mass_runs(NEW_RUNS,PATH_TO_MESH_MASK+'mesh_mask.nc',\
+                                               tem_bins,sal_bins,RECORDS_PER_BLOCK,\
+                                               TARGET_VENTILATED_FRACTION,SPARSE,NWORKERS))
+    if USE_RESULTS_STORE:
+        with stage('save'):
+            for name in NEW_RUNS:
+                store_results(RESULTS_KEYS[name],RESULTS[name],\
+                              [RUNS[name]['output_file'],PATH_TO_MESH_MASK+'mesh_mask.nc'],\
+                              run_parameters(RUNS[name]['mode']),\
+                              'process_water_mass_runs.py')
+    RESULTS=dict((name,RESULTS[name]) for name in RUNS) # In namelist order
+    write_report(REPORT_FILE)
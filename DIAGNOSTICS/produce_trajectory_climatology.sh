@@ -7,6 +7,8 @@
 # First averages in time along each processor tile, then ensures (using python script) that
 # output is compatible with TOOLS/rebuild_nemo and stitches in space, before
 # concatenating in time.
+# build_trajectory_climatology.py produces the same file in a single parallel
+# pass over the trajectory, without intermediate files.
 ################################################################################
 
 ###
@@ -22,9 +24,10 @@ do
     do
     echo "Tile ${T}, day ${D}"
     ncra `seq -f "${TRAJECTORY_DIRECTORY}/t_%08g_${T}.nc" $(((0+$((10#$D)))*15)) 5475 328500` "./CLIMATOLOGY_${D}_${T}.nc"
-    python2.7 rearrange_climatology_for_rebuild_nemo.py "CLIMATOLOGY_${D}_${T}.nc"
-    rm "./CLIMATOLOGY_${D}_${T}.nc"
     done;    
+    # Rearrange all tiles of this day in one (parallel) python process
+    python2.7 rearrange_climatology_for_rebuild_nemo.py "CLIMATOLOGY_${D}_????.nc"
+    rm ./CLIMATOLOGY_${D}_????.nc
     ${REBUILD_NEMO_DIRECTORY}/rebuild_nemo ./TRAJ_CLIMATOLOGY_${D} 64;
     rm ./TRAJ_CLIMATOLOGY_${D}_????.nc
 done
@@ -0,0 +1,259 @@
+import os
+import json
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener,Client
+import numpy as np
+from grid_metrics import grid_metrics
+from instrumentation import stage
+from results_store import results_key,load_results,store_results,_jsonable
+from process_water_mass_runs import water_mass_runs,run_parameters,process_run,STORED_NAMES,\
+                                    TRAJECTORY_PARAMETERS,tem_bins,sal_bins
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Long-running query service for the water-mass runs. The grid metrics, and
+the diagnostics of each run (those of diagnostics_tangent_linear.py or
+diagnostics_adjoint.py, loaded from the results store, or calculated and
+stored if absent, as by process_water_mass_runs.py) are loaded once and kept
+in memory, so that questions such as "what fraction of NASMW_adj_below_MLD
+ventilated east of 35W within 20 years" are answered in milliseconds rather
+than by rerunning a script. The diagnostics of the runs most recently
+queried are kept, up to MAX_RESIDENT_BYTES (least recently used runs are
+dropped first, and reloaded from the results store when next queried), as
+are the answers to the last MAX_CACHED_QUERIES queries.
+
+The service is used either in-process:
+       open_service() ; query({'run':'NASMW_adj_below_MLD',...})
+or over a local socket, by running this script (which serves on ADDRESS
+until it receives the query {'query':'stop'}) and, from any other process of
+the same user:
+       remote_query({'run':'NASMW_adj_below_MLD',...})
+Connections are authenticated with a random key generated when the service
+starts and written to AUTHKEY_FILE, readable only by its owner (messages are
+pickled, so only those holding the key must be able to send them).
+
+A query is a dictionary with the name of a run ('run', its cn_exp), the
+kind of query ('query') and its arguments. Times are in years since the
+start of a tangent-linear run or, for an adjoint run, ages in years; record
+n of a run is at n*nn_pttam_out_freq/NSTEPS_PER_YEAR years. Answers are
+dictionaries of numpy arrays:
+{'query':'region','region':REGION,'years':(start,stop)}
+       'fraction' of the tracer in a region (tangent-linear) or which has
+       ventilated there by each age (adjoint, cumulative) at each record
+       'years' between start and stop (inclusive; default: the whole run).
+       REGION is a dictionary of any of lat_range, lon_range (min <= value
+       < max, degrees) and basin (a basin mask of grid_metrics, e.g.
+       'atlmsk', if PATH_TO_SUBBASINS is given), as in water_masses.py
+{'query':'ts_class','tem_range':(min,max),'sal_range':(min,max),'years':...}
+       'fraction' of the tracer in TS bins with centres in the given ranges
+       (tangent-linear), or which has ventilated from them by each age
+       (adjoint, cumulative)
+{'query':'age','years':...}
+       (adjoint only) cumulative 'fraction' ventilated by each age
+{'query':'age','fraction':f}
+       (adjoint only) the first age ('years') by which a fraction f of the
+       tracer has ventilated (NaN if it never does)
+
+open_service(path_to_runs,path_to_outputs,mesh_file,subbasins_file)
+       load the grid metrics and find the runs (as process_water_mass_runs)
+query(QUERY)
+       answer a query, from the cache if it has been asked before
+serve(address,authkey_file), remote_query(QUERY,address,authkey_file)
+       answer queries over a local socket
+'''
+
+PATH_TO_RUNS      ='../WATER_MASS_RUNS/'
+PATH_TO_OUTPUTS   ='WATER_MASS_OUTPUTS/'
+PATH_TO_MESH_MASK ='./'
+PATH_TO_SUBBASINS =None # e.g. './', to allow basin regions
+NSTEPS_PER_YEAR   =5475
+MAX_RESIDENT_BYTES=2*2**30 # Diagnostics of runs kept in memory
+MAX_CACHED_QUERIES=1024
+ADDRESS           =('localhost',6150)
+AUTHKEY_FILE      =os.path.expanduser('~/.passive_experiments_query_service.key')
+
+SERVICE ={}            # GRID, RUNS, mesh_file
+RESIDENT=OrderedDict() # {run: diagnostics}, least recently used first
+ANSWERS =OrderedDict() # {query: answer}, least recently used first
+
+################################################################################
+#                              FUNCTIONS
+################################################################################
+
+def open_service(path_to_runs=PATH_TO_RUNS,path_to_outputs=PATH_TO_OUTPUTS,\
+                 mesh_file=PATH_TO_MESH_MASK+'mesh_mask.nc',subbasins_file=None):
+    '''Load the grid metrics and find the runs with an output file'''
+    SERVICE['GRID']=grid_metrics(mesh_file,subbasins_file)
+    SERVICE['RUNS']=dict((name,RUN) for name,RUN in\
+                         water_mass_runs(path_to_runs,path_to_outputs).items()\
+                         if os.path.isfile(RUN['output_file']))
+    SERVICE['mesh_file']=mesh_file
+    RESIDENT.clear()
+    ANSWERS.clear()
+
+def results_bytes(RESULTS):
+    return sum(np.asarray(value).nbytes for value in RESULTS.values())
+
+def run_results(name):
+    '''Diagnostics of a run, loaded (or calculated) on first use, keeping the
+    most recently used runs resident up to MAX_RESIDENT_BYTES'''
+    if name in RESIDENT:
+        RESIDENT.move_to_end(name)
+        return RESIDENT[name]
+    RUN=SERVICE['RUNS'][name]
+    input_files=[RUN['output_file'],SERVICE['mesh_file']]
+    key=results_key(input_files,run_parameters(RUN['mode']))
+    with stage('load'):
+        RESULTS=load_results(key,names=STORED_NAMES[RUN['mode']])
+    if RESULTS is None:
+        RESULTS=process_run(RUN,SERVICE['mesh_file'],tem_bins,sal_bins,sparse=True)
+        with stage('save'):
+            store_results(key,RESULTS,input_files,run_parameters(RUN['mode']),'query_service.py')
+    RESIDENT[name]=RESULTS
+    while len(RESIDENT)>1 and sum(results_bytes(R) for R in RESIDENT.values())>MAX_RESIDENT_BYTES:
+        RESIDENT.popitem(last=False)
+    return RESULTS
+
+def years_per_record(name):
+    '''Years between outputs of a run (nn_pttam_out_freq)'''
+    RUN=SERVICE['RUNS'][name]
+    return float(RUN['trajectory'][TRAJECTORY_PARAMETERS.index('nn_pttam_out_freq')])\
+           /NSTEPS_PER_YEAR
+
+def record_window(name,nrecords,years=None):
+    '''Records of a run, and their times (years), within years (start,stop)'''
+    times=np.arange(nrecords)*years_per_record(name)
+    if years is None:
+        return np.arange(nrecords),times
+    records=np.nonzero((times>=years[0]) & (times<=years[1]))[0]
+    return records,times[records]
+
+def region_mask(region):
+    '''(y,x) mask of the T points in a region'''
+    GRID=SERVICE['GRID']
+    mask=np.ones(np.shape(GRID['X']),dtype=bool)
+    if 'lat_range' in region:
+        lat=GRID['gphit'][0,:]
+        mask&=(lat>=region['lat_range'][0]) & (lat<region['lat_range'][1])
+    if 'lon_range' in region:
+        lon=GRID['glamt'][0,:]
+        mask&=(lon>=region['lon_range'][0]) & (lon<region['lon_range'][1])
+    if 'basin' in region:
+        mask&=(GRID[region['basin']]!=0)
+    return mask
+
+def prdens_name(name):
+    return {'tangent_linear':'tracer_depth_integrated_prdens',\
+            'adjoint'       :'tracer_ventilation_prdens'}[SERVICE['RUNS'][name]['mode']]
+
+def region_query(name,region={},years=None):
+    '''Fraction of the tracer in (or ventilated in) a region'''
+    RESULTS=run_results(name)
+    prdens=RESULTS[prdens_name(name)]
+    records,times=record_window(name,np.shape(prdens)[0],years)
+    mask=region_mask(region)
+    cell_area=SERVICE['GRID']['cell_area'][0]
+    fraction=np.array([np.sum(np.ma.filled(prdens[record],0)[mask]*cell_area[mask])\
+                       for record in records])
+    return {'years':times,'fraction':fraction}
+
+def ts_class_query(name,tem_range=(-np.inf,np.inf),sal_range=(-np.inf,np.inf),years=None):
+    '''Fraction of the tracer in (or ventilated from) a range of TS classes'''
+    RESULTS=run_results(name)
+    histogram=RESULTS['tracer_TS_volume_histogram']
+    records,times=record_window(name,np.shape(histogram)[0],years)
+    tem_centres=(RESULTS['tem_bins'][1:]+RESULTS['tem_bins'][:-1])/2
+    sal_centres=(RESULTS['sal_bins'][1:]+RESULTS['sal_bins'][:-1])/2
+    in_tem=(tem_centres>=tem_range[0]) & (tem_centres<=tem_range[1])
+    in_sal=(sal_centres>=sal_range[0]) & (sal_centres<=sal_range[1])
+    fraction=np.sum(np.asarray(histogram)[records][:,in_tem][:,:,in_sal],axis=(1,2))\
+             /RESULTS['tracer_initial_volume']
+    return {'years':times,'fraction':fraction}
+
+def age_query(name,years=None,fraction=None):
+    '''Cumulative fraction ventilated by each age, or the age by which a
+    fraction has ventilated (adjoint runs)'''
+    if SERVICE['RUNS'][name]['mode']!='adjoint':
+        raise ValueError('%s is not an adjoint run'%name)
+    age_probability=np.asarray(run_results(name)['tracer_age_probability'])
+    if fraction is not None:
+        reached=np.nonzero(age_probability>=fraction)[0]
+        return {'years':reached[0]*years_per_record(name) if len(reached) else np.nan}
+    records,times=record_window(name,len(age_probability),years)
+    return {'years':times,'fraction':age_probability[records]}
+
+QUERIES={'region'  :region_query,
+         'ts_class':ts_class_query,
+         'age'     :age_query}
+
+def query(QUERY):
+    '''Answer a query (see DESCRIPTION), from the cache if possible'''
+    key=json.dumps(_jsonable(QUERY),sort_keys=True) # numpy values as plain JSON
+    if key in ANSWERS:
+        ANSWERS.move_to_end(key)
+        return ANSWERS[key]
+    arguments=dict((argument,value) for argument,value in QUERY.items()\
+                   if argument not in ['run','query'])
+    with stage('query'):
+        ANSWER=QUERIES[QUERY['query']](QUERY['run'],**arguments)
+    ANSWERS[key]=ANSWER
+    if len(ANSWERS)>MAX_CACHED_QUERIES:
+        ANSWERS.popitem(last=False)
+    return ANSWER
+
+def new_authkey(authkey_file=AUTHKEY_FILE):
+    '''Random key, written to authkey_file (mode 0600)'''
+    authkey=os.urandom(32)
+    tmp_file=authkey_file+'.tmp%d'%os.getpid()
+    with os.fdopen(os.open(tmp_file,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0o600),'wb') as f:
+        f.write(authkey)
+    os.replace(tmp_file,authkey_file)
+    return authkey
+
+def read_authkey(authkey_file=AUTHKEY_FILE):
+    with open(authkey_file,'rb') as f:
+        return f.read()
+
+def serve(address=ADDRESS,authkey_file=AUTHKEY_FILE):
+    '''Answer queries from local clients (one at a time) until one sends
+    {'query':'stop'}. Errors are returned as {'error':message}'''
+    authkey=new_authkey(authkey_file)
+    try:
+        with Listener(address,authkey=authkey) as listener:
+            while True:
+                try:
+                    connection=listener.accept()
+                except AuthenticationError: # Without the key: nothing was unpickled
+                    continue
+                with connection:
+                    QUERY=connection.recv()
+                    if QUERY.get('query')=='stop':
+                        connection.send({})
+                        return
+                    try:
+                        connection.send(query(QUERY))
+                    except Exception as error:
+                        connection.send({'error':'%s: %s'%(type(error).__name__,error)})
+    finally:
+        os.remove(authkey_file)
+
+def remote_query(QUERY,address=ADDRESS,authkey_file=AUTHKEY_FILE):
+    '''Send a query to the service running at address'''
+    with Client(address,authkey=read_authkey(authkey_file)) as connection:
+        connection.send(QUERY)
+        ANSWER=connection.recv()
+    if 'error' in ANSWER:
+        raise RuntimeError(ANSWER['error'])
+    return ANSWER
+
+################################################################################
+#                                 MAIN
+################################################################################
+
+if __name__=='__main__':
+    open_service(PATH_TO_RUNS,PATH_TO_OUTPUTS,PATH_TO_MESH_MASK+'mesh_mask.nc',\
+                 PATH_TO_SUBBASINS and PATH_TO_SUBBASINS+'subbasins.nc')
+    print('serving water-mass run queries on %s:%d'%ADDRESS)
+    serve(ADDRESS,AUTHKEY_FILE)
@@ -1,31 +1,95 @@
 import netCDF4 as nc
 import numpy as np
 import sys
-''' 
+import os
+import glob
+import multiprocessing
+from nemo_io import read_records
+from instrumentation import stage,write_report,report_to,worker_stages,merge_stages
+'''
 Rearrange netCDF dimensions produced by trajectory_climatology.sh
 so the files can be stitched together by TOOLS/rebuild_nemo
+
+Usage: python rearrange_climatology_for_rebuild_nemo.py FILE [FILE ...]
+FILE may be a file name or a quoted glob pattern (e.g. "CLIMATOLOGY_000_????.nc"),
+and each FILE is written to TRAJ_FILE in the same directory. Files are
+processed in parallel by NWORKERS worker processes, and each variable is
+copied RECORDS_PER_BLOCK slices (along its first dimension) at a time rather
+than being read into memory whole.
+
+NetCDF4 (and NetCDF4 classic model) outputs are compressed (COMPRESSION_LEVEL,
+0 for none) and chunked one horizontal (y,x) slice at a time, matching the
+slices in which rebuild_nemo reads and writes them.
+
+Time, bytes read and peak memory of each stage (summed over the workers) are
+written to REPORT_FILE (see instrumentation.py).
 '''
-fname=sys.argv[1]
-        
-infile=fname
-outfile=('./TRAJ_'+fname)
-print('writing to '+outfile)        
-IN=nc.Dataset(infile)    
-#Copy global attributes:
-OUT=nc.Dataset(outfile,'w')
-OUT.setncatts(IN.__dict__)
-        
-# Create dimensions in (I believe) the correct order:
-OUT.createDimension('x', IN.dimensions['x'].size)
-OUT.createDimension('y', IN.dimensions['y'].size)
-OUT.createDimension('z', IN.dimensions['z'].size)
-OUT.createDimension('t',None)
-        
-# Copy variables from input file
-for name, variable in IN.variables.items():
-    x = OUT.createVariable(name, variable.datatype, variable.dimensions)
-    OUT[name][:] = IN[name][:]
-    # copy variable attributes all at once via dictionary
-    OUT[name].setncatts(IN[name].__dict__)
-OUT.close()
-    
+NWORKERS         =multiprocessing.cpu_count()
+RECORDS_PER_BLOCK=1
+COMPRESSION_LEVEL=1
+REPORT_FILE      ='rearrange_climatology_for_rebuild_nemo_report.json'
+
+def rearrange(fname,records_per_block=RECORDS_PER_BLOCK,compression_level=COMPRESSION_LEVEL):
+    infile=fname
+    outfile=os.path.join(os.path.dirname(fname),'TRAJ_'+os.path.basename(fname))
+    print('writing to '+outfile)
+    IN=nc.Dataset(infile)
+    #Copy global attributes:
+    OUT=nc.Dataset(outfile,'w',format=IN.data_model)
+    OUT.setncatts(IN.__dict__)
+
+    # Create dimensions in (I believe) the correct order:
+    OUT.createDimension('x', IN.dimensions['x'].size)
+    OUT.createDimension('y', IN.dimensions['y'].size)
+    OUT.createDimension('z', IN.dimensions['z'].size)
+    OUT.createDimension('t',None)
+
+    # Copy variables from input file
+    netcdf4=IN.data_model.startswith('NETCDF4') # NETCDF4 or NETCDF4_CLASSIC
+    for name, variable in IN.variables.items():
+        dims=variable.dimensions
+        fill_value=getattr(variable,'_FillValue',None)
+        if netcdf4 and len(dims)>=2 and dims[-2:]==('y','x'):
+            chunksizes=[1]*(len(dims)-2)+[IN.dimensions['y'].size,IN.dimensions['x'].size]
+            x = OUT.createVariable(name, variable.datatype, dims, fill_value=fill_value,\
+                                   zlib=compression_level>0, complevel=compression_level,\
+                                   chunksizes=chunksizes)
+        else:
+            x = OUT.createVariable(name, variable.datatype, dims, fill_value=fill_value)
+        # copy variable attributes all at once via dictionary
+        OUT[name].setncatts(dict((key,value) for key,value in IN[name].__dict__.items()\
+                                 if key!='_FillValue'))
+        # copy data a block of slices along the first dimension at a time
+        if len(variable.shape)==0:
+            OUT[name].assignValue(IN[name].getValue())
+            continue
+        for start in np.arange(0,variable.shape[0],records_per_block):
+            stop=min(start+records_per_block,variable.shape[0])
+            with stage('load'):
+                data=read_records(IN[name],start,stop)
+            with stage('save'):
+                OUT[name][start:stop] = data
+    OUT.close()
+    IN.close()
+    return outfile
+
+def _rearrange(fname):
+    return rearrange(fname),worker_stages()
+
+if __name__=='__main__':
+    report_to(REPORT_FILE) # Rewritten as the script runs, so a killed job leaves a report
+    fnames=[]
+    for pattern in sys.argv[1:]:
+        matches=sorted(glob.glob(pattern))
+        if not matches:
+            print('no files match '+pattern)
+        fnames+=matches
+    if not fnames:
+        sys.exit('no files to rearrange\nUsage: python rearrange_climatology_for_rebuild_nemo.py'\
+                 ' FILE [FILE ...]')
+    pool=multiprocessing.Pool(min(NWORKERS,len(fnames)))
+    for outfile,stages in pool.map(_rearrange,fnames):
+        merge_stages(stages)
+    pool.close()
+    pool.join()
+    write_report(REPORT_FILE)
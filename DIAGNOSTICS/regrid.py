@@ -0,0 +1,186 @@
+import os
+import numpy as np
+from grid_metrics import grid_metrics,remembered_file_hash,R_earth
+from instrumentation import stage
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Conservative remapping of (t,y,x) fields from the ORCA2 (curvilinear,
+tripolar) T grid to a regular latitude-longitude grid, as a sparse matrix
+computed once from mesh_mask.nc and applied to a whole stack of records at
+once (rather than regridding one time slice at a time with external tools).
+
+Each ocean T cell (tmask at the surface) is divided into NSUBCELLS x NSUBCELLS
+sub-cells, by bilinear interpolation (in 3D Cartesian coordinates, so
+across the date line and north fold alike) between its corners. Corners
+are taken at the centre of the four surrounding T points, as NEMO places F
+points. The fraction of the cell's area in each lat-lon cell is that of
+its sub-cells whose centres fall there. These fractions sum to one for
+every ocean T cell, so:
+- an extensive field (e.g. a volume per cell) regrids as
+  sum_i F[j,i]*field[i], and its total is conserved exactly;
+- a density (e.g. a probability density per m^2) regrids as
+  sum_i F[j,i]*cell_area[i]*field[i]/ocean_area[j], where ocean_area[j] is
+  the ocean area (sum_i F[j,i]*cell_area[i]) of lat-lon cell j. Its integral
+  (tracer volume, or probability) is conserved exactly, and a uniform
+  density stays uniform.
+Lat-lon cells with no ocean are masked. The area of a T cell is split among
+lat-lon cells to within about 1/NSUBCELLS of the cells on their boundary.
+Cells duplicated by ORCA2's cyclic and north-fold halos are included, as
+in the totals of the diagnostics; they only contribute the same values
+twice to an area-weighted mean.
+
+Newly computed weights are checked by regridding gphit and glamt, which
+must reproduce the latitudes and longitudes of the lat-lon cells to within
+half a lat-lon cell and half the largest T cell (check_remap_weights). They
+are cached in REMAP_WEIGHTS_CACHE, keyed by a hash of mesh_mask.nc, the
+resolution, NSUBCELLS and REMAP_VERSION, and are stored sorted by lat-lon cell, so that
+the matrix product is a single np.add.reduceat over all records (in blocks
+of records_per_block records, to bound memory).
+
+remap_weights(mesh_file,resolution,nsubcells,cache_dir)
+       dictionary of the remapping:
+       lat, lon       (Y,),(X,): centres of the lat-lon cells (degrees)
+       lat_bounds,lon_bounds     : their edges, (Y+1,),(X+1,)
+       row, column, fraction     : the non-zero F[row,column] (row: flat
+                                   index of a lat-lon cell, column: flat
+                                   index of a T cell), sorted by row
+       cell_area  (y,x)          : area of each T cell (m^2)
+       ocean_area (Y,X)          : ocean area of each lat-lon cell (m^2)
+check_remap_weights(REMAP,GRID)
+       raise ValueError if regridded gphit/glamt are not at the lat-lon cells
+regrid(REMAP,field,extensive,records_per_block)
+       field (t,y,x) (or (y,x)) on the lat-lon grid, (t,Y,X) (or (Y,X)), as
+       a density (default) or an extensive quantity
+'''
+
+REMAP_WEIGHTS_CACHE='./REMAP_WEIGHTS_CACHE/'
+RESOLUTION         =1.  # Degrees
+NSUBCELLS          =10  # Sub-cells per side of each T cell
+REMAP_VERSION      =2   # Changed whenever cached weights must be recomputed
+
+def corner_points(P):
+    '''(y+1,x+1,3) corners of the cells of (y,x,3) unit vectors P, at the
+    centre of each four neighbouring points (extrapolated at the edges)'''
+    P=np.concatenate([2*P[:1]-P[1:2],P,2*P[-1:]-P[-2:-1]],axis=0)
+    P=np.concatenate([2*P[:,:1]-P[:,1:2],P,2*P[:,-1:]-P[:,-2:-1]],axis=1)
+    corners=(P[:-1,:-1]+P[1:,:-1]+P[:-1,1:]+P[1:,1:])/4
+    return corners/np.linalg.norm(corners,axis=-1,keepdims=True)
+
+def subcell_overlaps(GRID,resolution=RESOLUTION,nsubcells=NSUBCELLS):
+    '''(row,column,area) of every sub-cell of every ocean T cell: the lat-lon
+    cell containing its centre, its T cell and its (unnormalised) area'''
+    P=np.stack([GRID['X'],GRID['Y'],GRID['Z']],axis=-1)/R_earth
+    C=corner_points(P)
+    ocean=np.nonzero(GRID['tmask'][0,0].reshape(-1))[0]
+    nx=np.shape(P)[1]
+    jj,ii=ocean//nx,ocean%nx
+    SW,SE,NW,NE=[C[jj+dj,ii+di][:,np.newaxis,:] for dj,di in [(0,0),(0,1),(1,0),(1,1)]]
+    nlon=int(round(360/resolution))
+    rows,columns,areas=[],[],[]
+    for s in (np.arange(nsubcells)+0.5)/nsubcells:
+        t=((np.arange(nsubcells)+0.5)/nsubcells)[:,np.newaxis]
+        centre=(1-s)*(1-t)*SW+s*(1-t)*SE+(1-s)*t*NW+s*t*NE
+        # Area from the Jacobian of the bilinear map:
+        area=np.linalg.norm(np.cross((1-t)*(SE-SW)+t*(NE-NW),(1-s)*(NW-SW)+s*(NE-SE)),axis=-1)
+        # As streaming_diagnostics.spherical_projection (the inverse of
+        # grid_metrics.cartesian_projection), with lon in [-180,180):
+        lat=-np.rad2deg(np.arcsin(np.clip(centre[...,2]/np.linalg.norm(centre,axis=-1),-1,1)))
+        lon=np.mod(np.rad2deg(np.arctan2(centre[...,1],centre[...,0])),360)-180
+        jlat=np.minimum(((lat+90)/resolution).astype(int),int(round(180/resolution))-1)
+        ilon=np.minimum(((lon+180)/resolution).astype(int),nlon-1)
+        rows   .append((jlat*nlon+ilon).reshape(-1))
+        columns.append(np.repeat(ocean,nsubcells))
+        areas  .append(area.reshape(-1))
+    return np.concatenate(rows),np.concatenate(columns),np.concatenate(areas)
+
+def compute_remap_weights(mesh_file,resolution=RESOLUTION,nsubcells=NSUBCELLS):
+    '''Remapping from the T grid of mesh_file to a lat-lon grid (no caching)'''
+    GRID=grid_metrics(mesh_file)
+    ny,nx=np.shape(GRID['X'])
+    nlat,nlon=int(round(180/resolution)),int(round(360/resolution))
+    row,column,area=subcell_overlaps(GRID,resolution,nsubcells)
+
+    ## Sum sub-cells into (row,column) pairs, as fractions of each T cell:
+    pair,index=np.unique(row.astype(np.int64)*ny*nx+column,return_inverse=True)
+    area=np.bincount(index.reshape(-1),weights=area)
+    row,column=pair//(ny*nx),pair%(ny*nx)
+    fraction=area/np.bincount(column,weights=area,minlength=ny*nx)[column]
+
+    cell_area=np.array(GRID['cell_area'][0])
+    ocean_area=np.bincount(row,weights=fraction*cell_area.reshape(-1)[column],\
+                           minlength=nlat*nlon).reshape(nlat,nlon)
+    lat_bounds=np.linspace(-90,90,nlat+1)
+    lon_bounds=np.linspace(-180,180,nlon+1)
+    return {'lat'       :(lat_bounds[:-1]+lat_bounds[1:])/2,
+            'lon'       :(lon_bounds[:-1]+lon_bounds[1:])/2,
+            'lat_bounds':lat_bounds,
+            'lon_bounds':lon_bounds,
+            'row'       :row,
+            'column'    :column,
+            'fraction'  :fraction,
+            'cell_area' :cell_area,
+            'ocean_area':ocean_area}
+
+def check_remap_weights(REMAP,GRID):
+    '''Check that gphit and glamt regrid to the centres of the lat-lon cells
+    (longitude only within 60 degrees of the equator, away from the date
+    line, where T cells are not too distorted in longitude)'''
+    resolution=REMAP['lat_bounds'][1]-REMAP['lat_bounds'][0]
+    ocean=GRID['tmask'][0,0]!=0
+    # Largest distance (degrees) from a T point to a corner of its cell:
+    P=np.stack([GRID['X'],GRID['Y'],GRID['Z']],axis=-1)/R_earth
+    C=corner_points(P)
+    half_cell=max(np.max(np.rad2deg(np.arccos(np.clip(np.sum(P*corner,axis=-1),-1,1)))[ocean])\
+                  for corner in [C[:-1,:-1],C[1:,:-1],C[:-1,1:],C[1:,1:]])
+    tolerance=resolution/2+half_cell
+    lat,lon=np.meshgrid(REMAP['lat'],REMAP['lon'],indexing='ij')
+    lat_error=np.abs(regrid(REMAP,GRID['gphit'][0])-lat)
+    lon_error=np.abs(regrid(REMAP,GRID['glamt'][0])-lon)*np.cos(np.deg2rad(lat))
+    lon_error[(np.abs(lat)>60) | (np.abs(lon)>180-2*tolerance)]=np.ma.masked
+    for name,error in [('gphit',lat_error),('glamt',lon_error)]:
+        if np.ma.max(error)>tolerance:
+            raise ValueError('regridded %s is up to %g degrees from the lat-lon cell centres'\
+                             ' (tolerance %g)'%(name,np.ma.max(error),tolerance))
+
+def remap_weights(mesh_file,resolution=RESOLUTION,nsubcells=NSUBCELLS,\
+                  cache_dir=REMAP_WEIGHTS_CACHE):
+    '''Remapping to a lat-lon grid, loaded from cache_dir (computed on
+    first use)'''
+    mesh_hash=remembered_file_hash(mesh_file,cache_dir) # Only re-read if mesh_file changes
+    filename=os.path.join(cache_dir,'%s_%gdeg_%d_v%d.npz'%(mesh_hash,resolution,nsubcells,\
+                                                           REMAP_VERSION))
+    if not os.path.isfile(filename):
+        with stage('remap weights'):
+            REMAP=compute_remap_weights(mesh_file,resolution,nsubcells)
+            check_remap_weights(REMAP,grid_metrics(mesh_file))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir,exist_ok=True)
+        # Write privately first, so that concurrent jobs never see a partial file
+        tmp_file=filename[:-4]+'.tmp%d.npz'%os.getpid()
+        np.savez(tmp_file,**REMAP)
+        os.replace(tmp_file,filename)
+    return dict(np.load(filename))
+
+def regrid(REMAP,field,extensive=False,records_per_block=100):
+    '''Conservatively regrid a (t,y,x) or (y,x) field to the lat-lon grid'''
+    nlat,nlon=np.shape(REMAP['ocean_area'])
+    row,column,weight=REMAP['row'],REMAP['column'],REMAP['fraction']
+    if not extensive:
+        weight=weight*REMAP['cell_area'].reshape(-1)[column]
+    ## Rows with any weight, and where each starts in the (sorted) weights:
+    rows,starts=np.unique(row,return_index=True)
+
+    single=np.ndim(field)==2
+    flat=np.ma.filled(field,0).reshape((1 if single else np.shape(field)[0]),-1)
+    regridded=np.zeros((np.shape(flat)[0],nlat*nlon))
+    for start in np.arange(0,np.shape(flat)[0],records_per_block):
+        stop=min(start+records_per_block,np.shape(flat)[0])
+        regridded[start:stop,rows]=np.add.reduceat(flat[start:stop,column]*weight,starts,axis=1)
+    regridded=regridded.reshape(-1,nlat,nlon)
+    ocean=REMAP['ocean_area']>0
+    if not extensive:
+        regridded[:,ocean]/=REMAP['ocean_area'][ocean]
+    regridded=np.ma.masked_array(regridded,np.broadcast_to(~ocean,np.shape(regridded)))
+    return regridded[0] if single else regridded
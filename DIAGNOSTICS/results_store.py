@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import subprocess
+import numpy as np
+import netCDF4 as nc
+from grid_metrics import remembered_file_hash
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Content-addressed on-disk store of diagnostic results. A set of results (a
+dictionary of named arrays, e.g. the probability densities, centre-of-mass
+series and TS histograms of one run) is keyed by a hash of
+- the contents of the input files it was calculated from (model output,
+  mesh_mask.nc, ...), and
+- its parameters (bin edges, target fractions, the name of the diagnostic...),
+and saved to RESULTS_STORE/<key>.nc. Each result is a zlib-compressed netCDF
+variable, chunked one record (leading index) at a time; masked arrays are
+stored with their masks (as _FillValue) and loaded as masked arrays. The
+file also holds provenance metadata: the input files and their hashes, the
+parameters, the script, time, host, git commit, RESULTS_VERSION and library
+versions it was produced with.
+
+Replacing or editing any input file, or changing a parameter, changes the key,
+so stale results are never loaded. So does RESULTS_VERSION, which is changed
+whenever the definition of a stored result changes (the diagnostics code is
+not itself hashed). Input files are hashed once: their hashes are remembered
+(in RESULTS_STORE/file_hashes.json) for as long as their size and
+modification time are unchanged.
+
+results_key(input_files,parameters,store_dir)
+       key (hex string) of the results calculated from input_files with
+       parameters (a dictionary of JSON-serialisable values or arrays)
+load_results(key,store_dir,names)
+       dictionary of stored results, or None if there are none (or if any
+       of names is missing from them, e.g. stored before it was calculated)
+store_results(key,RESULTS,input_files,parameters,script,store_dir)
+       save a dictionary of results under key, with provenance
+load_provenance(key,store_dir)
+       provenance metadata of stored results (dictionary)
+'''
+
+RESULTS_STORE='./RESULTS_STORE/'
+COMPRESSION_LEVEL=4
+RESULTS_VERSION  =2 # Changed whenever stored results must be recalculated
+
+################################################################################
+#                                 KEYS
+################################################################################
+
+def _jsonable(value):
+    '''Parameters as JSON (arrays as lists, with every digit of each float)'''
+    if isinstance(value,dict):
+        return dict((str(key),_jsonable(item)) for key,item in value.items())
+    if isinstance(value,(list,tuple,np.ndarray)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value,np.generic):
+        return value.item()
+    return value
+
+def input_file_hash(filename,store_dir=RESULTS_STORE):
+    '''Hash of a file's contents, remembered while its size and mtime are unchanged'''
+    return remembered_file_hash(filename,store_dir)
+
+def results_key(input_files,parameters={},store_dir=RESULTS_STORE):
+    '''Key of results calculated from input_files with parameters'''
+    hasher=hashlib.sha1()
+    for filename in input_files:
+        hasher.update(input_file_hash(filename,store_dir).encode())
+    hasher.update(json.dumps(_jsonable(parameters),sort_keys=True).encode())
+    hasher.update(('v%d'%RESULTS_VERSION).encode())
+    return hasher.hexdigest()
+
+################################################################################
+#                             LOAD AND STORE
+################################################################################
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],stderr=subprocess.DEVNULL,\
+                                       cwd=os.path.dirname(os.path.abspath(__file__)))\
+                         .decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return 'unknown'
+
+def store_results(key,RESULTS,input_files=[],parameters={},script='',store_dir=RESULTS_STORE):
+    '''Save RESULTS ({name: array}) and their provenance under key'''
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    filename=os.path.join(store_dir,key+'.nc')
+    # Write to a private file first, so that concurrent jobs never see a
+    # partially written entry
+    tmp_file=filename+'.tmp%d'%os.getpid()
+    STORE=nc.Dataset(tmp_file,'w')
+    STORE.setncatts({'key'        :key,
+                     'script'     :script,
+                     'created'    :time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime()),
+                     'host'       :socket.gethostname(),
+                     'git_commit' :_git_commit(),
+                     'version'    :RESULTS_VERSION,
+                     'numpy'      :np.__version__,
+                     'netCDF4'    :nc.__version__,
+                     'input_files':json.dumps(dict((os.path.abspath(f),\
+                                                    input_file_hash(f,store_dir))\
+                                                   for f in input_files)),
+                     'parameters' :json.dumps(_jsonable(parameters),sort_keys=True)})
+    for name,value in RESULTS.items():
+        masked=isinstance(value,np.ma.MaskedArray)
+        value=np.ma.asarray(value)
+        dimensions=[]
+        for axis,size in enumerate(value.shape):
+            dimensions.append('%s_%d'%(name,axis))
+            STORE.createDimension(dimensions[-1],size)
+        chunksizes=(1,)+value.shape[1:] if value.ndim>=2 else None
+        fill_value=value.fill_value if masked else None
+        x=STORE.createVariable(name,value.dtype,tuple(dimensions),fill_value=fill_value,\
+                               zlib=value.ndim>0,complevel=COMPRESSION_LEVEL,\
+                               chunksizes=chunksizes)
+        x.masked=int(masked)
+        x[...]=value
+    STORE.close()
+    os.replace(tmp_file,filename)
+    return filename
+
+def load_results(key,store_dir=RESULTS_STORE,names=[]):
+    '''Stored results ({name: array}) for key, or None'''
+    filename=os.path.join(store_dir,key+'.nc')
+    if not os.path.isfile(filename):
+        return None
+    STORE=nc.Dataset(filename)
+    if not all(name in STORE.variables for name in names):
+        STORE.close()
+        return None
+    RESULTS={}
+    for name,variable in STORE.variables.items():
+        value=variable[...]
+        if not variable.masked:
+            value=np.ma.getdata(value)
+        RESULTS[name]=value[()] if value.ndim==0 else value
+    STORE.close()
+    return RESULTS
+
+def load_provenance(key,store_dir=RESULTS_STORE):
+    '''Provenance metadata of stored results'''
+    STORE=nc.Dataset(os.path.join(store_dir,key+'.nc'))
+    PROVENANCE=dict((name,STORE.getncattr(name)) for name in STORE.ncattrs())
+    STORE.close()
+    for name in ['input_files','parameters']:
+        PROVENANCE[name]=json.loads(PROVENANCE[name])
+    return PROVENANCE
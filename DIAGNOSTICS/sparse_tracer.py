@@ -0,0 +1,64 @@
+import numpy as np
+from ts_histogram import digitize
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Active-cell (sparse) representation of passive tracer fields. A tangent-linear
+tracer is non-zero only in a small patch early in a run, and adjoint
+ventilation only at surface outcrops, so rather than multiplying, summing and
+histogramming every cell of the global grid, a block of records is reduced to
+the list of its non-zero cells, and every diagnostic is accumulated over that
+list with np.bincount. The cost of the diagnostics then scales with the
+tracer footprint rather than with the size of the grid. Masked cells are
+treated as zero, so never appear in the list.
+
+active_cells(block)
+       (record,index,values) of the non-zero cells of a (t,...) block, where
+       index is flattened over the non-time dimensions
+record_sums(record,values,nrecords)
+       (t,) sum of values in each record
+scatter_sums(record,index,values,nrecords,size)
+       (t,size) sum of values at each index of each record (e.g. with index
+       the (y,x) column of each cell, the depth-integrated field)
+active_ts_histogram(record,index,values,traj_tn,traj_sn,tem_bins,sal_bins)
+       (t,T,S) histogram of values in the TS class of each active cell, as
+       ts_histogram.ts_histograms (but only digitising active cells)
+active_bin_histogram(record,index,values,bin_indices,tem_bins,sal_bins)
+       as active_ts_histogram, from (t,N) TS bin indices already calculated
+       by ts_histogram.ts_bin_indices
+'''
+
+def active_cells(block):
+    '''Record, flat index and value of the non-zero cells of a (t,...) block'''
+    flat=np.ma.filled(block,0).reshape(np.shape(block)[0],-1)
+    record,index=np.nonzero(flat)
+    return record,index,flat[record,index]
+
+def record_sums(record,values,nrecords):
+    '''Sum of values in each record'''
+    return np.bincount(record,weights=values,minlength=nrecords)
+
+def scatter_sums(record,index,values,nrecords,size):
+    '''(t,size) sums of values at each index of each record'''
+    return np.bincount(record*size+index,weights=values,minlength=nrecords*size)\
+             .reshape(nrecords,size)
+
+def active_ts_histogram(record,index,values,traj_tn,traj_sn,tem_bins,sal_bins):
+    '''(t,T,S) histogram of values, binned by T and S at each active cell'''
+    nrecords=np.shape(traj_tn)[0]
+    ntem,nsal=len(tem_bins)-1,len(sal_bins)-1
+    tem_index=digitize(np.ma.getdata(traj_tn).reshape(nrecords,-1)[record,index],tem_bins)
+    sal_index=digitize(np.ma.getdata(traj_sn).reshape(nrecords,-1)[record,index],sal_bins)
+    inside=(tem_index>=0) & (sal_index>=0)
+    return scatter_sums(record[inside],(tem_index*nsal+sal_index)[inside],values[inside],\
+                        nrecords,ntem*nsal).reshape(nrecords,ntem,nsal)
+
+def active_bin_histogram(record,index,values,bin_indices,tem_bins,sal_bins):
+    '''(t,T,S) histogram of values, from the TS bin index of each active cell'''
+    nrecords=np.shape(bin_indices)[0]
+    ntem,nsal=len(tem_bins)-1,len(sal_bins)-1
+    bin_index=bin_indices[record,index]
+    inside=bin_index>=0
+    return scatter_sums(record[inside],bin_index[inside],values[inside],\
+                        nrecords,ntem*nsal).reshape(nrecords,ntem,nsal)
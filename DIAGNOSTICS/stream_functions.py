@@ -0,0 +1,79 @@
+import numpy as np
+from nemo_io import record_blocks
+from instrumentation import stage
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Barotropic and meridional overturning stream functions of the North Atlantic
+from the trajectory climatology. Only the meridional velocity 'vn' is read,
+one block of days at a time, and accumulated into monthly sums; the annual,
+monthly and seasonal mean velocities (and so stream functions) all come from
+this single pass. Days are assigned to months of a 365-day (noleap) year
+starting on 1 January, as in the trajectory, and the land mask is assumed
+constant in time. Means are accumulated in float64, so differ from a float32
+np.mean of the whole field only by its rounding error.
+
+barotropic_stream_function(v_bar,e1v,e3v,atlmsk)
+       (y,x) barotropic stream function (Sv, integrated from W to E)
+overturning_stream_function(v_bar,e1v,e3v,atlmsk)
+       (z,y) meridional overturning stream function (Sv)
+climatology_stream_functions(TRAJ_CLIM,GRID,records_per_block)
+       dictionary containing:
+       v_bar         (  z,y,x) : annual mean meridional velocity
+       BSFv          (    y,x) : annual mean barotropic stream function
+       MSF           (  z,y  ) : annual mean overturning stream function
+       BSFv_monthly  (12,  y,x): monthly mean barotropic stream function
+       MSF_monthly   (12,z,y  ): monthly mean overturning stream function
+       BSFv_seasonal ( 4,  y,x): seasonal (SEASONS) barotropic stream function
+       MSF_seasonal  ( 4,z,y  ): seasonal (SEASONS) overturning stream function
+'''
+
+DAYS_IN_MONTH=np.array([31,28,31,30,31,30,31,31,30,31,30,31])
+SEASONS      ={'DJF':[11,0,1],'MAM':[2,3,4],'JJA':[5,6,7],'SON':[8,9,10]}
+
+def barotropic_stream_function(v_bar,e1v,e3v,atlmsk):
+    '''Atlantic barotropic stream function (Sv, integrated from W to E)'''
+    return np.cumsum(np.sum(e3v[:,:,:]*e1v[:,:]*v_bar[:,:,:]*atlmsk[:,:],axis=0),axis=1)*1e-6
+
+def overturning_stream_function(v_bar,e1v,e3v,atlmsk):
+    '''Atlantic meridional overturning stream function (Sv)'''
+    return np.cumsum(np.sum(atlmsk*e1v*e3v*v_bar,axis=2),axis=0)*1e-6
+
+def climatology_stream_functions(TRAJ_CLIM,GRID,records_per_block=5):
+    '''Annual, monthly and seasonal stream functions in one pass over vn'''
+    e1v   =GRID['e1v'      ][0,:,:]
+    e3v   =GRID['e3v'      ][0,:,:,:]
+    atlmsk=GRID['atlmsk_NA'] #North Atlantic only
+    month_of_day=np.repeat(np.arange(12),DAYS_IN_MONTH)
+
+    ## Accumulate monthly sums of meridional velocity:
+    vn=TRAJ_CLIM.variables['vn']
+    v_sum   =np.zeros((12,)+vn.shape[1:])
+    v_count =np.zeros(12)
+    v_valid =np.zeros(vn.shape[1:],dtype=bool) # Points with data in any record
+    for start,stop,(v,) in record_blocks([vn],records_per_block):
+        with stage('mean velocity'):
+            for ii in np.arange(stop-start):
+                month=month_of_day[(start+ii)%365]
+                v_sum  [month]+=np.ma.filled(v[ii],0)
+                v_count[month]+=1
+                v_valid|=~np.ma.getmaskarray(v[ii])
+
+    def mean_velocity(months):
+        return np.ma.masked_where(~v_valid,np.sum(v_sum[months],axis=0)/np.sum(v_count[months]))
+
+    ## Stream functions of annual, monthly and seasonal mean velocity:
+    with stage('stream functions'):
+        v_bar=mean_velocity(np.arange(12))
+        RESULTS={'v_bar':v_bar,
+                 'BSFv' :barotropic_stream_function (v_bar,e1v,e3v,atlmsk),
+                 'MSF'  :overturning_stream_function(v_bar,e1v,e3v,atlmsk)}
+        for period,groups in [('monthly' ,[[month] for month in np.arange(12)]),\
+                              ('seasonal',list(SEASONS.values()))]:
+            v_means=[mean_velocity(months) for months in groups]
+            RESULTS['BSFv_'+period]=np.ma.stack([barotropic_stream_function (v_mean,e1v,e3v,atlmsk)\
+                                                 for v_mean in v_means])
+            RESULTS['MSF_' +period]=np.ma.stack([overturning_stream_function(v_mean,e1v,e3v,atlmsk)\
+                                                 for v_mean in v_means])
+    return RESULTS
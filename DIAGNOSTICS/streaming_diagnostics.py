@@ -0,0 +1,450 @@
+import multiprocessing
+import numpy as np
+import netCDF4 as nc
+from grid_metrics import grid_metrics,R_earth
+from nemo_io import record_blocks,read_records,read_precision
+from instrumentation import stage,worker_stages,merge_stages
+from ts_histogram import ts_bin_indices,ts_histograms
+from sparse_tracer import active_cells,record_sums,scatter_sums,active_ts_histogram,\
+                          active_bin_histogram
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Bounded-memory versions of the water-mass diagnostics. Outputs are read one
+block of records at a time and every quantity is accumulated incrementally,
+so peak working memory depends on the block size and not on the number of
+outputs in the run. Each block is timed in instrumentation stages (see
+instrumentation.py). Results match the corresponding scripts.
+
+If sparse is True, each block is first reduced to its non-zero tracer cells
+(see sparse_tracer.py), and all sums, centres of mass and histograms are
+taken over those cells only. Results then match to within rounding (the sums
+are taken in a different order).
+
+The TS histograms of the tangent-linear and adjoint diagnostics may instead be
+filled from ts_indices, the (t,N) TS bin indices of every record in file
+order (ts_histogram.ts_bin_indices of tn,sn, or of their surface values for
+the adjoint), when these have already been calculated (e.g. once for several
+runs sharing a trajectory). tn and sn are then not read.
+
+The lateral spread of tracer (lateral_STD) is calculated in the same pass as
+its centre of mass, for each block of records as it is read, from the
+great-circle distance to the centre of mass of each column of the
+depth-integrated volume (or, if sparse, of each active cell), so never from
+the full 3D field (see lateral_spread). The vertical spread (vertical_STD)
+follows from the volume at each level, accumulated in the same pass. The
+grid's Cartesian coordinates are cached by grid_metrics.py, so no trigonometry
+of grid positions is evaluated per record.
+
+tangent_linear_streaming(OUTPUT_NC,GRID,tem_bins,sal_bins,records_per_block,sparse,ts_indices)
+       streaming equivalent of diagnostics_tangent_linear.py. Returns a
+       dictionary with every quantity documented there apart from the full
+       (t,z,y,x) tracer_volume, which is never held in memory
+adjoint_streaming(OUTPUT_NC,GRID,tem_bins,sal_bins,records_per_block,target_fraction,sparse,
+                  ts_indices)
+       streaming equivalent of diagnostics_adjoint.py. Records are read
+       directly from the file in reverse ("age") order, without flipping
+       whole arrays. If target_fraction is given, reading stops at the first
+       age by which that fraction of the tracer has ventilated, and outputs
+       only cover ages up to it
+advection_scheme_streaming(output_file,mesh_file,records_per_block,sparse)
+       all quantities calculated by compare_advection_schemes.py for a single
+       run, in one fused pass per block of records
+advection_scheme_comparison(schemes,mesh_file,records_per_block,nworkers,sparse)
+       advection_scheme_streaming for each run in the dictionary
+       {scheme name: output file}, with runs spread across worker processes
+'''
+
+################################################################################
+#                               GEOMETRY
+################################################################################
+
+def spherical_projection(X_bar,Y_bar,Z_bar):
+    '''Project mean position back to spherical coordinates and get lat,lon'''
+    lat_bar=(np.rad2deg(np.arccos(Z_bar/np.sqrt(X_bar**2 + Y_bar**2 + Z_bar**2)))-90)
+    lon_bar=(np.rad2deg(np.arctan2(Y_bar,X_bar))-180)
+    return lat_bar,lon_bar
+
+def unit_positions(X,Y,Z):
+    '''(y*x,3) unit vectors towards each T point of the Cartesian grid X,Y,Z'''
+    return np.stack([np.ravel(X),np.ravel(Y),np.ravel(Z)],axis=1)/R_earth
+
+def centre_directions(centre):
+    '''(t,3) unit vectors towards the (t,3) centres of mass (X_bar,Y_bar,Z_bar).
+    These are means (sums divided by total volume) rather than sums, so that
+    tracer of negative total volume (e.g. a negative tangent-linear
+    perturbation) is not placed at the antipode'''
+    centre=np.asarray(centre,dtype=np.float64)
+    return centre/np.sqrt(np.sum(centre**2,axis=1))[:,np.newaxis]
+
+def chord_angle(cos_angle):
+    '''Angle (radians) between unit vectors u,r from their dot product u.r,
+    through the chord between them, a=2*arcsin(|r-u|/2) with
+    |r-u|**2=2-2*u.r, which (unlike arccos(u.r)) stays accurate for small
+    angles'''
+    return 2*np.arcsin(np.minimum(np.sqrt(np.maximum(2-2*cos_angle,0))/2,1))
+
+def lateral_spread(unit,depth_integrated_volume,centre,total_volume):
+    '''Volume-weighted RMS great-circle distance (km) of tracer from its
+    (t,3) centre of mass (X_bar,Y_bar,Z_bar), from its (t,y,x)
+    depth-integrated volume on the grid of unit_positions unit'''
+    nrecords=np.shape(depth_integrated_volume)[0]
+    volume=np.ma.filled(depth_integrated_volume,0).reshape(nrecords,-1).astype(np.float64)
+    angle=chord_angle(centre_directions(centre)@unit.T)
+    return R_earth/1e3*np.sqrt(np.sum(volume*angle**2,axis=1)/total_volume)
+
+def active_lateral_spread(unit,record,column,volume,centre,total_volume):
+    '''As lateral_spread, from the active cells of a block of records (see
+    sparse_tracer.active_cells), with column the (y,x) index of each, so
+    that distances are only evaluated where there is tracer'''
+    angle=chord_angle(np.sum(centre_directions(centre)[record]*unit[column],axis=1))
+    return R_earth/1e3*np.sqrt(record_sums(record,volume*angle**2,len(total_volume))\
+                               /total_volume)
+
+def vertical_spread(dep0,dep_bar,horiz_integrated_volume,total_volume):
+    '''Volume-weighted RMS vertical distance (m) of tracer, at the T-point
+    depths dep0, from its centre of mass depth dep_bar'''
+    horiz_integrated_volume=np.ma.filled(horiz_integrated_volume,0).astype(np.float64)
+    dep0_sum        =horiz_integrated_volume@dep0
+    dep0_squared_sum=horiz_integrated_volume@(dep0**2)
+    return np.sqrt((dep0_squared_sum-2*dep_bar*dep0_sum)/total_volume+dep_bar**2)
+
+################################################################################
+#                            TANGENT-LINEAR
+################################################################################
+
+def tangent_linear_streaming(OUTPUT_NC,GRID,tem_bins,sal_bins,records_per_block=1,sparse=False,\
+                             ts_indices=None):
+    '''Tangent-linear water-mass diagnostics accumulated block by block'''
+
+    ## Grid data (from grid_metrics):
+    lat =GRID['gphit'  ][0,:]
+    dep0=GRID['gdept_0'][0,:]
+    dep =read_precision(GRID['dep'])
+    X,Y,Z=GRID['X'],GRID['Y'],GRID['Z']
+    unit=unit_positions(X,Y,Z)
+    cell_volume=read_precision(GRID['cell_volume'])
+    nz=np.shape(dep)[0]
+    ncolumns=np.size(lat)
+
+    ## Initialise outputs:
+    tracer_conc=OUTPUT_NC.variables['pt_conc_tl']
+    noutputs=tracer_conc.shape[0]
+    tracer_depth_integrated_volume=np.ma.zeros((noutputs,)+np.shape(lat))
+    tracer_total_volume           =np.zeros(noutputs)
+    X_sum  =np.zeros(noutputs) # sum(volume*X), etc.
+    Y_sum  =np.zeros(noutputs)
+    Z_sum  =np.zeros(noutputs)
+    dep_sum=np.zeros(noutputs)
+    level_volume=np.zeros((noutputs,nz)) # Horizontally-integrated volume
+    lateral_STD =np.zeros(noutputs)
+    tracer_TS_volume_histogram=np.zeros((noutputs,len(tem_bins)-1,len(sal_bins)-1))
+
+    ## Accumulate one block of outputs at a time:
+    variables=[tracer_conc]
+    if ts_indices is None:
+        variables+=[OUTPUT_NC.variables['tn'],OUTPUT_NC.variables['sn']]
+    for start,stop,block in record_blocks(variables,records_per_block):
+        nblock=stop-start
+        conc=block[0]
+        if ts_indices is None:
+            traj_tn,traj_sn=block[1:]
+        if sparse:
+            with stage('volume'):
+                record,index,conc_values=active_cells(conc)
+                volume=conc_values*cell_volume.reshape(-1)[index]
+                column=index%ncolumns
+                if start==0:
+                    tracer_initial_volume=np.sum(volume[record==0])
+                land=np.ma.getmaskarray(conc).all(axis=1)
+                tracer_depth_integrated_volume[start:stop]=np.ma.masked_array(\
+                        scatter_sums(record,column,volume,nblock,ncolumns).reshape(land.shape),land)
+                tracer_total_volume[start:stop]=record_sums(record,volume,nblock)
+            with stage('centre of mass'):
+                X_sum  [start:stop]=record_sums(record,X.reshape(-1)  [column]*volume,nblock)
+                Y_sum  [start:stop]=record_sums(record,Y.reshape(-1)  [column]*volume,nblock)
+                Z_sum  [start:stop]=record_sums(record,Z.reshape(-1)  [column]*volume,nblock)
+                dep_sum[start:stop]=record_sums(record,dep.reshape(-1)[index ]*volume,nblock)
+                level_volume[start:stop]=scatter_sums(record,index//ncolumns,volume,nblock,nz)
+            with stage('spread'):
+                centre=np.stack([X_sum[start:stop],Y_sum[start:stop],Z_sum[start:stop]],axis=1)\
+                       /tracer_total_volume[start:stop,np.newaxis] # (X_bar,Y_bar,Z_bar)
+                lateral_STD [start:stop]=active_lateral_spread(unit,record,column,volume,centre,\
+                                                  tracer_total_volume[start:stop])
+            with stage('histogram'):
+                if ts_indices is None:
+                    tracer_TS_volume_histogram[start:stop]=\
+                        active_ts_histogram(record,index,volume,traj_tn,traj_sn,tem_bins,sal_bins)
+                else:
+                    tracer_TS_volume_histogram[start:stop]=\
+                        active_bin_histogram(record,index,volume,ts_indices[start:stop],\
+                                             tem_bins,sal_bins)
+        else:
+            with stage('volume'):
+                tracer_volume=conc*cell_volume
+                depth_integrated_volume=np.sum(tracer_volume,axis=1,dtype=np.float64)
+
+                if start==0:
+                    tracer_initial_volume=np.sum(tracer_volume[0,:],dtype=np.float64)
+                tracer_depth_integrated_volume[start:stop]=depth_integrated_volume
+                tracer_total_volume[start:stop]=np.sum(tracer_volume.reshape(nblock,-1),axis=1,\
+                                                       dtype=np.float64)
+            with stage('centre of mass'):
+                X_sum  [start:stop]=np.sum((X*depth_integrated_volume).reshape(nblock,-1),axis=1)
+                Y_sum  [start:stop]=np.sum((Y*depth_integrated_volume).reshape(nblock,-1),axis=1)
+                Z_sum  [start:stop]=np.sum((Z*depth_integrated_volume).reshape(nblock,-1),axis=1)
+                dep_sum[start:stop]=np.sum((tracer_volume*dep      ).reshape(nblock,-1),axis=1,\
+                                           dtype=np.float64)
+                level_volume[start:stop]=np.ma.filled(\
+                        np.sum(tracer_volume.reshape(nblock,nz,-1),axis=2,dtype=np.float64),0)
+            with stage('spread'):
+                centre=np.stack([X_sum[start:stop],Y_sum[start:stop],Z_sum[start:stop]],axis=1)\
+                       /tracer_total_volume[start:stop,np.newaxis] # (X_bar,Y_bar,Z_bar)
+                lateral_STD [start:stop]=lateral_spread(unit,depth_integrated_volume,centre,\
+                                                  tracer_total_volume[start:stop])
+
+            with stage('histogram'):
+                bin_indices=ts_bin_indices(traj_tn,traj_sn,tem_bins,sal_bins)\
+                            if ts_indices is None else ts_indices[start:stop]
+                tracer_TS_volume_histogram[start:stop],=\
+                            ts_histograms(bin_indices,[tracer_volume],tem_bins,sal_bins)
+
+    # DEPTH-INTEGRATED PROBABILITY DENSITY
+    tracer_depth_integrated_prdens=(tracer_depth_integrated_volume/tracer_initial_volume)\
+                                  /GRID['cell_area']
+
+    # TRACER CENTRE OF MASS:
+    X_bar=X_sum/tracer_total_volume
+    Y_bar=Y_sum/tracer_total_volume
+    Z_bar=Z_sum/tracer_total_volume
+    lat_bar,lon_bar=spherical_projection(X_bar,Y_bar,Z_bar)
+    dep_bar=dep_sum/tracer_total_volume
+
+    # TRACER VERTICAL STANDARD DEVIATION (lateral_STD is accumulated above):
+    with stage('spread'):
+        vertical_STD=vertical_spread(dep0,dep_bar,level_volume,tracer_total_volume)
+
+    return {'tracer_depth_integrated_volume':tracer_depth_integrated_volume,
+            'tracer_initial_volume'         :tracer_initial_volume,
+            'tracer_total_volume'           :tracer_total_volume,
+            'tracer_depth_integrated_prdens':tracer_depth_integrated_prdens,
+            'lat_bar'                       :lat_bar,
+            'lon_bar'                       :lon_bar,
+            'dep_bar'                       :dep_bar,
+            'lateral_STD'                   :lateral_STD,
+            'vertical_STD'                  :vertical_STD,
+            'tem_bins'                      :tem_bins,
+            'sal_bins'                      :sal_bins,
+            'tracer_TS_volume_histogram'    :tracer_TS_volume_histogram}
+
+################################################################################
+#                               ADJOINT
+################################################################################
+
+def adjoint_streaming(OUTPUT_NC,GRID,tem_bins,sal_bins,records_per_block=1,target_fraction=None,\
+                      sparse=False,ts_indices=None):
+    '''Adjoint water-mass diagnostics accumulated block by block in age order'''
+    cell_area=GRID['cell_area']
+
+    ## Initialise outputs:
+    tracer_vent=OUTPUT_NC.variables['pt_vent_ad']
+    noutputs=tracer_vent.shape[0]
+    # Age 0 is the last output of the run:
+    with stage('load'):
+        tracer_initial_volume =np.sum(read_records(OUTPUT_NC.variables['pt_vol_ad'],-1),\
+                                       dtype=np.float64)
+    tracer_ventilation_prdens =np.ma.zeros((noutputs,)+np.shape(cell_area)[1:])
+    tracer_TS_volume_histogram=np.zeros((noutputs,len(tem_bins)-1,len(sal_bins)-1))
+    tracer_age_probability    =np.zeros(noutputs)
+
+    ## Accumulate one block of ages at a time:
+    variables=[tracer_vent]
+    if ts_indices is None:
+        variables+=[(OUTPUT_NC.variables['tn'],(0,)),(OUTPUT_NC.variables['sn'],(0,))]
+    for start,stop,block in record_blocks(variables,records_per_block,reverse=True):
+        nblock=stop-start
+        vent=block[0]
+        if ts_indices is None:
+            traj_sst,traj_sss=block[1:]
+            bin_indices=None
+        else:
+            bin_indices=ts_indices[noutputs-stop:noutputs-start][::-1]
+        if sparse:
+            with stage('ventilation'):
+                record,index,vent_values=active_cells(vent)
+                prdens=np.zeros((nblock,np.size(cell_area)))
+                prdens[record,index]=vent_values\
+                                     /(tracer_initial_volume*cell_area.reshape(-1)[index])
+                tracer_ventilation_prdens [start:stop]=np.ma.masked_array(\
+                        prdens.reshape(np.shape(vent)),np.ma.getmaskarray(vent))
+            with stage('histogram'):
+                if bin_indices is None:
+                    tracer_TS_volume_histogram[start:stop]=\
+                        active_ts_histogram(record,index,vent_values,traj_sst,traj_sss,\
+                                            tem_bins,sal_bins)
+                else:
+                    tracer_TS_volume_histogram[start:stop]=\
+                        active_bin_histogram(record,index,vent_values,bin_indices,\
+                                             tem_bins,sal_bins)
+            with stage('age'):
+                tracer_age_probability    [start:stop]=record_sums(record,vent_values,nblock)\
+                                                       /tracer_initial_volume
+        else:
+            with stage('ventilation'):
+                tracer_ventilation_prdens [start:stop]=vent/(tracer_initial_volume*cell_area)
+            with stage('histogram'):
+                if bin_indices is None:
+                    bin_indices=ts_bin_indices(traj_sst,traj_sss,tem_bins,sal_bins)
+                tracer_TS_volume_histogram[start:stop],=\
+                        ts_histograms(bin_indices,[vent],tem_bins,sal_bins)
+            with stage('age'):
+                tracer_age_probability    [start:stop]=np.sum(vent.reshape(nblock,-1),axis=1,\
+                                                              dtype=np.float64)\
+                                                       /tracer_initial_volume
+
+        # pt_vent_ad accumulates through the run, so the age probability is
+        # already cumulative:
+        if target_fraction is not None and \
+           np.any(tracer_age_probability[start:stop]>=target_fraction):
+            nages=start+np.argmax(tracer_age_probability[start:stop]>=target_fraction)+1
+            tracer_ventilation_prdens =tracer_ventilation_prdens [:nages]
+            tracer_TS_volume_histogram=tracer_TS_volume_histogram[:nages]
+            tracer_age_probability    =tracer_age_probability    [:nages]
+            break
+
+    return {'tracer_initial_volume'     :tracer_initial_volume,
+            'tracer_ventilation_prdens' :tracer_ventilation_prdens,
+            'tem_bins'                  :tem_bins,
+            'sal_bins'                  :sal_bins,
+            'tracer_TS_volume_histogram':tracer_TS_volume_histogram,
+            'tracer_age_probability'    :tracer_age_probability}
+
+################################################################################
+#                        ADVECTION SCHEME COMPARISON
+################################################################################
+
+def advection_scheme_streaming(output_file,mesh_file,records_per_block=1,sparse=False):
+    '''Volume, centre of mass and spread of tracer in one advection scheme
+    run, with all reductions of each block of records made in a single pass'''
+    OUTPUT_NC=nc.Dataset(output_file)
+
+    ## Grid data (from grid_metrics):
+    GRID=grid_metrics(mesh_file)
+    lat =GRID['gphit'  ][0,:]
+    dep0=GRID['gdept_0'][0,:]
+    dep =read_precision(GRID['dep'])
+    X,Y,Z=GRID['X'],GRID['Y'],GRID['Z']
+    unit=unit_positions(X,Y,Z)
+    cell_volume=read_precision(GRID['cell_volume'])
+    nz=np.shape(dep)[0]
+    ncolumns=np.size(lat)
+
+    ## Initialise outputs:
+    tracer_conc=OUTPUT_NC.variables['pt_conc_tl']
+    noutputs=tracer_conc.shape[0]
+    depth_integrated_volume=np.ma.zeros((noutputs,)+np.shape(lat))
+    horiz_integrated_volume=np.ma.zeros((noutputs,nz))
+    total_volume           =np.zeros(noutputs)
+    total_positive_volume  =np.zeros(noutputs)
+    total_negative_volume  =np.zeros(noutputs)
+    X_sum  =np.zeros(noutputs) # sum(volume*X), etc.
+    Y_sum  =np.zeros(noutputs)
+    Z_sum  =np.zeros(noutputs)
+    dep_sum=np.zeros(noutputs)
+    lateral_STD=np.zeros(noutputs)
+
+    ## Accumulate one block of outputs at a time:
+    for start,stop,(conc,) in record_blocks([tracer_conc],records_per_block):
+        nblock=stop-start
+        if sparse:
+            with stage('volume'):
+                record,index,conc_values=active_cells(conc)
+                volume=conc_values*cell_volume.reshape(-1)[index]
+                column=index%ncolumns
+                mask=np.ma.getmaskarray(conc)
+                total_volume         [start:stop]=record_sums(record,volume,nblock)
+                total_positive_volume[start:stop]=record_sums(record,np.maximum(volume,0),nblock)
+                total_negative_volume[start:stop]=np.abs(record_sums(record,np.minimum(volume,0),\
+                                                                     nblock))
+                depth_integrated_volume[start:stop]=np.ma.masked_array(\
+                        scatter_sums(record,column,volume,nblock,ncolumns)\
+                        .reshape((nblock,)+np.shape(lat)),mask.all(axis=1))
+                horiz_integrated_volume[start:stop]=np.ma.masked_array(\
+                        scatter_sums(record,index//ncolumns,volume,nblock,nz),\
+                        mask.reshape(nblock,nz,-1).all(axis=2))
+            with stage('centre of mass'):
+                X_sum  [start:stop]=record_sums(record,X.reshape(-1)  [column]*volume,nblock)
+                Y_sum  [start:stop]=record_sums(record,Y.reshape(-1)  [column]*volume,nblock)
+                Z_sum  [start:stop]=record_sums(record,Z.reshape(-1)  [column]*volume,nblock)
+                dep_sum[start:stop]=record_sums(record,dep.reshape(-1)[index ]*volume,nblock)
+            with stage('spread'):
+                centre=np.stack([X_sum[start:stop],Y_sum[start:stop],Z_sum[start:stop]],axis=1)\
+                       /total_volume[start:stop,np.newaxis] # (X_bar,Y_bar,Z_bar)
+                lateral_STD[start:stop]=active_lateral_spread(unit,record,column,volume,centre,\
+                                                              total_volume[start:stop])
+        else:
+            with stage('volume'):
+                volume=conc*cell_volume
+                flat_volume=volume.reshape(nblock,-1)
+                block_depth_integrated_volume=np.sum(volume,axis=1,dtype=np.float64)
+
+                total_volume         [start:stop]=np.sum(flat_volume,axis=1,dtype=np.float64)
+                total_positive_volume[start:stop]=np.sum(np.maximum(flat_volume,0),axis=1,\
+                                                         dtype=np.float64)
+                total_negative_volume[start:stop]=np.abs(np.sum(np.minimum(flat_volume,0),axis=1,\
+                                                                dtype=np.float64))
+                depth_integrated_volume[start:stop]=block_depth_integrated_volume
+                horiz_integrated_volume[start:stop]=np.sum(volume.reshape(nblock,nz,-1),axis=2,\
+                                                           dtype=np.float64)
+            with stage('centre of mass'):
+                X_sum  [start:stop]=np.sum((X*block_depth_integrated_volume)\
+                                            .reshape(nblock,-1),axis=1)
+                Y_sum  [start:stop]=np.sum((Y*block_depth_integrated_volume)\
+                                            .reshape(nblock,-1),axis=1)
+                Z_sum  [start:stop]=np.sum((Z*block_depth_integrated_volume)\
+                                            .reshape(nblock,-1),axis=1)
+                dep_sum[start:stop]=np.sum((volume*dep).reshape(nblock,-1),axis=1,dtype=np.float64)
+            with stage('spread'):
+                centre=np.stack([X_sum[start:stop],Y_sum[start:stop],Z_sum[start:stop]],axis=1)\
+                       /total_volume[start:stop,np.newaxis] # (X_bar,Y_bar,Z_bar)
+                lateral_STD[start:stop]=lateral_spread(unit,block_depth_integrated_volume,centre,\
+                                                       total_volume[start:stop])
+
+    # TRACER CENTRE OF MASS:
+    lat_bar,lon_bar=spherical_projection(X_sum/total_volume,\
+                                         Y_sum/total_volume,\
+                                         Z_sum/total_volume)
+    dep_bar=dep_sum/total_volume
+
+    # TRACER VERTICAL STANDARD DEVIATION (lateral_STD is accumulated above):
+    with stage('spread'):
+        vertical_STD=vertical_spread(dep0,dep_bar,horiz_integrated_volume,total_volume)
+
+    OUTPUT_NC.close()
+    return {'total_volume'           :total_volume,
+            'depth_integrated_volume':depth_integrated_volume,
+            'horiz_integrated_volume':horiz_integrated_volume,
+            'total_positive_volume'  :total_positive_volume,
+            'total_negative_volume'  :total_negative_volume,
+            'lat_bar'                :lat_bar,
+            'lon_bar'                :lon_bar,
+            'dep_bar'                :dep_bar,
+            'lateral_STD'            :lateral_STD,
+            'vertical_STD'           :vertical_STD}
+
+def _advection_scheme_streaming(args):
+    return advection_scheme_streaming(*args),worker_stages()
+
+def advection_scheme_comparison(schemes,mesh_file,records_per_block=1,nworkers=None,sparse=False):
+    '''advection_scheme_streaming for every {scheme name: output file} in
+    schemes, one run per worker process'''
+    names=list(schemes.keys())
+    pool=multiprocessing.Pool(nworkers or min(len(names),multiprocessing.cpu_count()))
+    results=pool.map(_advection_scheme_streaming,\
+                     [(schemes[name],mesh_file,records_per_block,sparse) for name in names])
+    pool.close()
+    pool.join()
+    for result,stages in results:
+        merge_stages(stages)
+    return dict(zip(names,[result for result,stages in results]))
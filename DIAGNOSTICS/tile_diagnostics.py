@@ -0,0 +1,334 @@
+import os
+import re
+import glob
+import multiprocessing
+import numpy as np
+import netCDF4 as nc
+from grid_metrics import grid_metrics
+from nemo_io import read_records,read_precision,tile_position
+from instrumentation import stage,worker_stages,merge_stages
+from ts_histogram import ts_bin_indices,ts_histograms
+from streaming_diagnostics import spherical_projection,unit_positions,lateral_spread,\
+                                  vertical_spread
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Water-mass diagnostics calculated directly from the per-processor NEMOTAM
+output tiles PTTAM_output_<step>_<tile>.nc, without first stitching them
+with rebuild_nemo and concatenating them in time with ncrcat.
+
+Each tile is handled by one worker of a process pool, which reads every
+output file of that tile (in step order) and reduces it to partial results
+over the cells of the tile: its (t,y,x) depth-integrated or surface fields,
+and (t,) totals, (t,z) horizontal sums and (t,T,S) histograms. The parent
+places the tile fields at their position in the global domain (from the
+DOMAIN_position_first/last attributes, as rebuild_nemo does) and adds up the
+partial sums, which are exactly additive across tiles. Where tiles overlap,
+each cell is counted once, taking it from the last tile covering it (as it
+would be in the rebuilt file). Cells covered by no tile (land processors
+removed from the decomposition) are masked. Results therefore match the
+diagnostics of the rebuilt, concatenated file to within rounding (the sums
+are taken in a different order).
+
+Time, bytes read and peak memory in the workers are added to the report of
+the calling process (under 'workers/', see instrumentation.py).
+
+tile_files(tile_directory,prefix)
+       {tile number: [output files of that tile, in step order]}
+tangent_linear_tiles(tile_directory,mesh_file,tem_bins,sal_bins,nworkers,prefix)
+       as streaming_diagnostics.tangent_linear_streaming, from output tiles
+adjoint_tiles(tile_directory,mesh_file,tem_bins,sal_bins,target_fraction,nworkers,prefix)
+       as streaming_diagnostics.adjoint_streaming (in "age" order), from
+       output tiles
+advection_scheme_tiles(tile_directory,mesh_file,nworkers,prefix)
+       as streaming_diagnostics.advection_scheme_streaming, from output tiles
+'''
+
+TILE_PREFIX='PTTAM_output'
+
+################################################################################
+#                                TILES
+################################################################################
+
+def tile_files(tile_directory,prefix=TILE_PREFIX):
+    '''Output files of each tile, in step order'''
+    pattern=re.compile(re.escape(prefix)+r'_(\d{8})_(\d{4})\.nc$')
+    TILES={}
+    for filename in glob.glob(os.path.join(tile_directory,prefix+'_????????_????.nc')):
+        step,tile=map(int,pattern.search(filename).groups())
+        TILES.setdefault(tile,[]).append((step,filename))
+    if not TILES:
+        raise IOError('No %s_????????_????.nc files in %s'%(prefix,tile_directory))
+    return dict((tile,[filename for step,filename in sorted(files)])\
+                for tile,files in sorted(TILES.items()))
+
+def tile_ownership(TILES,shape):
+    '''(jslice,islice,owned) of each tile, where owned marks the cells of the
+    tile not overwritten by a later tile'''
+    positions={}
+    owner=np.full(shape,-1)
+    for tile,files in TILES.items():
+        TILE=nc.Dataset(files[0])
+        positions[tile]=tile_position(TILE)
+        TILE.close()
+        owner[positions[tile]]=tile
+    return dict((tile,(jslice,islice,owner[jslice,islice]==tile))\
+                for tile,(jslice,islice) in positions.items())
+
+def place(data,mask,jslice,islice,owned,tile_field):
+    '''Copy the owned cells of a (t,y,x) tile field into global data and mask'''
+    data[:,jslice,islice][:,owned]=np.ma.getdata     (tile_field)[:,owned]
+    mask[:,jslice,islice][:,owned]=np.ma.getmaskarray(tile_field)[:,owned]
+
+def map_tiles(worker,TILES,mesh_file,args,nworkers=None):
+    '''Yield (tile position, partial results) of worker for each tile,
+    as tiles are finished'''
+    OWNERSHIP=tile_ownership(TILES,np.shape(grid_metrics(mesh_file)['X']))
+    pool=multiprocessing.Pool(nworkers or min(len(TILES),multiprocessing.cpu_count()))
+    for tile,PARTIALS,stages in pool.imap_unordered(worker,\
+            [(tile,files,mesh_file,OWNERSHIP[tile])+args for tile,files in TILES.items()]):
+        merge_stages(stages)
+        yield OWNERSHIP[tile],PARTIALS
+    pool.close()
+    pool.join()
+
+################################################################################
+#                            TILE PARTIALS
+################################################################################
+
+def tracer_tile_partials(files,mesh_file,jslice,islice,owned,tem_bins=None,sal_bins=None):
+    '''Partial tracer volume sums over the owned cells of one tile, through
+    every output file of the tile'''
+    GRID=grid_metrics(mesh_file)
+    cell_volume=read_precision(GRID['cell_volume'][...,jslice,islice]*owned)
+    dep=read_precision(GRID['dep'][:,jslice,islice])
+    X,Y,Z=[GRID[name][jslice,islice] for name in ['X','Y','Z']]
+
+    PARTIALS=dict((name,[]) for name in ['depth_integrated_volume','horiz_integrated_volume',\
+                                         'total_volume','total_positive_volume',\
+                                         'total_negative_volume','X_sum','Y_sum','Z_sum',\
+                                         'dep_sum','TS_volume_histogram'])
+    for filename in files:
+        TILE=nc.Dataset(filename)
+        with stage('load'):
+            conc=read_records(TILE.variables['pt_conc_tl'])
+            if tem_bins is not None:
+                traj_tn=read_records(TILE.variables['tn'])
+                traj_sn=read_records(TILE.variables['sn'])
+        TILE.close()
+        nrecords=np.shape(conc)[0]
+        with stage('volume'):
+            volume=conc*cell_volume
+            flat_volume=volume.reshape(nrecords,-1)
+            depth_integrated_volume=np.sum(volume,axis=1,dtype=np.float64)
+            PARTIALS['depth_integrated_volume'].append(depth_integrated_volume)
+            PARTIALS['horiz_integrated_volume'].append(\
+                    np.sum(volume.reshape(nrecords,np.shape(dep)[0],-1),axis=2,dtype=np.float64))
+            PARTIALS['total_volume'         ].append(np.sum(flat_volume,axis=1,dtype=np.float64))
+            PARTIALS['total_positive_volume'].append(np.sum(np.maximum(flat_volume,0),axis=1,\
+                                                            dtype=np.float64))
+            PARTIALS['total_negative_volume'].append(np.sum(np.minimum(flat_volume,0),axis=1,\
+                                                            dtype=np.float64))
+        with stage('centre of mass'):
+            for name,coordinate in [('X_sum',X),('Y_sum',Y),('Z_sum',Z)]:
+                PARTIALS[name].append(np.sum((coordinate*depth_integrated_volume)\
+                                             .reshape(nrecords,-1),axis=1))
+            PARTIALS['dep_sum'].append(np.sum((volume*dep).reshape(nrecords,-1),axis=1,\
+                                              dtype=np.float64))
+        if tem_bins is not None:
+            with stage('histogram'):
+                histogram,=ts_histograms(ts_bin_indices(traj_tn,traj_sn,tem_bins,sal_bins),\
+                                         [volume],tem_bins,sal_bins)
+                PARTIALS['TS_volume_histogram'].append(histogram)
+
+    # Fields keep their masks; sums over masked (land) cells only are zero
+    return dict((name,np.ma.concatenate(partials) if 'integrated' in name\
+                      else np.ma.filled(np.ma.concatenate(partials),0))\
+                for name,partials in PARTIALS.items() if partials)
+
+def ventilation_tile_partials(files,mesh_file,jslice,islice,owned,tem_bins,sal_bins):
+    '''Partial ventilated volume sums over the owned cells of one tile,
+    through every output file of the tile (in time order)'''
+    PARTIALS=dict((name,[]) for name in ['ventilation','ventilated_volume',\
+                                         'TS_volume_histogram'])
+    for filename in files:
+        TILE=nc.Dataset(filename)
+        with stage('load'):
+            vent    =read_records( TILE.variables['pt_vent_ad'])
+            traj_sst=read_records((TILE.variables['tn'],(0,)))
+            traj_sss=read_records((TILE.variables['sn'],(0,)))
+        nrecords=np.shape(vent)[0]
+        owned_vent=vent*owned
+        with stage('ventilation'):
+            PARTIALS['ventilation'      ].append(vent)
+            PARTIALS['ventilated_volume'].append(\
+                    np.ma.filled(np.sum(owned_vent.reshape(nrecords,-1),axis=1,dtype=np.float64),0))
+        with stage('histogram'):
+            histogram,=ts_histograms(ts_bin_indices(traj_sst,traj_sss,tem_bins,sal_bins),\
+                                     [owned_vent],tem_bins,sal_bins)
+            PARTIALS['TS_volume_histogram'].append(histogram)
+        if filename==files[-1]:
+            # The adjoint run ends (age 0) with the last output:
+            with stage('load'):
+                initial_volume=np.ma.filled(\
+                        np.sum(read_records(TILE.variables['pt_vol_ad'],-1)*owned,dtype=np.float64),0)
+        TILE.close()
+
+    PARTIALS=dict((name,np.ma.concatenate(partials)) for name,partials in PARTIALS.items())
+    PARTIALS['initial_volume']=float(initial_volume)
+    return PARTIALS
+
+def _tile_partials(args):
+    worker,tile,files,mesh_file,(jslice,islice,owned)=args[:5]
+    return tile,worker(files,mesh_file,jslice,islice,owned,*args[5:]),worker_stages()
+
+def _tracer_tile_partials(args):
+    return _tile_partials((tracer_tile_partials,)+args)
+
+def _ventilation_tile_partials(args):
+    return _tile_partials((ventilation_tile_partials,)+args)
+
+################################################################################
+#                            MERGED RESULTS
+################################################################################
+
+def merge_tracer_tiles(tile_directory,mesh_file,tem_bins=None,sal_bins=None,nworkers=None,\
+                       prefix=TILE_PREFIX):
+    '''Sum of the tracer partials of every tile, with depth-integrated
+    volume placed on the global grid, and its lateral and vertical spread'''
+    shape=np.shape(grid_metrics(mesh_file)['X'])
+    TOTALS={}
+    for (jslice,islice,owned),PARTIALS in map_tiles(_tracer_tile_partials,\
+                                                    tile_files(tile_directory,prefix),\
+                                                    mesh_file,(tem_bins,sal_bins),nworkers):
+        with stage('merge'):
+            if not TOTALS:
+                noutputs=len(PARTIALS['total_volume'])
+                data=np.zeros((noutputs,)+shape)
+                mask=np.ones ((noutputs,)+shape,dtype=bool)
+                horiz_mask=np.ones(np.shape(PARTIALS['horiz_integrated_volume']),dtype=bool)
+                TOTALS=dict((name,np.zeros(np.shape(partial)))\
+                            for name,partial in PARTIALS.items()\
+                            if name!='depth_integrated_volume')
+            place(data,mask,jslice,islice,owned,PARTIALS.pop('depth_integrated_volume'))
+            # Levels are masked where they are land in every tile:
+            horiz_mask&=np.ma.getmaskarray(PARTIALS['horiz_integrated_volume'])
+            for name,partial in PARTIALS.items():
+                TOTALS[name]+=np.ma.filled(partial,0)
+    TOTALS['depth_integrated_volume']=np.ma.masked_array(data,mask)
+    TOTALS['horiz_integrated_volume']=np.ma.masked_array(TOTALS['horiz_integrated_volume'],\
+                                                         horiz_mask)
+    TOTALS['total_negative_volume']=np.abs(TOTALS['total_negative_volume'])
+
+    # TRACER LATERAL AND VERTICAL STANDARD DEVIATION:
+    with stage('spread'):
+        GRID=grid_metrics(mesh_file)
+        centre=np.stack([TOTALS['X_sum'],TOTALS['Y_sum'],TOTALS['Z_sum']],axis=1)\
+               /TOTALS['total_volume'][:,np.newaxis] # (X_bar,Y_bar,Z_bar)
+        TOTALS['lateral_STD' ]=lateral_spread(unit_positions(GRID['X'],GRID['Y'],GRID['Z']),\
+                                              TOTALS['depth_integrated_volume'],centre,\
+                                              TOTALS['total_volume'])
+        TOTALS['vertical_STD']=vertical_spread(GRID['gdept_0'][0,:],\
+                                               TOTALS['dep_sum']/TOTALS['total_volume'],\
+                                               TOTALS['horiz_integrated_volume'],\
+                                               TOTALS['total_volume'])
+    return TOTALS
+
+def tangent_linear_tiles(tile_directory,mesh_file,tem_bins,sal_bins,nworkers=None,\
+                         prefix=TILE_PREFIX):
+    '''Tangent-linear water-mass diagnostics from per-processor output tiles'''
+    GRID=grid_metrics(mesh_file)
+    TOTALS=merge_tracer_tiles(tile_directory,mesh_file,tem_bins,sal_bins,nworkers,prefix)
+    tracer_total_volume  =TOTALS['total_volume']
+    tracer_initial_volume=tracer_total_volume[0]
+
+    # DEPTH-INTEGRATED PROBABILITY DENSITY
+    tracer_depth_integrated_prdens=(TOTALS['depth_integrated_volume']/tracer_initial_volume)\
+                                  /GRID['cell_area']
+
+    # TRACER CENTRE OF MASS:
+    lat_bar,lon_bar=spherical_projection(TOTALS['X_sum']/tracer_total_volume,\
+                                         TOTALS['Y_sum']/tracer_total_volume,\
+                                         TOTALS['Z_sum']/tracer_total_volume)
+    dep_bar=TOTALS['dep_sum']/tracer_total_volume
+
+    return {'tracer_depth_integrated_volume':TOTALS['depth_integrated_volume'],
+            'tracer_initial_volume'         :tracer_initial_volume,
+            'tracer_total_volume'           :tracer_total_volume,
+            'tracer_depth_integrated_prdens':tracer_depth_integrated_prdens,
+            'lat_bar'                       :lat_bar,
+            'lon_bar'                       :lon_bar,
+            'dep_bar'                       :dep_bar,
+            'lateral_STD'                   :TOTALS['lateral_STD'],
+            'vertical_STD'                  :TOTALS['vertical_STD'],
+            'tem_bins'                      :tem_bins,
+            'sal_bins'                      :sal_bins,
+            'tracer_TS_volume_histogram'    :TOTALS['TS_volume_histogram']}
+
+def adjoint_tiles(tile_directory,mesh_file,tem_bins,sal_bins,target_fraction=None,\
+                  nworkers=None,prefix=TILE_PREFIX):
+    '''Adjoint water-mass diagnostics, in age order, from per-processor
+    output tiles'''
+    cell_area=grid_metrics(mesh_file)['cell_area']
+    shape=np.shape(cell_area)[1:]
+    TOTALS={}
+    for (jslice,islice,owned),PARTIALS in map_tiles(_ventilation_tile_partials,\
+                                                    tile_files(tile_directory,prefix),\
+                                                    mesh_file,(tem_bins,sal_bins),nworkers):
+        with stage('merge'):
+            if not TOTALS:
+                noutputs=len(PARTIALS['ventilated_volume'])
+                data=np.zeros((noutputs,)+shape)
+                mask=np.ones ((noutputs,)+shape,dtype=bool)
+                TOTALS={'ventilated_volume'  :np.zeros(noutputs),
+                        'TS_volume_histogram':np.zeros(np.shape(PARTIALS['TS_volume_histogram'])),
+                        'initial_volume'     :0.}
+            place(data,mask,jslice,islice,owned,PARTIALS.pop('ventilation'))
+            for name,partial in PARTIALS.items():
+                TOTALS[name]+=partial
+
+    # Age 0 is the last output of the run:
+    tracer_initial_volume     =TOTALS['initial_volume']
+    tracer_ventilation_prdens =np.ma.masked_array(data,mask)[::-1]\
+                               /(tracer_initial_volume*cell_area)
+    tracer_TS_volume_histogram=TOTALS['TS_volume_histogram'][::-1]
+    tracer_age_probability    =TOTALS['ventilated_volume'  ][::-1]/tracer_initial_volume
+
+    # pt_vent_ad accumulates through the run, so the age probability is
+    # already cumulative:
+    if target_fraction is not None and np.any(tracer_age_probability>=target_fraction):
+        nages=np.argmax(tracer_age_probability>=target_fraction)+1
+        tracer_ventilation_prdens =tracer_ventilation_prdens [:nages]
+        tracer_TS_volume_histogram=tracer_TS_volume_histogram[:nages]
+        tracer_age_probability    =tracer_age_probability    [:nages]
+
+    return {'tracer_initial_volume'     :tracer_initial_volume,
+            'tracer_ventilation_prdens' :tracer_ventilation_prdens,
+            'tem_bins'                  :tem_bins,
+            'sal_bins'                  :sal_bins,
+            'tracer_TS_volume_histogram':tracer_TS_volume_histogram,
+            'tracer_age_probability'    :tracer_age_probability}
+
+def advection_scheme_tiles(tile_directory,mesh_file,nworkers=None,prefix=TILE_PREFIX):
+    '''Volume, centre of mass and spread of tracer in one advection scheme
+    run, from per-processor output tiles'''
+    TOTALS=merge_tracer_tiles(tile_directory,mesh_file,nworkers=nworkers,prefix=prefix)
+    total_volume=TOTALS['total_volume']
+
+    # TRACER CENTRE OF MASS:
+    lat_bar,lon_bar=spherical_projection(TOTALS['X_sum']/total_volume,\
+                                         TOTALS['Y_sum']/total_volume,\
+                                         TOTALS['Z_sum']/total_volume)
+    dep_bar=TOTALS['dep_sum']/total_volume
+
+    return {'total_volume'           :total_volume,
+            'depth_integrated_volume':TOTALS['depth_integrated_volume'],
+            'horiz_integrated_volume':TOTALS['horiz_integrated_volume'],
+            'total_positive_volume'  :TOTALS['total_positive_volume'],
+            'total_negative_volume'  :TOTALS['total_negative_volume'],
+            'lat_bar'                :lat_bar,
+            'lon_bar'                :lon_bar,
+            'dep_bar'                :dep_bar,
+            'lateral_STD'            :TOTALS['lateral_STD'],
+            'vertical_STD'           :TOTALS['vertical_STD']}
@@ -0,0 +1,137 @@
+import multiprocessing
+import numpy as np
+from grid_metrics import grid_metrics
+from trajectory_store import trajectory_file,store_file,trajectory_blocks
+from tile_diagnostics import tile_ownership
+from water_masses import NADW,NASMW,water_mass_mask
+from instrumentation import stage,write_report,report_to,worker_stages,merge_stages
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Water-mass census of the whole NEMOTAM trajectory, rather than of its
+climatology (as in climatology_NADW_properties.py and
+climatology_NASMW_properties.py), giving the interannual variability of the
+volume and outcrop area of each water mass over the trajectory.
+
+Every record of the trajectory, TRAJECTORY_DIRECTORY/t_????????_????.nc (or
+its store, TRAJECTORY_STORE, see trajectory_store.py), is classified with the
+criteria of water_masses.py (here NADW and NASMW), in one pass. Each
+processor tile is handled by one worker of a process pool, which reads its
+tn and sn a block of RECORDS_PER_BLOCK records at a time (a single record
+when reading the trajectory files), classifies them with the grid metrics of
+the tile's position in the global domain, and keeps only the (t,) volume and
+outcrop-area sums over the tile. Memory per worker is therefore a block of
+one tile, whatever the length of the trajectory. Where tiles overlap, each
+cell is counted once (see tile_diagnostics.tile_ownership). The minimum
+thickness criterion is applied to whole water columns, which every tile
+holds.
+
+The script calculates (saved in OUTPUT_FILE, .npz):
+steps                       : (t,) trajectory steps classified
+years                       : (t,) the same, in years
+<water mass>_volume         : (t,) volume of each water mass (m^3)
+<water mass>_outcrop        : (t,) outcrop area of each water mass (km^2)
+
+Time, bytes read and peak memory of each stage, in the parent and (summed
+over) the workers, are written to REPORT_FILE (see instrumentation.py).
+'''
+
+TRAJECTORY_DIRECTORY='[PATH TO TRAJECTORY]'
+TRAJECTORY_STORE =None # Directory of the repacked trajectory, if any (see trajectory_store.py)
+PATH_TO_MESH_MASK='./'
+PATH_TO_SUBBASINS='./'
+NSTEPS_PER_YEAR  =5475
+NSTEPS_TOTAL     =328500
+NSTEPS_PER_DAY   =15   # nn_ittrjfrq: trajectory output frequency
+NPROCESSORS      =64   # Number of processors trajectory was run on
+NWORKERS         =multiprocessing.cpu_count()
+RECORDS_PER_BLOCK=73   # Records read at once from the store
+WATER_MASSES     ={'NADW':NADW,'NASMW':NASMW}
+OUTPUT_FILE      ='trajectory_census.npz'
+REPORT_FILE      ='trajectory_census_report.json'
+
+################################################################################
+#                              FUNCTIONS
+################################################################################
+
+def tile_grid(GRID,jslice,islice):
+    '''Grid metrics (those with (y,x) dimensions) of a tile'''
+    shape=np.shape(GRID['X'])
+    return dict((name,metric[...,jslice,islice]) for name,metric in GRID.items()\
+                if np.shape(metric)[-2:]==shape)
+
+def tile_census(tile,jslice,islice,owned,mesh_file,subbasins_file,water_masses,\
+                trajectory_directory=TRAJECTORY_DIRECTORY,store_directory=None,\
+                nsteps_total=NSTEPS_TOTAL,nsteps_per_day=NSTEPS_PER_DAY,\
+                records_per_block=RECORDS_PER_BLOCK):
+    '''(t,) volume and outcrop area sums of each water mass over the owned
+    cells of one tile, for every trajectory record from step 0 to
+    nsteps_total'''
+    GRID=tile_grid(grid_metrics(mesh_file,subbasins_file),jslice,islice)
+    cell_volume=GRID['cell_volume'][0]*owned
+    cell_area  =GRID['cell_area'  ][0]*owned
+    nrecords=nsteps_total//nsteps_per_day+1
+    volume =dict((name,np.zeros(nrecords)) for name in water_masses)
+    outcrop=dict((name,np.zeros(nrecords)) for name in water_masses)
+    for steps,BLOCK in trajectory_blocks(tile,0,nsteps_total,nsteps_per_day,\
+                                         trajectory_directory,store_directory,\
+                                         records_per_block,names=['tn','sn']):
+        records=steps//nsteps_per_day
+        for name,criteria in water_masses.items():
+            with stage('classify'):
+                mask=water_mass_mask(BLOCK['tn'],BLOCK['sn'],GRID,criteria)
+            with stage('volume'):
+                volume [name][records]+=np.sum(np.broadcast_to(cell_volume,mask.shape),\
+                                               axis=(1,2,3),where=mask)
+                outcrop[name][records]+=np.sum(np.broadcast_to(cell_area,mask[:,0].shape),\
+                                               axis=(1,2),where=mask[:,0])/1e6
+    return tile,volume,outcrop
+
+def _tile_census(args):
+    return tile_census(*args)+(worker_stages(),)
+
+def trajectory_census(mesh_file,subbasins_file,water_masses=WATER_MASSES,\
+                      trajectory_directory=TRAJECTORY_DIRECTORY,store_directory=None,\
+                      nprocessors=NPROCESSORS,nworkers=NWORKERS,nsteps_total=NSTEPS_TOTAL,\
+                      nsteps_per_day=NSTEPS_PER_DAY,records_per_block=RECORDS_PER_BLOCK):
+    '''Volume and outcrop area time series of each water mass over the whole
+    trajectory, one tile per worker'''
+    GRID=grid_metrics(mesh_file,subbasins_file) # Build the cache once, before the workers read it
+    TILES=dict((tile,[trajectory_file(0,tile,trajectory_directory) if store_directory is None\
+                      else store_file(tile,store_directory)]) for tile in range(nprocessors))
+    OWNERSHIP=tile_ownership(TILES,np.shape(GRID['X']))
+
+    steps=np.arange(0,nsteps_total+1,nsteps_per_day)
+    CENSUS={'steps':steps}
+    for name in water_masses:
+        CENSUS[name+'_volume' ]=np.zeros(len(steps))
+        CENSUS[name+'_outcrop']=np.zeros(len(steps))
+
+    tasks=[(tile,)+OWNERSHIP[tile]+(mesh_file,subbasins_file,water_masses,trajectory_directory,\
+                                    store_directory,nsteps_total,nsteps_per_day,records_per_block)\
+           for tile in TILES]
+    pool=multiprocessing.Pool(min(nworkers,nprocessors),initializer=worker_stages)
+    for tile,volume,outcrop,stages in pool.imap_unordered(_tile_census,tasks):
+        print('tile %04d classified'%tile)
+        merge_stages(stages)
+        for name in water_masses:
+            CENSUS[name+'_volume' ]+=volume [name]
+            CENSUS[name+'_outcrop']+=outcrop[name]
+    pool.close()
+    pool.join()
+    return CENSUS
+
+################################################################################
+#                                 MAIN
+################################################################################
+
+if __name__=='__main__':
+    report_to(REPORT_FILE) # Rewritten as the script runs, so a killed job leaves a report
+    CENSUS=trajectory_census(PATH_TO_MESH_MASK+'mesh_mask.nc',PATH_TO_SUBBASINS+'subbasins.nc',\
+                             WATER_MASSES,TRAJECTORY_DIRECTORY,TRAJECTORY_STORE,NPROCESSORS,\
+                             NWORKERS,NSTEPS_TOTAL,NSTEPS_PER_DAY,RECORDS_PER_BLOCK)
+    CENSUS['years']=CENSUS['steps']/NSTEPS_PER_YEAR
+    with stage('save'):
+        np.savez(OUTPUT_FILE,**CENSUS)
+    write_report(REPORT_FILE)
@@ -0,0 +1,241 @@
+import os
+import multiprocessing
+import numpy as np
+import netCDF4 as nc
+from nemo_io import read_records
+from instrumentation import stage,write_report,report_to,worker_stages,merge_stages
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Compressed, chunked store of the NEMOTAM trajectory. NEMO writes the
+trajectory as one small file per output step and processor tile,
+t_<step>_<tile>.nc, so a 400-year trajectory written every 15 steps on 64
+processors is millions of files, each of which every climatology or
+diagnostic pass opens and reads in turn. Here the files of each tile are
+consolidated into a single file, STORE_DIRECTORY/t_store_<tile>.nc, with:
+- the same variables, dimensions and attributes (including DOMAIN_, so that
+  nemo_io.tile_position and the climatology builder work on it unchanged) as
+  the tile files, and every output step as a record along the unlimited
+  dimension (from step STORE_first_step, every STORE_step_interval steps);
+- record variables compressed (zlib, with shuffle) in chunks of
+  RECORDS_PER_CHUNK records of one level each, so that reading a block of
+  consecutive records, or the time series of a level, touches few chunks;
+- optionally, T, S, U and V quantised to a fixed number of decimal digits
+  (QUANTISE_DIGITS, netCDF4's least_significant_digit), which makes them far
+  more compressible. The absolute error of each quantised value is at most
+  half of 10**-digits (e.g. 0.0005 degC and psu, and 0.05 mm/s, with
+  QUANTISE_DIGITS={'tn':3,'sn':3,'un':4,'vn':4}). This can move values
+  across the limits of water-mass criteria and TS histogram bins, so
+  quantisation is off by default (QUANTISE_DIGITS=None) and the store is
+  lossless.
+
+Repacking can be repeated as the trajectory is extended: records after the
+last step already in the store are appended (UPDATE=True).
+
+trajectory_file(step,tile,trajectory_directory)
+       name of a trajectory tile file written by NEMO
+store_file(tile,store_directory)
+       name of the store file of a tile
+repack_tile(tile,trajectory_directory,store_directory,nsteps_total,
+            nsteps_per_day,quantise_digits,complevel,records_per_chunk,update)
+       write (or extend) the store file of one tile
+repack_trajectory(trajectory_directory,store_directory,nprocessors,...)
+       repack every tile, one tile per worker process
+
+Reader, used in place of the tile files (e.g. by
+build_trajectory_climatology.py with TRAJECTORY_STORE set):
+open_trajectory_tile(tile,step,trajectory_directory,store_directory)
+       netCDF4 Dataset with the variables and attributes of a tile: its store
+       file if store_directory is given, else its file for step
+trajectory_blocks(tile,first_step,last_step,nsteps_per_day,
+                  trajectory_directory,store_directory,records_per_block,names)
+       yields (steps,{name: data}) for consecutive blocks of records of every
+       record variable (or only those in names) of one tile, from first_step
+       to last_step, read
+       (with nemo_io.read_records) from the store if store_directory is
+       given, else file by file
+'''
+
+TRAJECTORY_DIRECTORY='[PATH TO TRAJECTORY]'
+STORE_DIRECTORY     ='TRAJECTORY_STORE/'
+NSTEPS_TOTAL        =328500
+NSTEPS_PER_DAY      =15   # nn_ittrjfrq: trajectory output frequency
+NPROCESSORS         =64   # Number of processors trajectory was run on
+NWORKERS            =multiprocessing.cpu_count()
+UPDATE              =False # Append new trajectory steps to an existing store
+COMPLEVEL           =4
+RECORDS_PER_CHUNK   =73   # A fifth of a year of daily records
+# Decimal digits kept in each variable, e.g. {'tn':3,'sn':3,'un':4,'vn':4}
+# (None: lossless):
+QUANTISE_DIGITS     =None
+REPORT_FILE         ='trajectory_store_report.json'
+
+STORE_PREFIX='t_store'
+
+################################################################################
+#                              FUNCTIONS
+################################################################################
+
+def trajectory_file(step,tile,trajectory_directory=TRAJECTORY_DIRECTORY):
+    return trajectory_directory+'/t_%08d_%04d.nc'%(step,tile)
+
+def store_file(tile,store_directory=STORE_DIRECTORY):
+    return os.path.join(store_directory,'%s_%04d.nc'%(STORE_PREFIX,tile))
+
+def record_variables(DATASET):
+    '''Names of variables varying along the record (unlimited) dimension'''
+    return [name for name,variable in DATASET.variables.items()\
+            if len(variable.dimensions)>0\
+            and DATASET.dimensions[variable.dimensions[0]].isunlimited()]
+
+def record_dimension(DATASET):
+    '''Name of the record (unlimited) dimension'''
+    return [name for name,dimension in DATASET.dimensions.items() if dimension.isunlimited()][0]
+
+def create_store_file(filename,TEMPLATE,first_step,step_interval,quantise_digits=None,\
+                      complevel=COMPLEVEL,records_per_chunk=RECORDS_PER_CHUNK):
+    '''Create the store file of a tile, with the dimensions, attributes and
+    time-invariant variables of its first trajectory file TEMPLATE'''
+    STORE=nc.Dataset(filename,'w')
+    STORE.setncatts(TEMPLATE.__dict__)
+    STORE.STORE_first_step   =first_step
+    STORE.STORE_step_interval=step_interval
+    for name,dimension in TEMPLATE.dimensions.items():
+        STORE.createDimension(name,None if dimension.isunlimited() else dimension.size)
+    records=record_variables(TEMPLATE)
+    for name,variable in TEMPLATE.variables.items():
+        fill_value=getattr(variable,'_FillValue',None)
+        if name in records:
+            # One level (or the whole variable, if it has no levels) per chunk:
+            chunksizes=[records_per_chunk]+[1]*(variable.ndim-3)+list(variable.shape[-2:])\
+                       if variable.ndim>=3 else [records_per_chunk]+list(variable.shape[1:])
+            x=STORE.createVariable(name,variable.datatype,variable.dimensions,\
+                                   fill_value=fill_value,zlib=complevel>0,complevel=complevel,\
+                                   shuffle=True,chunksizes=chunksizes,\
+                                   least_significant_digit=(quantise_digits or {}).get(name))
+        else:
+            x=STORE.createVariable(name,variable.datatype,variable.dimensions,\
+                                   fill_value=fill_value)
+            x[:]=variable[:]
+        x.setncatts(dict((key,value) for key,value in variable.__dict__.items()\
+                         if key!='_FillValue'))
+    return STORE
+
+def repack_tile(tile,trajectory_directory=TRAJECTORY_DIRECTORY,store_directory=STORE_DIRECTORY,\
+                nsteps_total=NSTEPS_TOTAL,nsteps_per_day=NSTEPS_PER_DAY,\
+                quantise_digits=QUANTISE_DIGITS,complevel=COMPLEVEL,\
+                records_per_chunk=RECORDS_PER_CHUNK,update=False):
+    '''Copy every trajectory file of one tile (up to step nsteps_total) into
+    its store file, a chunk of records at a time. If update, only steps after
+    the last one already in the store file are copied'''
+    filename=store_file(tile,store_directory)
+    if update and os.path.isfile(filename):
+        STORE=nc.Dataset(filename,'a')
+        if STORE.STORE_step_interval!=nsteps_per_day:
+            raise ValueError('%s holds every %d steps, not %d'\
+                             %(filename,STORE.STORE_step_interval,nsteps_per_day))
+        nrecords=len(STORE.dimensions[record_dimension(STORE)])
+        first_step=int(STORE.STORE_first_step)+nrecords*nsteps_per_day
+    else:
+        TEMPLATE=nc.Dataset(trajectory_file(0,tile,trajectory_directory))
+        STORE=create_store_file(filename,TEMPLATE,0,nsteps_per_day,quantise_digits,complevel,\
+                                records_per_chunk)
+        TEMPLATE.close()
+        nrecords,first_step=0,0
+    names=record_variables(STORE)
+
+    ## Buffer a chunk of records, so that each chunk is compressed once:
+    buffers=dict((name,[]) for name in names)
+    def flush(nrecords):
+        with stage('save'):
+            for name in names:
+                data=np.ma.concatenate(buffers[name])
+                STORE.variables[name][nrecords:nrecords+len(data)]=data
+                buffers[name]=[]
+        return nrecords+len(data)
+
+    for step in np.arange(first_step,nsteps_total+1,nsteps_per_day):
+        TILE=nc.Dataset(trajectory_file(step,tile,trajectory_directory))
+        with stage('load'):
+            for name in names:
+                buffers[name].append(read_records(TILE.variables[name]))
+        TILE.close()
+        if sum(len(data) for data in buffers[names[0]])>=records_per_chunk:
+            nrecords=flush(nrecords)
+    if buffers[names[0]]:
+        nrecords=flush(nrecords)
+    STORE.close()
+    return tile,nrecords
+
+def _repack_tile(args):
+    return repack_tile(*args)+(worker_stages(),)
+
+def repack_trajectory(trajectory_directory=TRAJECTORY_DIRECTORY,store_directory=STORE_DIRECTORY,\
+                      nprocessors=NPROCESSORS,nworkers=NWORKERS,nsteps_total=NSTEPS_TOTAL,\
+                      nsteps_per_day=NSTEPS_PER_DAY,quantise_digits=QUANTISE_DIGITS,\
+                      complevel=COMPLEVEL,records_per_chunk=RECORDS_PER_CHUNK,update=False):
+    '''Repack every tile of the trajectory, one tile per worker'''
+    if not os.path.isdir(store_directory):
+        os.makedirs(store_directory)
+    tasks=[(tile,trajectory_directory,store_directory,nsteps_total,nsteps_per_day,\
+            quantise_digits,complevel,records_per_chunk,update) for tile in np.arange(nprocessors)]
+    pool=multiprocessing.Pool(min(nworkers,nprocessors),initializer=worker_stages)
+    for tile,nrecords,stages in pool.imap_unordered(_repack_tile,tasks):
+        print('tile %04d: %d records'%(tile,nrecords))
+        merge_stages(stages)
+    pool.close()
+    pool.join()
+
+################################################################################
+#                                 READER
+################################################################################
+
+def open_trajectory_tile(tile,step=0,trajectory_directory=TRAJECTORY_DIRECTORY,\
+                         store_directory=None):
+    '''Store file of a tile if store_directory is given, else its trajectory
+    file for step'''
+    if store_directory is not None:
+        return nc.Dataset(store_file(tile,store_directory))
+    return nc.Dataset(trajectory_file(step,tile,trajectory_directory))
+
+def trajectory_blocks(tile,first_step,last_step,nsteps_per_day=NSTEPS_PER_DAY,\
+                      trajectory_directory=TRAJECTORY_DIRECTORY,store_directory=None,\
+                      records_per_block=RECORDS_PER_CHUNK,names=None):
+    '''Iterate over blocks of records of every record variable (or those in
+    names) of one tile, from the store file or the trajectory files'''
+    if store_directory is None:
+        for step in np.arange(first_step,last_step+1,nsteps_per_day):
+            TILE=nc.Dataset(trajectory_file(step,tile,trajectory_directory))
+            with stage('load'):
+                BLOCK=dict((name,read_records(TILE.variables[name]))\
+                           for name in (names or record_variables(TILE)))
+            TILE.close()
+            yield np.full(len(list(BLOCK.values())[0]),step),BLOCK
+        return
+
+    STORE=nc.Dataset(store_file(tile,store_directory))
+    first,interval=int(STORE.STORE_first_step),int(STORE.STORE_step_interval)
+    nrecords=len(STORE.dimensions[record_dimension(STORE)])
+    if nsteps_per_day!=interval or (first_step-first)%interval!=0 or first_step<first\
+       or (last_step-first)//interval>=nrecords:
+        raise ValueError('steps %d to %d (every %d) are not in %s (%d to %d, every %d)'\
+                         %(first_step,last_step,nsteps_per_day,store_file(tile,store_directory),\
+                           first,first+(nrecords-1)*interval,interval))
+    names=names or record_variables(STORE)
+    stop_record=(last_step-first)//interval+1
+    for start in np.arange((first_step-first)//interval,stop_record,records_per_block):
+        stop=min(start+records_per_block,stop_record)
+        with stage('load'):
+            BLOCK=dict((name,read_records(STORE.variables[name],start,stop)) for name in names)
+        yield first+np.arange(start,stop)*interval,BLOCK
+    STORE.close()
+
+################################################################################
+#                                 MAIN
+################################################################################
+
+if __name__=='__main__':
+    report_to(REPORT_FILE) # Rewritten as the script runs, so a killed job leaves a report
+    repack_trajectory(update=UPDATE)
+    write_report(REPORT_FILE)
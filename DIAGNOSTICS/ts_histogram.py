@@ -0,0 +1,46 @@
+import numpy as np
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Batched temperature-salinity histograms, shared by the tangent-linear and
+adjoint diagnostics. Rather than calling np.histogram2d once per output, the
+T/S fields of every record are digitised once against the fixed tem_bins and
+sal_bins edges, and the histograms of every record (and of any number of
+weight fields) are then filled in a single np.bincount each. Bin edges follow
+np.histogram2d: bins are half-open except the last, which includes its
+right-hand edge, and values outside the edges are ignored.
+
+ts_bin_indices(traj_tn,traj_sn,tem_bins,sal_bins)
+       (t,N) flattened TS bin index of every cell, -1 outside the bins
+ts_histograms(bin_indices,weights,tem_bins,sal_bins)
+       list of (t,T,S) histograms, one per (t,...) weight field in weights
+'''
+
+def digitize(values,bins):
+    '''Bin number of each value (-1 if outside bins), as in np.histogram2d'''
+    index=np.searchsorted(bins,values,side='right')
+    index[values==bins[-1]]-=1
+    index[(index==0) | (index==len(bins))]=0
+    return index-1
+
+def ts_bin_indices(traj_tn,traj_sn,tem_bins,sal_bins):
+    '''Flattened TS bin index of each cell in each record, -1 outside the bins'''
+    nrecords=np.shape(traj_tn)[0]
+    tem_index=digitize(np.ma.getdata(traj_tn).reshape(nrecords,-1),tem_bins)
+    sal_index=digitize(np.ma.getdata(traj_sn).reshape(nrecords,-1),sal_bins)
+    bin_indices=(tem_index*(len(sal_bins)-1)+sal_index).astype(np.int32)
+    bin_indices[(tem_index<0) | (sal_index<0)]=-1
+    return bin_indices
+
+def ts_histograms(bin_indices,weights,tem_bins,sal_bins):
+    '''(t,T,S) histogram of each weight field, all records in one pass'''
+    nrecords=bin_indices.shape[0]
+    nbins=(len(tem_bins)-1)*(len(sal_bins)-1)
+    inside=bin_indices>=0
+    record_bin=(bin_indices+nbins*np.arange(nrecords).reshape(-1,1))[inside]
+    return [np.bincount(record_bin,\
+                        weights=np.ma.getdata(weight).reshape(nrecords,-1)[inside],\
+                        minlength=nrecords*nbins)\
+              .reshape(nrecords,len(tem_bins)-1,len(sal_bins)-1)\
+            for weight in weights]
@@ -0,0 +1,99 @@
+import numpy as np
+from nemo_io import record_blocks
+from instrumentation import stage
+################################################################################
+#                             DESCRIPTION
+################################################################################
+'''
+Water-mass classification from declarative criteria. A water mass is a
+dictionary with any of the following entries:
+tem_range     : (min,max) temperature (degC), inclusive
+sal_range     : (min,max) salinity (psu), inclusive
+lon_range     : (min,max) longitude (degrees east), min <= lon < max
+basin         : name of a basin mask in grid_metrics (e.g. 'atlmsk')
+min_thickness : minimum thickness (m) of the water mass in each water column;
+                columns with less are not counted
+
+All criteria are evaluated together on boolean arrays, one block of records
+at a time, so no full-size float temporaries are made. Masks are stored
+bit-packed (1 bit per cell rather than a float64):
+
+water_mass_mask(tn,sn,GRID,criteria)
+       boolean (t,z,y,x) mask of water satisfying criteria
+water_mass_census(TRAJ,GRID,criteria,nrecords,records_per_block,mask_file)
+       (t,) time series of volume (m^3) and outcrop area (km^2) of the water
+       mass in the records of TRAJ (a dataset with 'tn' and 'sn'). If
+       mask_file is given, the bit-packed mask is saved there (.npz)
+load_water_mass_mask(mask_file,records)
+       unpack a saved mask to a boolean (t,z,y,x) array (optionally only for
+       a slice or list of records)
+'''
+
+# North Atlantic Deep Water
+NADW ={'tem_range':( 2  , 4  ),
+       'sal_range':(34.9,35.0),
+       'basin'    :'atlmsk'}
+
+# North Atlantic Subtropical Mode Water
+NASMW={'tem_range':(17  ,19  ),
+       'sal_range':(36.4,36.6),
+       'lon_range':(-180,-35 ),
+       'basin'    :'atlmsk_NA',
+       'min_thickness':125}
+
+def water_mass_mask(tn,sn,GRID,criteria):
+    '''Boolean mask of (t,z,y,x) cells satisfying all criteria'''
+    tn=np.ma.filled(tn,np.nan)
+    sn=np.ma.filled(sn,np.nan)
+    mask=np.ones(np.shape(tn),dtype=bool)
+    if 'tem_range' in criteria:
+        mask&=(tn>=criteria['tem_range'][0]) & (tn<=criteria['tem_range'][1])
+    if 'sal_range' in criteria:
+        mask&=(sn>=criteria['sal_range'][0]) & (sn<=criteria['sal_range'][1])
+    if 'lon_range' in criteria:
+        lon=GRID['glamt'][0,:]
+        mask&=(lon>=criteria['lon_range'][0]) & (lon<criteria['lon_range'][1])
+    if 'basin' in criteria:
+        mask&=(GRID[criteria['basin']]!=0)
+    if 'min_thickness' in criteria:
+        thickness=np.sum(np.broadcast_to(GRID['e3t'][0,:],mask.shape),axis=1,where=mask)
+        mask&=(thickness>=criteria['min_thickness'])[:,np.newaxis,:,:]
+    return mask
+
+def water_mass_census(TRAJ,GRID,criteria,nrecords=None,records_per_block=5,mask_file=None):
+    '''Volume (m^3) and outcrop area (km^2) time series of a water mass'''
+    variables=[TRAJ.variables['tn'],TRAJ.variables['sn']]
+    nrecords=min(nrecords or variables[0].shape[0],variables[0].shape[0])
+    cell_volume=GRID['cell_volume'][0,:]
+    cell_area  =GRID['cell_area'  ][0,:]
+    ncells=cell_volume.size
+
+    volume =np.zeros(nrecords)
+    outcrop=np.zeros(nrecords)
+    packed_mask=np.zeros((nrecords,(ncells+7)//8),dtype=np.uint8)
+
+    for start,stop,(tn,sn) in record_blocks(variables,records_per_block,nrecords):
+        with stage('classify'):
+            mask=water_mass_mask(tn,sn,GRID,criteria)
+        with stage('volume'):
+            volume [start:stop]=np.sum(np.broadcast_to(cell_volume,mask.shape),\
+                                       axis=(1,2,3),where=mask)
+            outcrop[start:stop]=np.sum(np.broadcast_to(cell_area,mask[:,0].shape),\
+                                       axis=(1,2),where=mask[:,0])/1e6
+            packed_mask[start:stop]=np.packbits(mask.reshape(stop-start,-1),axis=1)
+
+    if mask_file is not None:
+        with stage('save'):
+            np.savez(mask_file,packed_mask=packed_mask,shape=(nrecords,)+np.shape(cell_volume))
+    return volume,outcrop
+
+def load_water_mass_mask(mask_file,records=slice(None)):
+    '''Unpack a mask saved by water_mass_census'''
+    MASK=np.load(mask_file)
+    shape=MASK['shape']
+    packed_mask=MASK['packed_mask'][records]
+    if packed_mask.ndim==1:
+        return np.unpackbits(packed_mask,count=np.prod(shape[1:])).view(bool)\
+                 .reshape(shape[1:])
+    return np.unpackbits(packed_mask,axis=1,count=np.prod(shape[1:])).view(bool)\
+             .reshape((-1,)+tuple(shape[1:]))